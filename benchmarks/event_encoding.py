@@ -0,0 +1,61 @@
+"""
+Microbenchmark of websocket event encoding: the current one-pass encoder against the previous
+implementation, that encoded the payload and the envelope separately and spliced them with a string replace.
+
+    $ python -m benchmarks.event_encoding --number 100000
+"""
+import argparse
+from datetime import datetime, timezone
+import json
+import timeit
+
+from pydantic import ValidationError
+
+from chatrooms.apps.chats.schemas import ChatMessageCreate, ChatMessageDetail
+from chatrooms.apps.chats.websockets import encode_event
+from chatrooms.apps.common.encoders import orjson
+
+
+def legacy_get_event_payload(event, payload):
+    return json.dumps({"event": event, "payload": "[PAYLOAD]"}).replace('"[PAYLOAD]"', payload.json())
+
+
+def make_payloads():
+    message = ChatMessageDetail(
+        id=123456,
+        text="Lorem ipsum dolor sit amet, consectetur adipiscing elit " * 4,
+        created_at=datetime.now(tz=timezone.utc),
+        is_deleted=False,
+        author={'id': 42, 'email': 'author@example.com'},
+    )
+    try:
+        ChatMessageCreate(text='')
+    except ValidationError as err:
+        validation_error = err
+    return {'new_message': message, 'validation_error': validation_error}
+
+
+def run(number: int) -> dict:
+    results = {'encoder': 'orjson' if orjson is not None else 'json', 'number': number, 'events': {}}
+    for event, payload in make_payloads().items():
+        assert json.loads(legacy_get_event_payload(event, payload)) == json.loads(encode_event(event, payload))
+
+        legacy = min(timeit.repeat(lambda: legacy_get_event_payload(event, payload), number=number, repeat=5))
+        current = min(timeit.repeat(lambda: encode_event(event, payload), number=number, repeat=5))
+        results['events'][event] = {
+            'legacy_us': round(legacy / number * 1e6, 3),
+            'current_us': round(current / number * 1e6, 3),
+            'speedup': round(legacy / current, 2),
+        }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=20000, help="encodings per timing round")
+    args = parser.parse_args()
+    print(json.dumps(run(args.number), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+"""
+Benchmark of the fan-out to a busy room, with and without batching of the outbound frames.
+
+Messages are published to a room of `--recipients` websockets at `--rate` per second for `--duration` seconds;
+the websockets encode every frame as it would be written to the socket, and count the frames, each of them
+being a write syscall on a real connection. CPU time is that of this process, from the first message
+until the last one is delivered.
+
+    $ python -m benchmarks.fanout_batching --recipients 2000 --rate 200 --duration 5
+"""
+import argparse
+import asyncio
+import json
+import time
+from uuid import uuid4
+
+from benchmarks.load import get_revision
+from chatrooms.apps.chats.websockets import ChatsConnectionManager
+from chatrooms.apps.common.broadcast import MemoryBroadcast
+from chatrooms.config import settings
+
+
+class CountingWebSocket:
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+
+    async def send_text(self, data: str):
+        self.frames += 1
+        self.bytes += len(data.encode('utf-8'))
+
+    async def close(self, code: int):
+        pass
+
+
+def make_message(message_id: int) -> str:
+    return json.dumps({
+        'event': 'new_message',
+        'payload': {
+            'id': message_id,
+            'text': "Lorem ipsum dolor sit amet, consectetur adipiscing elit",
+            'created_at': '2026-10-17T12:00:00.000000+00:00',
+            'is_deleted': False,
+            'author': {'id': 42, 'email': 'author@example.com'},
+        },
+    })
+
+
+async def run_room(batching: bool, recipients: int, rate: float, duration: float) -> dict:
+    manager = ChatsConnectionManager(
+        MemoryBroadcast(),
+        send_queue_size=100000,
+        batch_hot_rate=settings.WS_BATCH_HOT_CHAT_RATE if batching else 0,
+    )
+    chat_id = uuid4()
+    websockets = [CountingWebSocket() for __ in range(recipients)]
+    connections = [
+        manager.add_connection(chat_id, user_id, ws, batching=batching) for user_id, ws in enumerate(websockets)
+    ]
+
+    messages = int(rate * duration)
+    loop = asyncio.get_running_loop()
+    started_at, cpu_started_at = loop.time(), time.process_time()
+    for message_id in range(messages):
+        await asyncio.sleep(max(started_at + message_id / rate - loop.time(), 0))
+        await manager.send_chat_message(chat_id, make_message(message_id))
+    await asyncio.sleep(manager.batch_delay)
+    for connection in connections:
+        await connection.flush(timeout=60)
+    cpu_seconds = time.process_time() - cpu_started_at
+    wall_seconds = loop.time() - started_at
+
+    for user_id, connection in enumerate(connections):
+        manager.remove_connection(chat_id, user_id, connection)
+    manager.presence.clear()
+
+    frames = sum(ws.frames for ws in websockets)
+    return {
+        'messages': messages,
+        'frames': frames,
+        'frames_per_second': round(frames / wall_seconds),
+        'bytes': sum(ws.bytes for ws in websockets),
+        'cpu_seconds': round(cpu_seconds, 3),
+        'wall_seconds': round(wall_seconds, 3),
+        'cpu_us_per_delivery': round(cpu_seconds / (messages * recipients) * 1e6, 3),
+    }
+
+
+async def run(args: argparse.Namespace) -> dict:
+    results = {
+        'revision': get_revision(),
+        'config': {**vars(args), 'hot_rate': settings.WS_BATCH_HOT_CHAT_RATE, 'delay': settings.WS_BATCH_DELAY},
+        'results': {},
+    }
+    for batching in (False, True):
+        results['results']['batched' if batching else 'single'] = await run_room(
+            batching, args.recipients, args.rate, args.duration,
+        )
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--recipients', type=int, default=2000, help="websockets in the room")
+    parser.add_argument('--rate', type=float, default=200, help="messages per second")
+    parser.add_argument('--duration', type=float, default=5, help="seconds")
+    args = parser.parse_args()
+    loop = asyncio.get_event_loop()
+    print(json.dumps(loop.run_until_complete(run(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
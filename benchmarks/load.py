@@ -0,0 +1,245 @@
+"""
+Load test of the REST and websocket paths, on a live server with a throwaway `<POSTGRES_DB>_BENCH` database.
+
+Scenarios:
+  * websocket - every user connects to its room over /chats/ws/{chat_id} and sends messages; the fan-out
+    latency is the time from sending a message to its delivery to each member of the room;
+  * messages - paging through /chats/{chat_id}/messages, both with page numbers and cursors;
+  * login - /auth/login requests.
+
+Results are printed as JSON, so runs on different commits can be compared.
+
+    $ python -m benchmarks.load --users 200 --rooms 20 --messages 50 > before.json
+"""
+import argparse
+import asyncio
+import json
+import random
+import subprocess
+import time
+from typing import Dict, List
+
+import httpx
+from tortoise import Tortoise
+import websockets
+
+from benchmarks.server import run_live_server
+from benchmarks.stats import summarize
+from chatrooms.apps.chats.models import Chat
+from chatrooms.apps.users.models import Token, User
+from chatrooms.apps.users.security import generate_token, password_hasher
+
+
+PASSWORD = 'benchmarkpassword'
+
+
+class Fixtures:
+    """Seeded users and rooms; user `i` is a member of room `i % rooms`."""
+    emails: List[str]
+    tokens: List[str]
+    rooms: List[str]
+
+    def __init__(self, emails: List[str], tokens: List[str], rooms: List[str]):
+        self.emails = emails
+        self.tokens = tokens
+        self.rooms = rooms
+
+    def get_room(self, user_index: int) -> str:
+        return self.rooms[user_index % len(self.rooms)]
+
+    def get_room_members(self, room_index: int) -> List[int]:
+        return list(range(room_index, len(self.tokens), len(self.rooms)))
+
+
+async def seed(users: int, rooms: int, history: int) -> Fixtures:
+    password = await password_hasher.hash(PASSWORD)
+    await User.bulk_create([User(email=f'user{i}@bench.example.com', password=password) for i in range(users)])
+    user_ids = [user_id for user_id, in await User.all().order_by('id').values_list('id')]
+
+    tokens = [generate_token() for __ in user_ids]
+    await Token.bulk_create([Token(key=key, user_id=user_id) for key, user_id in zip(tokens, user_ids)])
+
+    chats = [Chat(title=f'room {i}', creator_id=user_ids[i]) for i in range(rooms)]
+    await Chat.bulk_create(chats)
+
+    connection = Tortoise.get_connection('default')
+    await connection.execute_many(
+        'INSERT INTO "chat_user" ("chat_id", "user_id") VALUES ($1, $2)',
+        [[chats[i % rooms].id, user_id] for i, user_id in enumerate(user_ids) if i >= rooms],
+    )
+    await connection.execute_query(
+        '''
+        INSERT INTO "chatmessage" ("text", "chat_id", "author_id")
+        SELECT 'history message ' || i, "chat"."id", "chat"."creator_id"
+        FROM "chat" CROSS JOIN generate_series(1, $1) AS i
+        ''',
+        [history],
+    )
+    await connection.execute_script('ANALYZE')
+
+    return Fixtures(
+        emails=[f'user{i}@bench.example.com' for i in range(users)],
+        tokens=tokens,
+        rooms=[str(chat.id) for chat in chats],
+    )
+
+
+async def run_websocket(ws_url: str, fixtures: Fixtures, messages: int, interval: float, timeout: float) -> dict:
+    latencies: List[float] = []
+    expected: Dict[int, int] = {}
+    received: Dict[int, int] = {}
+    connections = []
+    for user_index, token in enumerate(fixtures.tokens):
+        room_index = user_index % len(fixtures.rooms)
+        url = f'{ws_url}/chats/ws/{fixtures.get_room(user_index)}?token={token}'
+        connections.append(await websockets.connect(url, max_queue=None))
+        expected[user_index] = len(fixtures.get_room_members(room_index)) * messages
+        received[user_index] = 0
+
+    async def receive(user_index: int, ws) -> None:
+        while received[user_index] < expected[user_index]:
+            event = json.loads(await ws.recv())
+            if event['event'] != 'new_message':
+                continue
+            sent_at = float(event['payload']['text'].rsplit(':', 1)[1])
+            latencies.append(time.perf_counter() - sent_at)
+            received[user_index] += 1
+
+    async def send(user_index: int, ws) -> None:
+        await asyncio.sleep(random.uniform(0, interval))  # don't send in lockstep
+        for number in range(messages):
+            await ws.send(f'{user_index}:{number}:{time.perf_counter()}')
+            await asyncio.sleep(interval)
+
+    receivers = [asyncio.create_task(receive(user_index, ws)) for user_index, ws in enumerate(connections)]
+    started_at = time.perf_counter()
+    await asyncio.gather(*(send(user_index, ws) for user_index, ws in enumerate(connections)))
+    __, pending = await asyncio.wait(receivers, timeout=timeout)
+    duration = time.perf_counter() - started_at
+    for task in pending:
+        task.cancel()
+    await asyncio.gather(*(ws.close() for ws in connections))
+
+    result = summarize(latencies, duration)
+    result.update({
+        'connections': len(connections),
+        'messages_sent': len(connections) * messages,
+        'deliveries_expected': sum(expected.values()),
+        'deliveries_lost': sum(expected.values()) - len(latencies),
+    })
+    return result
+
+
+async def run_messages(
+        client: httpx.AsyncClient, fixtures: Fixtures, requests: int, pages: int, concurrency: int,
+) -> Dict[str, dict]:
+    async def paginate(pagination: str, worker: int, count: int) -> List[float]:
+        latencies = []
+        user_index = worker % len(fixtures.tokens)
+        headers = {'Authorization': f'Token {fixtures.tokens[user_index]}'}
+        url = f'/chats/{fixtures.get_room(user_index)}/messages'
+        next_url, page = None, 0
+        for __ in range(count):
+            if page == pages or (page and not next_url):
+                next_url, page = None, 0
+            params = {'pagination': pagination} if next_url is None else None
+            if pagination == 'page':
+                params = {'page': page + 1}
+
+            started_at = time.perf_counter()
+            response = await client.get(next_url or url, params=params, headers=headers)
+            latencies.append(time.perf_counter() - started_at)
+            response.raise_for_status()
+            next_url = response.json()['next'] if pagination == 'cursor' else None
+            page += 1
+        return latencies
+
+    results = {}
+    for pagination in ('page', 'cursor'):
+        counts = [requests // concurrency + (worker < requests % concurrency) for worker in range(concurrency)]
+        started_at = time.perf_counter()
+        latencies = await asyncio.gather(*(
+            paginate(pagination, worker, count) for worker, count in enumerate(counts)
+        ))
+        results[pagination] = summarize([latency for chunk in latencies for latency in chunk],
+                                        time.perf_counter() - started_at)
+    return results
+
+
+async def run_login(client: httpx.AsyncClient, fixtures: Fixtures, requests: int, concurrency: int) -> dict:
+    async def login(worker: int, count: int) -> List[float]:
+        latencies = []
+        email = fixtures.emails[worker % len(fixtures.emails)]
+        for __ in range(count):
+            started_at = time.perf_counter()
+            response = await client.post('/auth/login', json={'email': email, 'password': PASSWORD})
+            latencies.append(time.perf_counter() - started_at)
+            response.raise_for_status()
+        return latencies
+
+    counts = [requests // concurrency + (worker < requests % concurrency) for worker in range(concurrency)]
+    started_at = time.perf_counter()
+    latencies = await asyncio.gather(*(login(worker, count) for worker, count in enumerate(counts)))
+    return summarize([latency for chunk in latencies for latency in chunk], time.perf_counter() - started_at)
+
+
+def get_revision() -> str:
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+async def run(args: argparse.Namespace) -> dict:
+    results = {'revision': get_revision(), 'config': vars(args), 'results': {}}
+    async with run_live_server(db_suffix='_BENCH', host=args.host, port=args.port) as server:
+        fixtures = await seed(users=args.users, rooms=args.rooms, history=args.history)
+        limits = httpx.Limits(max_connections=args.concurrency)
+        async with httpx.AsyncClient(base_url=server.base_url, limits=limits, timeout=args.timeout) as client:
+            scenarios = args.scenarios
+            if 'websocket' in scenarios:
+                results['results']['websocket'] = await run_websocket(
+                    server.ws_url, fixtures, messages=args.messages, interval=args.interval, timeout=args.timeout,
+                )
+            if 'messages' in scenarios:
+                results['results']['messages'] = await run_messages(
+                    client, fixtures, requests=args.requests, pages=args.pages, concurrency=args.concurrency,
+                )
+            if 'login' in scenarios:
+                results['results']['login'] = await run_login(
+                    client, fixtures, requests=args.logins, concurrency=args.concurrency,
+                )
+    return results
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenarios', nargs='+', choices=('websocket', 'messages', 'login'),
+                        default=['websocket', 'messages', 'login'])
+    parser.add_argument('--users', type=int, default=100, help="seeded users, every one connects over websocket")
+    parser.add_argument('--rooms', type=int, default=10, help="seeded rooms, users are spread evenly among them")
+    parser.add_argument('--history', type=int, default=1000, help="seeded messages per room")
+    parser.add_argument('--messages', type=int, default=20, help="messages sent by every websocket user")
+    parser.add_argument('--interval', type=float, default=0.05, help="seconds between messages of a user")
+    parser.add_argument('--requests', type=int, default=1000, help="/messages requests per pagination mode")
+    parser.add_argument('--pages', type=int, default=10, help="pages walked through before starting over")
+    parser.add_argument('--logins', type=int, default=100, help="/auth/login requests")
+    parser.add_argument('--concurrency', type=int, default=20, help="concurrent HTTP clients")
+    parser.add_argument('--timeout', type=float, default=60, help="seconds to wait for responses and deliveries")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=3013)
+    args = parser.parse_args()
+    if args.users < args.rooms:
+        parser.error("--users must not be less than --rooms")
+    return args
+
+
+def main():
+    args = parse_args()
+    # the app's module level singletons are bound to the default loop, as under uvicorn
+    loop = asyncio.get_event_loop()
+    print(json.dumps(loop.run_until_complete(run(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,226 @@
+"""
+Benchmark of the monthly partitioned messages table against a plain copy of it, on a throwaway
+`<POSTGRES_DB>_PARTITIONS` database built from the migrations.
+
+Messages are seeded over `--years` years at a steady rate, each to one of the rooms created by then, so older
+rooms have messages in every month and the newest ones only in the last months. The queries are those of
+the message history, the websocket replay and the message deletion, timed for the oldest and the newest room;
+the partitioned ones are bounded by the creation of the room as `Chat.get_messages` does, and the pages
+and replays from a message by its creation too, as `Chat.get_messages_bound` does. Last, a share of the
+latest month's messages is deleted and the plain table and the latest partition are vacuumed.
+
+The full-text index is dropped before seeding, see `benchmarks.search` for the search.
+
+    $ python -m benchmarks.message_partitions --messages 5000000 --years 3 > partitions.json
+"""
+import argparse
+import asyncio
+from datetime import datetime, timedelta, timezone
+import json
+import time
+from typing import Dict, List
+
+from tortoise import Tortoise
+
+from benchmarks.load import get_revision
+from benchmarks.server import create_database, get_database_url
+from benchmarks.stats import summarize
+from chatrooms.apps.chats.models import MESSAGES_CLOCK_SKEW
+from chatrooms.apps.chats.partitions import get_month_start, get_partition_name, get_partitions, maintain_partitions
+
+
+SEED_BATCH_SIZE = 500000
+PLAIN_TABLE = 'chatmessage_plain'
+PAGE_SIZE = 20
+
+SEED_USERS_QUERY = (
+    'INSERT INTO "user" ("email", "password") '
+    'SELECT \'user\' || "i" || \'@bench.example.com\', \'\' FROM generate_series(0, $1 - 1) AS "i"'
+)
+# the i-th room is created after 0.9 * i / rooms of the time
+SEED_ROOMS_QUERY = '''
+INSERT INTO "chat" ("id", "title", "created_at", "creator_id")
+SELECT md5("i"::TEXT)::UUID, 'room ' || "i", $2::TIMESTAMPTZ + ("i"::FLOAT / $1 * 0.9) * $3::INTERVAL, "i" + 1
+FROM generate_series(0, $1 - 1) AS "i"
+'''
+# the i-th message goes to one of the rooms created before it, spread by a prime stride
+SEED_MESSAGES_QUERY = '''
+INSERT INTO "chatmessage" ("id", "text", "created_at", "is_deleted", "author_id", "chat_id")
+SELECT "i", 'Lorem ipsum dolor sit amet, consectetur adipiscing elit ' || "i", "message"."created_at", false,
+    "room" + 1, md5("room"::TEXT)::UUID
+FROM generate_series($1::INT, $2::INT) AS "i"
+CROSS JOIN LATERAL (SELECT $5::TIMESTAMPTZ + ("i"::FLOAT / $3) * $6::INTERVAL AS "created_at") AS "message"
+CROSS JOIN LATERAL (
+    SELECT "i"::BIGINT * 7919 % LEAST($4::INT, 1 + floor("i"::FLOAT / $3 / 0.9 * $4::INT)::INT) AS "room"
+) AS "target"
+'''
+
+QUERIES = {
+    'latest_page': (
+        'SELECT * FROM "{table}" WHERE "chat_id" = $1 {bound} ORDER BY "id" DESC LIMIT {page_size}'
+    ),
+    'cursor_page': (
+        'SELECT * FROM "{table}" WHERE "chat_id" = $1 {bound} {cursor_bound} AND "id" < $3 '
+        'ORDER BY "id" DESC LIMIT {page_size}'
+    ),
+    'replay': (
+        'SELECT * FROM "{table}" WHERE "chat_id" = $1 {bound} {cursor_bound} AND "id" > $3 ORDER BY "id" LIMIT 100'
+    ),
+    'count': 'SELECT count(*) FROM "{table}" WHERE "chat_id" = $1 {bound}',
+}
+
+
+async def seed(messages: int, rooms: int, years: float, now: datetime) -> datetime:
+    """Returns the time the seeded history starts at."""
+    connection = Tortoise.get_connection('default')
+    span = timedelta(days=365 * years)
+    started_at = now - span
+
+    await connection.execute_script('DROP INDEX "idx_chatmessage_text_search"')
+    await maintain_partitions(started_at, months_ahead=0)
+    await maintain_partitions(now, months_ahead=1)
+    await connection.execute_query(SEED_USERS_QUERY, [rooms])
+    await connection.execute_query(SEED_ROOMS_QUERY, [rooms, started_at, span])
+    for start in range(1, messages + 1, SEED_BATCH_SIZE):
+        await connection.execute_query(
+            SEED_MESSAGES_QUERY,
+            [start, min(start + SEED_BATCH_SIZE, messages + 1) - 1, messages, rooms, started_at, span],
+        )
+    await connection.execute_script(f'SELECT setval(\'chatmessage_id_seq\', {messages})')
+
+    await connection.execute_script(f'''
+        CREATE TABLE "{PLAIN_TABLE}" (LIKE "chatmessage" INCLUDING DEFAULTS);
+        INSERT INTO "{PLAIN_TABLE}" SELECT * FROM "chatmessage";
+        ALTER TABLE "{PLAIN_TABLE}" ADD PRIMARY KEY ("id");
+        CREATE INDEX ON "{PLAIN_TABLE}" ("chat_id", "id");
+    ''')
+    await connection.execute_script('VACUUM ANALYZE')
+    return started_at
+
+
+async def time_query(query: str, values: list, repeat: int) -> Dict[str, float]:
+    connection = Tortoise.get_connection('default')
+    latencies: List[float] = []
+    started_at = time.perf_counter()
+    for __ in range(repeat):
+        query_started_at = time.perf_counter()
+        await connection.execute_query(query, values)
+        latencies.append(time.perf_counter() - query_started_at)
+    return summarize(latencies, time.perf_counter() - started_at)
+
+
+async def time_room(room: dict, repeat: int) -> Dict[str, Dict[str, dict]]:
+    connection = Tortoise.get_connection('default')
+    rows = await connection.execute_query_dict(
+        'SELECT min("id") AS "first_id", max("id") AS "last_id" FROM "chatmessage" WHERE "chat_id" = $1', [room['id']],
+    )
+    # a page from a message in the middle of the history and a replay of its last tenth
+    message = await get_room_message(room['id'], (rows[0]['first_id'] + rows[0]['last_id']) // 2)
+    replay_message = await get_room_message(
+        room['id'], rows[0]['last_id'] - (rows[0]['last_id'] - rows[0]['first_id']) // 10,
+    )
+    cursors = {
+        'cursor_page': [message['id'], message['created_at'] + MESSAGES_CLOCK_SKEW],
+        'replay': [replay_message['id'], replay_message['created_at'] - MESSAGES_CLOCK_SKEW],
+    }
+
+    # the plain table takes the bounds too, for the queries to have the same parameters
+    tables = {
+        'plain': (PLAIN_TABLE, 'AND $2::TIMESTAMPTZ IS NOT NULL', 'AND $4::TIMESTAMPTZ IS NOT NULL'),
+        'partitioned': ('chatmessage', 'AND "created_at" >= $2', 'AND "created_at" {operator} $4'),
+    }
+    results: Dict[str, Dict[str, dict]] = {}
+    for name, query in QUERIES.items():
+        results[name] = {}
+        for kind, (table, bound, cursor_bound) in tables.items():
+            values = [room['id'], room['created_at'] - MESSAGES_CLOCK_SKEW, *cursors.get(name, [])]
+            sql = query.format(
+                table=table, bound=bound, page_size=PAGE_SIZE,
+                cursor_bound=cursor_bound.format(operator='<=' if name == 'cursor_page' else '>='),
+            )
+            results[name][kind] = await time_query(sql, values, repeat)
+
+    results['delete'] = {
+        'plain': await time_query(
+            f'UPDATE "{PLAIN_TABLE}" SET "text" = \'\', "is_deleted" = true WHERE "id" = $1', [message['id']], repeat,
+        ),
+        'partitioned': await time_query(
+            'UPDATE "chatmessage" SET "text" = \'\', "is_deleted" = true WHERE "id" = $1 AND "created_at" = $2',
+            [message['id'], message['created_at']], repeat,
+        ),
+    }
+    return results
+
+
+async def get_room_message(room_id: str, message_id: int) -> dict:
+    """The first message of the room from `message_id` on."""
+    rows = await Tortoise.get_connection('default').execute_query_dict(
+        'SELECT "id", "created_at" FROM "chatmessage" WHERE "chat_id" = $1 AND "id" >= $2 ORDER BY "id" LIMIT 1',
+        [room_id, message_id],
+    )
+    return rows[0]
+
+
+async def time_vacuum(now: datetime, share: float) -> Dict[str, dict]:
+    connection = Tortoise.get_connection('default')
+    month_start = get_month_start(now)
+    results = {}
+    for name, table in (('plain', PLAIN_TABLE), ('partitioned', get_partition_name(month_start))):
+        await connection.execute_query(
+            f'UPDATE "{table}" SET "text" = \'\', "is_deleted" = true '
+            f'WHERE "created_at" >= $1 AND "id" % {round(1 / share)} = 0',
+            [month_start],
+        )
+        started_at = time.perf_counter()
+        await connection.execute_script(f'VACUUM "{table}"')
+        size = await connection.execute_query_dict(
+            'SELECT pg_total_relation_size($1::REGCLASS) AS "size"', [f'"{table}"'],
+        )
+        results[name] = {
+            'table': table,
+            'vacuum_s': round(time.perf_counter() - started_at, 3),
+            'size_mb': round(size[0]['size'] / 2 ** 20, 1),
+        }
+    return results
+
+
+async def run(args: argparse.Namespace) -> dict:
+    results = {'revision': get_revision(), 'config': vars(args), 'results': {}}
+    await create_database(get_database_url('_PARTITIONS'))
+    try:
+        now = datetime.now(timezone.utc)
+        await seed(args.messages, args.rooms, args.years, now)
+        results['partitions'] = len(await get_partitions())
+
+        rooms = await Tortoise.get_connection('default').execute_query_dict(
+            'SELECT "id", "created_at" FROM "chat" ORDER BY "created_at"',
+        )
+        results['results']['oldest_room'] = await time_room(rooms[0], args.repeat)
+        results['results']['newest_room'] = await time_room(rooms[-1], args.repeat)
+        results['results']['vacuum'] = await time_vacuum(now, args.vacuum_share)
+    finally:
+        await Tortoise._drop_databases()
+    return results
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=5000000, help="seeded messages")
+    parser.add_argument('--rooms', type=int, default=1000, help="seeded rooms, created over the first 90%% of the time")
+    parser.add_argument('--years', type=float, default=3, help="time the messages are seeded over")
+    parser.add_argument('--repeat', type=int, default=200, help="timed runs per query")
+    parser.add_argument(
+        '--vacuum-share', type=float, default=0.01,
+        help="share of the latest month's messages deleted before vacuuming",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    loop = asyncio.get_event_loop()
+    print(json.dumps(loop.run_until_complete(run(args)), indent=2, default=str))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""
+Benchmark of the chat message search, on a throwaway `<POSTGRES_DB>_SEARCH` database built from the migrations.
+
+The messages are made of words drawn from a vocabulary with a skewed distribution, so `word0` occurs in most of
+the messages and the last words in a few. Searches are timed for terms of different frequency, in a single room
+and across the rooms available to a user, with and without the GIN index.
+
+    $ python -m benchmarks.search --messages 2000000 > search.json
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import Dict, List, Optional
+
+from tortoise import Tortoise
+
+from benchmarks.load import get_revision
+from benchmarks.server import create_database, get_database_url
+from benchmarks.stats import summarize
+from chatrooms.apps.chats.models import Chat
+from chatrooms.apps.chats.search import search_chat_messages
+from chatrooms.apps.users.models import User
+
+
+SEED_BATCH_SIZE = 100000
+
+
+async def seed(messages: int, rooms: int, joined: int, vocabulary: int) -> User:
+    """Returns the user searching: the creator of the first room and a member of the next `joined` ones."""
+    await User.bulk_create([User(email=f'user{i}@bench.example.com', password='') for i in range(rooms)])
+    users = await User.all().order_by('id')
+    await Chat.bulk_create([Chat(title=f'room {i}', creator_id=user.id) for i, user in enumerate(users)])
+    chats = await Chat.all().order_by('title')
+
+    connection = Tortoise.get_connection('default')
+    await connection.execute_many(
+        'INSERT INTO "chat_user" ("chat_id", "user_id") VALUES ($1, $2)',
+        [[chat.id, users[0].id] for chat in chats[1:joined + 1]],
+    )
+    words = [f'word{i}' for i in range(vocabulary)]
+    for start in range(0, messages, SEED_BATCH_SIZE):
+        await connection.execute_query(
+            '''
+            INSERT INTO "chatmessage" ("text", "chat_id", "author_id", "created_at", "is_deleted")
+            SELECT (
+                SELECT string_agg(($1::text[])[1 + floor(power(random(), 3) * array_length($1::text[], 1))::int], ' ')
+                FROM generate_series(1, 5 + "i" % 10)
+            ), "chat"."id", "chat"."creator_id", now(), false
+            FROM generate_series($2::int, $3::int) AS "i"
+            JOIN "chat" ON "chat"."title" = 'room ' || ("i" % $4)
+            ''',
+            [words, start, min(start + SEED_BATCH_SIZE, messages) - 1, rooms],
+        )
+    await connection.execute_script('ANALYZE')
+    return users[0]
+
+
+async def time_searches(
+        user: User, chat: Optional[Chat], query: str, repeat: int, page_size: int, pages: int,
+) -> Dict[str, float]:
+    latencies: List[float] = []
+    started_at = time.perf_counter()
+    for __ in range(repeat):
+        after = None
+        for __ in range(pages):
+            query_started_at = time.perf_counter()
+            results = await search_chat_messages(query, user, chat and chat.id, after, limit=page_size)
+            latencies.append(time.perf_counter() - query_started_at)
+            if len(results) < page_size:
+                break
+            after = (results[-1].rank, results[-1].id)
+    return summarize(latencies, time.perf_counter() - started_at)
+
+
+async def count_matches(query: str) -> int:
+    rows = await Tortoise.get_connection('default').execute_query_dict(
+        'SELECT count(*) AS "count" FROM "chatmessage" '
+        'WHERE to_tsvector(\'simple\', "text") @@ plainto_tsquery(\'simple\', $1)',
+        [query],
+    )
+    return rows[0]['count']
+
+
+async def run(args: argparse.Namespace) -> dict:
+    results = {'revision': get_revision(), 'config': vars(args), 'results': {}}
+    await create_database(get_database_url('_SEARCH'))
+    try:
+        user = await seed(messages=args.messages, rooms=args.rooms, joined=args.joined, vocabulary=args.vocabulary)
+        chat = await Chat.get(creator=user)
+        queries = {
+            'common': 'word0',
+            'medium': f'word{args.vocabulary // 10}',
+            'rare': f'word{args.vocabulary - 1}',
+            'two_words': f'word1 word{args.vocabulary // 10}',
+        }
+        connection = Tortoise.get_connection('default')
+        for index in ('gin', 'none'):
+            if index == 'none':
+                await connection.execute_script('DROP INDEX "idx_chatmessage_text_search"')
+            index_results = results['results'][index] = {}
+            for name, query in queries.items():
+                index_results[name] = {
+                    'matches': await count_matches(query) if index == 'gin' else None,
+                    'room': await time_searches(user, chat, query, args.repeat, args.page_size, args.pages),
+                    'accessible': await time_searches(user, None, query, args.repeat, args.page_size, args.pages),
+                }
+    finally:
+        await Tortoise._drop_databases()
+    return results
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=2000000, help="seeded messages, spread evenly among rooms")
+    parser.add_argument('--rooms', type=int, default=100, help="seeded rooms")
+    parser.add_argument('--joined', type=int, default=10, help="rooms joined by the searching user")
+    parser.add_argument('--vocabulary', type=int, default=10000, help="distinct words of the messages")
+    parser.add_argument('--repeat', type=int, default=20, help="timed searches per query and scope")
+    parser.add_argument('--pages', type=int, default=3, help="result pages walked through per search")
+    parser.add_argument('--page-size', type=int, default=20)
+    args = parser.parse_args()
+    if args.joined >= args.rooms:
+        parser.error("--joined must be less than --rooms")
+    return args
+
+
+def main():
+    args = parse_args()
+    loop = asyncio.get_event_loop()
+    print(json.dumps(loop.run_until_complete(run(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Live application server for the benchmarks, running against a throwaway copy of the database
+with the configuration of `chatrooms.config.server`.
+
+The schema is built by applying the aerich migrations in order, so it matches production, indexes included.
+"""
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import AsyncIterator, Optional
+from unittest import mock
+
+from aerich.utils import get_version_content_from_file
+from pydantic import PostgresDsn, parse_obj_as
+from tortoise import Tortoise
+from tortoise.exceptions import OperationalError
+
+from chatrooms.apps.common.ratelimit import rate_limit_backend
+from chatrooms.config import settings
+from chatrooms.config.server import DrainingServer, get_config
+from main import app
+
+
+MIGRATIONS_PATH = Path(__file__).parents[1] / 'chatrooms' / 'migrations' / 'models'
+
+
+@dataclass
+class LiveServer:
+    host: str
+    port: int
+    _server: DrainingServer = field(init=False, repr=False)
+    _task: Optional[asyncio.Task] = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self._server = DrainingServer(config=get_config(app, host=self.host, port=self.port, log_level='error'))
+        self._task = None
+
+    async def start(self):
+        self._server.config.setup_event_loop()
+        self._task = asyncio.create_task(self._server.serve())
+        await self.wait_connection()
+
+    async def stop(self):
+        self._server.should_exit = True
+        await self._task
+
+    async def wait_connection(self):
+        while not self._server.started:
+            await asyncio.sleep(0.1)
+
+    @property
+    def base_url(self) -> str:
+        return f'http://{self.host}:{self.port}{settings.API_BASE_URL}'
+
+    @property
+    def ws_url(self) -> str:
+        return f'ws://{self.host}:{self.port}{settings.API_BASE_URL}'
+
+
+def get_database_url(suffix: str) -> str:
+    base_url = parse_obj_as(PostgresDsn, settings.DATABASE_URI)
+    return PostgresDsn.build(
+        scheme=base_url.scheme,
+        host=base_url.host,
+        port=base_url.port,
+        path=f'{base_url.path}{suffix}',
+        user=base_url.user,
+        password=base_url.password,
+    )
+
+
+async def create_database(db_url: str) -> None:
+    modules = {'models': settings.APPS_MODELS}
+    try:
+        await Tortoise.init(db_url=db_url, modules=modules, _create_db=True)
+    except OperationalError:
+        # left over by an interrupted run
+        await Tortoise.init(db_url=db_url, modules=modules)
+        await Tortoise._drop_databases()
+        await Tortoise.init(db_url=db_url, modules=modules, _create_db=True)
+
+    connection = Tortoise.get_connection('default')
+    for path in sorted(MIGRATIONS_PATH.glob('*.sql'), key=lambda path: int(path.name.split('_', 1)[0])):
+        for statement in get_version_content_from_file(path)['upgrade']:
+            await connection.execute_script(statement)
+
+
+@asynccontextmanager
+async def run_live_server(db_suffix: str, host: str, port: int) -> AsyncIterator[LiveServer]:
+    """
+    Creates the benchmark database and serves the app on it, dropping the database afterwards.
+    The rate limits are lifted, as the load comes from a few clients on the same host.
+    """
+    await create_database(get_database_url(db_suffix))
+    try:
+        # the app would connect to the configured database on startup otherwise
+        with mock.patch('tortoise.Tortoise.init'), mock.patch('tortoise.Tortoise.close_connections'), \
+                mock.patch.object(rate_limit_backend, 'hit', mock.AsyncMock(return_value=0)), \
+                mock.patch.object(settings, 'WS_MESSAGES_RATE_LIMIT_RATE', 0):
+            server = LiveServer(host=host, port=port)
+            await server.start()
+            try:
+                yield server
+            finally:
+                await server.stop()
+    finally:
+        await Tortoise._drop_databases()
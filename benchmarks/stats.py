@@ -0,0 +1,24 @@
+import math
+from typing import Dict, List
+
+
+def percentile(sorted_values: List[float], percent: float) -> float:
+    """Nearest-rank percentile of already sorted values."""
+    if not sorted_values:
+        return math.nan
+    rank = max(math.ceil(percent / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def summarize(latencies: List[float], duration: float) -> Dict[str, float]:
+    """Throughput and latency percentiles (in milliseconds) of operations timed in seconds."""
+    values = sorted(latencies)
+    return {
+        'count': len(values),
+        'duration_s': round(duration, 3),
+        'throughput_per_s': round(len(values) / duration, 1) if duration else math.nan,
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p95_ms': round(percentile(values, 95) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+        'max_ms': round(values[-1] * 1000, 3) if values else math.nan,
+    }
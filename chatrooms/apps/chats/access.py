@@ -0,0 +1,59 @@
+from typing import Optional
+from uuid import UUID
+
+from chatrooms.apps.common.broadcast import BroadcastBackend, broadcast
+from chatrooms.apps.common.cache import TTLCache
+from chatrooms.config import settings
+
+
+class ChatAccessCache:
+    """
+    Short-lived cache of whether a user may access a chat.
+    Invalidation is published through the broadcast backend, so it reaches every worker.
+    """
+    CHANNEL = 'chat_access'
+
+    _cache: TTLCache
+    _broadcast: BroadcastBackend
+
+    def __init__(self, broadcast_backend: BroadcastBackend, max_size: int, ttl: float):
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+        self._broadcast = broadcast_backend
+        self._broadcast.subscribe(self.CHANNEL, self._on_broadcast)
+
+    def get(self, chat_id: UUID, user_id: int) -> Optional[bool]:
+        return self._cache.get((chat_id, user_id))
+
+    def set(self, chat_id: UUID, user_id: int, is_accessible: bool) -> None:
+        self._cache.set((chat_id, user_id), is_accessible)
+
+    async def invalidate_chat(self, chat_id: UUID) -> None:
+        self._invalidate(chat_id)
+        await self._broadcast.publish(self.CHANNEL, f'{chat_id}:')
+
+    async def invalidate_user(self, chat_id: UUID, user_id: int) -> None:
+        self._invalidate(chat_id, user_id)
+        await self._broadcast.publish(self.CHANNEL, f'{chat_id}:{user_id}')
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def _invalidate(self, chat_id: UUID, user_id: Optional[int] = None) -> None:
+        if user_id is not None:
+            self._cache.delete((chat_id, user_id))
+            return
+
+        for key, __ in self._cache.items():
+            if key[0] == chat_id:
+                self._cache.delete(key)
+
+    async def _on_broadcast(self, message: str) -> None:
+        chat_id, user_id = message.split(':')
+        self._invalidate(UUID(chat_id), int(user_id) if user_id else None)
+
+
+chat_access_cache = ChatAccessCache(
+    broadcast,
+    max_size=settings.CHAT_ACCESS_CACHE_SIZE,
+    ttl=settings.CHAT_ACCESS_CACHE_TTL,
+)
@@ -1,14 +1,30 @@
-from typing import Optional
+from typing import List, Optional, Union
 from uuid import UUID
 
-from fastapi import APIRouter, Depends, HTTPException, WebSocket, status, Request
+from fastapi import APIRouter, Depends, HTTPException, Query, WebSocket, status, Request
+from fastapi.responses import StreamingResponse
 from tortoise.exceptions import DoesNotExist
 
 from chatrooms.apps.chats import services as chat_services
-from chatrooms.apps.chats.pagination import ChatPagination, ChatOwnPagination, ChatMessagePagination
-from chatrooms.apps.chats.schemas import ChatCreate, ChatDetail
+from chatrooms.apps.chats.export import EXPORT_FORMATS, EXPORTERS
+from chatrooms.apps.chats.frames import negotiate_encoding
+from chatrooms.apps.chats.pagination import (
+    ChatPagination,
+    ChatCursorPagination,
+    ChatOwnPagination,
+    ChatOwnCursorPagination,
+    ChatMessagePagination,
+    ChatMessageCursorPagination,
+    ChatMessageSearchPagination,
+)
+from chatrooms.apps.chats.read_markers import chat_read_markers
+from chatrooms.apps.chats.schemas import ChatCreate, ChatDetail, ChatMembersChange, ChatMembersResult, ChatUnread
 from chatrooms.apps.chats.models import Chat, ChatMessage
-from chatrooms.apps.chats.websockets import get_ws_user
+from chatrooms.apps.chats.recent_messages import LatestMessages, recent_messages
+from chatrooms.apps.chats.search import paginate_search
+from chatrooms.apps.chats.websockets import chats_connections, get_ws_user
+from chatrooms.apps.common.db import get_read_connection
+from chatrooms.apps.common.responses import EncodedPageResponse
 from chatrooms.apps.common.schemas import ResponseDetail
 from chatrooms.apps.users.authentication import get_current_user
 from chatrooms.apps.users.models import User
@@ -16,6 +32,11 @@ from chatrooms.apps.users.models import User
 
 chats_router = APIRouter()
 
+PAGINATION_QUERY = Query('page', regex='^(page|cursor)$', description="Use `cursor` for keyset pagination.")
+SEARCH_QUERY = Query(..., min_length=1, max_length=200, description="Words the messages must contain.")
+
+MESSAGES_PAGE_SIZE = 20
+
 
 @chats_router.post('/', status_code=status.HTTP_201_CREATED, response_model=ChatDetail)
 async def create_chat(chat_data: ChatCreate, user: User = Depends(get_current_user)):
@@ -34,10 +55,23 @@ async def delete_chat(chat_id: UUID, user: User = Depends(get_current_user)):
     return None
 
 
-@chats_router.get('/own', response_model=ChatOwnPagination)
-async def list_own_chats(request: Request, page: int = 1, user: User = Depends(get_current_user)):
+@chats_router.get('/own', response_model=Union[ChatOwnPagination, ChatOwnCursorPagination])
+async def list_own_chats(
+        request: Request,
+        page: int = 1,
+        pagination: str = PAGINATION_QUERY,
+        cursor: Optional[str] = None,
+        user: User = Depends(get_current_user),
+):
+    qs = Chat.filter(creator=user).using_db(get_read_connection(Chat, user.id))
+    if pagination == 'cursor' or cursor is not None:
+        return await ChatOwnCursorPagination.paginate_queryset(
+            qs=qs, ordering=('-created_at', '-id'),
+            page_size=20, cursor=cursor, request=request,
+        )
+
     return await ChatOwnPagination.paginate_queryset(
-        qs=Chat.filter(creator=user).order_by('-created_at'),
+        qs=qs.order_by('-created_at'),
         page_size=20, page=page, request=request,
     )
 
@@ -53,19 +87,67 @@ async def join_chat(chat_id: UUID, user: User = Depends(get_current_user)):
     return {'detail': "Joined"}
 
 
-@chats_router.get('/joined', response_model=ChatPagination)
-async def list_joined_chats(request: Request, page: int = 1, user: User = Depends(get_current_user)):
+@chats_router.delete('/{chat_id}/access', response_model=ResponseDetail)
+async def leave_chat(chat_id: UUID, user: User = Depends(get_current_user)):
+    try:
+        chat = await Chat.get(id=chat_id)
+    except DoesNotExist:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found.")
+
+    await chat_services.leave_chat(chat, user)
+    return {'detail': "Left"}
+
+
+@chats_router.post('/{chat_id}/members', response_model=ChatMembersResult)
+async def add_chat_members(chat_id: UUID, data: ChatMembersChange, user: User = Depends(get_current_user)):
+    try:
+        chat = await Chat.get(id=chat_id)
+    except DoesNotExist:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found.")
+
+    return await chat_services.add_chat_members(chat, user, data)
+
+
+@chats_router.post('/{chat_id}/members/remove', response_model=ChatMembersResult)
+async def remove_chat_members(chat_id: UUID, data: ChatMembersChange, user: User = Depends(get_current_user)):
+    try:
+        chat = await Chat.get(id=chat_id)
+    except DoesNotExist:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found.")
+
+    return await chat_services.remove_chat_members(chat, user, data)
+
+
+@chats_router.get('/joined', response_model=Union[ChatPagination, ChatCursorPagination])
+async def list_joined_chats(
+        request: Request,
+        page: int = 1,
+        pagination: str = PAGINATION_QUERY,
+        cursor: Optional[str] = None,
+        user: User = Depends(get_current_user),
+):
+    qs = Chat.filter(participants=user).using_db(get_read_connection(Chat, user.id)).select_related('creator')
+    if pagination == 'cursor' or cursor is not None:
+        return await ChatCursorPagination.paginate_queryset(
+            qs=qs, ordering=('title', 'id'),
+            page_size=20, cursor=cursor, request=request,
+        )
+
     return await ChatPagination.paginate_queryset(
-        qs=Chat.filter(participants=user).select_related('creator').order_by('title'),
+        qs=qs.order_by('title'),
         page_size=20, page=page, request=request,
     )
 
 
+@chats_router.get('/unread', response_model=List[ChatUnread])
+async def list_unread_counts(user: User = Depends(get_current_user)):
+    return await chat_read_markers.get_unread_counts(user.id)
+
+
 @chats_router.get('/{chat_id}', response_model=ChatDetail)
 async def retrieve_chat_details(chat_id: UUID, user: User = Depends(get_current_user)):
-    qs = Chat.available_to_user(user).select_related('creator')
     try:
-        chat = await qs.get(id=chat_id)
+        chat = await Chat.get_accessible(chat_id, user, 'creator', connection=get_read_connection(Chat, user.id))
     except DoesNotExist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found.")
 
@@ -73,42 +155,143 @@ async def retrieve_chat_details(chat_id: UUID, user: User = Depends(get_current_
 
 
 @chats_router.websocket('/ws/{chat_id}')
-async def send_chat_messages(websocket: WebSocket, chat_id: UUID, user: Optional[User] = Depends(get_ws_user)):
+async def send_chat_messages(
+        websocket: WebSocket,
+        chat_id: UUID,
+        since_id: Optional[int] = Query(
+            None, ge=0, description="Id of the last received message, to get the missed ones.",
+        ),
+        batch: bool = Query(
+            False, description="Accept frames with a JSON array of events, sent instead of single ones in busy chats.",
+        ),
+        user: Optional[User] = Depends(get_ws_user),
+):
     if not user:
         return
+    if chats_connections.is_draining:  # accepted, so that the client gets the close code rather than 403
+        await websocket.accept()
+        await websocket.close(code=status.WS_1012_SERVICE_RESTART)
+        return
 
     try:
-        chat = await Chat.available_to_user(user).get(id=chat_id)
+        chat = await Chat.get_accessible(chat_id, user)
     except DoesNotExist:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return
 
-    await websocket.accept()
-    await chat_services.handle_chat_connection(chat, user, websocket)
+    # events are JSON text frames, unless the client offers a subprotocol of another encoding, e.g. `msgpack`
+    subprotocol, encoding = negotiate_encoding(websocket.scope.get('subprotocols', []))
+    await websocket.accept(subprotocol=subprotocol)
+    await chat_services.handle_chat_connection(
+        chat, user, websocket, since_id=since_id, batch=batch, encoding=encoding,
+    )
 
 
-@chats_router.get('/{chat_id}/messages', response_model=ChatMessagePagination)
-async def list_chat_messages(request: Request, chat_id: UUID, page: int = 1, user: User = Depends(get_current_user)):
+@chats_router.get('/{chat_id}/messages', response_model=Union[ChatMessagePagination, ChatMessageCursorPagination])
+async def list_chat_messages(
+        request: Request,
+        chat_id: UUID,
+        page: int = 1,
+        pagination: str = PAGINATION_QUERY,
+        cursor: Optional[str] = None,
+        user: User = Depends(get_current_user),
+):
     try:
-        chat = await Chat.available_to_user(user).select_related('creator').get(id=chat_id)
+        chat = await Chat.get_accessible(chat_id, user, 'creator')
     except DoesNotExist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found.")
 
+    is_cursor_pagination = pagination == 'cursor' or cursor is not None
+    if cursor is None and page <= 1:
+        latest_messages = await recent_messages.get_latest(chat, limit=MESSAGES_PAGE_SIZE)
+        if latest_messages is not None:
+            return get_latest_messages_response(request, is_cursor_pagination, latest_messages)
+
+    qs = chat.get_messages().using_db(get_read_connection(ChatMessage, user.id)).select_related('author')
+    if is_cursor_pagination:
+        if cursor is not None:
+            (message_id,), is_reversed = ChatMessageCursorPagination.decode_cursor(cursor, ChatMessage, ('-id',))
+            qs = qs.filter(await chat.get_messages_bound(message_id, after=is_reversed))
+        return await ChatMessageCursorPagination.paginate_queryset(
+            qs=qs, ordering=('-id',),
+            page_size=MESSAGES_PAGE_SIZE, cursor=cursor, request=request,
+        )
+
     return await ChatMessagePagination.paginate_queryset(
-        qs=ChatMessage.filter(chat=chat).select_related('author').order_by('-id'),
-        page_size=20, page=page, request=request,
+        qs=qs.order_by('-id'),
+        page_size=MESSAGES_PAGE_SIZE, page=page, request=request,
+    )
+
+
+def get_latest_messages_response(
+        request: Request, is_cursor_pagination: bool, latest_messages: LatestMessages,
+) -> EncodedPageResponse:
+    # the same first page the paginators would return, from the already encoded messages
+    has_next = latest_messages.count > len(latest_messages.ids)
+    if is_cursor_pagination:
+        next_page = None
+        if has_next and latest_messages.ids:
+            next_page = ChatMessageCursorPagination.get_cursor_url(request, [latest_messages.ids[-1]], False)
+        page = {'next': next_page, 'previous': None}
+    else:
+        next_page = ChatMessagePagination.get_page_url(request, 2) if has_next else None
+        page = {'count': latest_messages.count, 'next': next_page, 'previous': None}
+    return EncodedPageResponse(page, latest_messages.payloads)
+
+
+@chats_router.get('/messages/search', response_model=ChatMessageSearchPagination)
+async def search_messages(
+        request: Request,
+        q: str = SEARCH_QUERY,
+        cursor: Optional[str] = None,
+        user: User = Depends(get_current_user),
+):
+    return await paginate_search(request, q, user, chat=None, cursor=cursor, page_size=MESSAGES_PAGE_SIZE)
+
+
+@chats_router.get('/{chat_id}/messages/search', response_model=ChatMessageSearchPagination)
+async def search_chat_messages(
+        request: Request,
+        chat_id: UUID,
+        q: str = SEARCH_QUERY,
+        cursor: Optional[str] = None,
+        user: User = Depends(get_current_user),
+):
+    try:
+        chat = await Chat.get_accessible(chat_id, user)
+    except DoesNotExist:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found.")
+
+    return await paginate_search(request, q, user, chat=chat, cursor=cursor, page_size=MESSAGES_PAGE_SIZE)
+
+
+@chats_router.get('/{chat_id}/export', response_class=StreamingResponse)
+async def export_chat_messages(
+        chat_id: UUID,
+        format: str = Query('ndjson', regex='^(ndjson|csv)$'),
+        user: User = Depends(get_current_user),
+):
+    try:
+        chat = await Chat.get_accessible(chat_id, user)
+    except DoesNotExist:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found.")
+
+    return StreamingResponse(
+        EXPORTERS[format](chat, get_read_connection(ChatMessage, user.id)),
+        media_type=EXPORT_FORMATS[format],
+        headers={'Content-Disposition': f'attachment; filename="chat-{chat.id}.{format}"'},
     )
 
 
 @chats_router.delete('/{chat_id}/messages/{message_id}', status_code=status.HTTP_204_NO_CONTENT)
 async def delete_chat_message(chat_id: UUID, message_id: int, user: User = Depends(get_current_user)):
     try:
-        chat = await Chat.available_to_user(user).select_related('creator').get(id=chat_id)
+        chat = await Chat.get_accessible(chat_id, user, 'creator')
     except DoesNotExist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found.")
 
     try:
-        message = await ChatMessage.get(chat=chat, id=message_id)
+        message = await chat.get_messages().get(id=message_id)
     except DoesNotExist:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat message not found.")
 
@@ -0,0 +1,78 @@
+import csv
+import io
+from typing import AsyncIterator, Dict, List
+
+from tortoise.backends.base.client import BaseDBAsyncClient
+
+from chatrooms.apps.chats.models import Chat
+from chatrooms.apps.common.encoders import json_dumps
+from chatrooms.config import settings
+
+
+CSV_HEADER = ('id', 'created_at', 'author_id', 'author_email', 'is_deleted', 'text')
+
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',  # the charset is added by the response
+}
+
+
+async def iter_chat_messages_batches(
+        chat: Chat, connection: BaseDBAsyncClient, batch_size: int = settings.CHAT_EXPORT_BATCH_SIZE,
+) -> AsyncIterator[List[Dict]]:
+    """
+    Messages of the chat, oldest first, as rows read in keyset batches on `(chat_id, id)`,
+    so only one batch is held in memory however long the chat is.
+    """
+    last_id = 0
+    while True:
+        qs = chat.get_messages().filter(id__gt=last_id).using_db(connection)
+        rows = await qs.order_by('id').limit(batch_size).values(
+            'id', 'text', 'created_at', 'is_deleted', 'author_id', author_email='author__email',
+        )
+        if not rows:
+            return
+        yield rows
+        if len(rows) < batch_size:
+            return
+        last_id = rows[-1]['id']
+
+
+async def export_ndjson(chat: Chat, connection: BaseDBAsyncClient) -> AsyncIterator[bytes]:
+    """One `ChatMessageDetail` JSON object per line."""
+    async for rows in iter_chat_messages_batches(chat, connection):
+        yield b''.join(
+            json_dumps({
+                'id': row['id'],
+                'text': row['text'],
+                'created_at': row['created_at'],
+                'is_deleted': row['is_deleted'],
+                'author': {'id': row['author_id'], 'email': row['author_email']},
+            }) + b'\n'
+            for row in rows
+        )
+
+
+async def export_csv(chat: Chat, connection: BaseDBAsyncClient) -> AsyncIterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(CSV_HEADER)
+    async for rows in iter_chat_messages_batches(chat, connection):
+        writer.writerows(
+            (
+                row['id'], row['created_at'].isoformat(), row['author_id'], row['author_email'],
+                row['is_deleted'], row['text'],
+            )
+            for row in rows
+        )
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():  # the chat has no messages, just the header
+        yield buffer.getvalue().encode('utf-8')
+
+
+EXPORTERS = {
+    'ndjson': export_ndjson,
+    'csv': export_csv,
+}
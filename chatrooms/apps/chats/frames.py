@@ -0,0 +1,76 @@
+"""
+Wire formats of the chat websocket events, negotiated as websocket subprotocols.
+
+Events are built and broadcast as JSON text, which is also what the clients get by default;
+the other encodings convert them once per message and worker, not per recipient. The actions
+the clients send in binary frames are decoded the same way.
+"""
+from abc import ABC, abstractmethod
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from chatrooms.apps.common.encoders import json_loads
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+class Frame(NamedTuple):
+    """A websocket frame encoded from one or more JSON events, the latter being a batch sent as an array."""
+    messages: List[str]
+    data: Union[str, bytes]
+
+
+class EventEncoding(ABC):
+    subprotocol: Optional[str] = None
+    binary: bool = False
+
+    @abstractmethod
+    def encode(self, messages: List[str]) -> Union[str, Frame]:
+        pass
+
+    @abstractmethod
+    def decode(self, data: bytes) -> Any:
+        """Raises `ValueError` if the data isn't valid in the encoding."""
+
+
+class JsonEncoding(EventEncoding):
+    subprotocol = 'json'
+
+    def encode(self, messages: List[str]) -> Union[str, Frame]:
+        if len(messages) == 1:
+            return messages[0]
+        return Frame(messages, f'[{",".join(messages)}]')
+
+    def decode(self, data: bytes) -> Any:
+        return json_loads(data)
+
+
+class MessagePackEncoding(EventEncoding):
+    subprotocol = 'msgpack'
+    binary = True
+
+    def encode(self, messages: List[str]) -> Union[str, Frame]:
+        if len(messages) == 1:
+            return Frame(messages, msgpack.packb(json_loads(messages[0])))
+        return Frame(messages, msgpack.packb([json_loads(message) for message in messages]))
+
+    def decode(self, data: bytes) -> Any:
+        return msgpack.unpackb(data)
+
+
+JSON_ENCODING = JsonEncoding()
+
+EVENT_ENCODINGS: Dict[str, EventEncoding] = {JSON_ENCODING.subprotocol: JSON_ENCODING}
+if msgpack is not None:
+    EVENT_ENCODINGS[MessagePackEncoding.subprotocol] = MessagePackEncoding()
+
+
+def negotiate_encoding(subprotocols: Sequence[str]) -> Tuple[Optional[str], EventEncoding]:
+    """The first of the subprotocols offered by the client that is supported, JSON without any subprotocol if none."""
+    for subprotocol in subprotocols:
+        encoding = EVENT_ENCODINGS.get(subprotocol)
+        if encoding is not None:
+            return subprotocol, encoding
+    return None, JSON_ENCODING
@@ -1,5 +1,18 @@
+from datetime import timedelta
+from typing import Optional
+from uuid import UUID
+
 from tortoise import fields, models
-from tortoise.expressions import Q
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.exceptions import DoesNotExist
+from tortoise.expressions import Q, RawSQL
+from tortoise.queryset import QuerySet
+
+from chatrooms.apps.chats.access import chat_access_cache
+
+
+# messages are timestamped by the workers, whose clocks may be a bit off
+MESSAGES_CLOCK_SKEW = timedelta(hours=1)
 
 
 class Chat(models.Model):
@@ -10,15 +23,88 @@ class Chat(models.Model):
     creator = fields.ForeignKeyField('models.User', related_name='own_chats')
     participants = fields.ManyToManyField('models.User', related_name='joined_chats')
 
+    class Meta:
+        unique_together = (('creator', 'title'),)
+        indexes = (('creator', 'created_at'),)
+
     @classmethod
     def available_to_user(cls, user):
-        return cls.filter(Q(creator=user) | Q(participants=user))
+        user_id = int(user.id)
+        is_available = RawSQL(
+            f'("chat"."creator_id" = {user_id} OR EXISTS ('
+            f'SELECT 1 FROM "chat_user" WHERE "chat_user"."chat_id" = "chat"."id" AND "chat_user"."user_id" = {user_id}'
+            f'))'
+        )
+        return cls.annotate(is_available=is_available).filter(is_available=True)
+
+    @classmethod
+    async def get_accessible(
+            cls, chat_id: UUID, user, *related: str, connection: Optional[BaseDBAsyncClient] = None,
+    ) -> 'Chat':
+        """
+        The chat if the user may access it. Only a chat with the access cached already is fetched through
+        `connection`, the access itself is always checked on the primary. A denied access is cached too,
+        until the user joins the chat.
+        """
+        is_accessible = chat_access_cache.get(chat_id, user.id)
+        if is_accessible is False:
+            raise DoesNotExist("Object does not exist")
+        if is_accessible:
+            return await cls.get(id=chat_id).using_db(connection or cls._meta.db).select_related(*related)
+
+        try:
+            chat = await cls.available_to_user(user).select_related(*related).get(id=chat_id)
+        except DoesNotExist:
+            chat_access_cache.set(chat_id, user.id, False)
+            raise
+
+        chat_access_cache.set(chat_id, user.id, True)
+        return chat
+
+    def get_messages(self) -> QuerySet['ChatMessage']:
+        """
+        Messages of the chat, none of them older than the chat itself,
+        so the message partitions of the months before it are skipped.
+        """
+        return ChatMessage.filter(chat_id=self.id, created_at__gte=self.created_at - MESSAGES_CLOCK_SKEW)
+
+    async def get_messages_bound(self, message_id: int, after: bool) -> Q:
+        """
+        Filter of the messages after, or before, the message of the chat with `message_id` by their creation time:
+        the ids follow the order the messages are written in, so none of them is older, or newer, than it
+        but for the clock skew, and the partitions of the months before, or after, it are skipped.
+        Empty if the chat has no such message.
+        """
+        created_at = await self.get_messages().filter(id=message_id).first().values_list('created_at', flat=True)
+        if created_at is None:
+            return Q()
+        if after:
+            return Q(created_at__gte=created_at - MESSAGES_CLOCK_SKEW)
+        return Q(created_at__lte=created_at + MESSAGES_CLOCK_SKEW)
 
 
 class ChatMessage(models.Model):
+    # the table is partitioned by the month of `created_at`, with ("id", "created_at") as its primary key,
+    # see `chats.partitions`; updates should filter by both to touch a single partition
     text = fields.TextField()
     created_at = fields.DatetimeField(auto_now_add=True)
     is_deleted = fields.BooleanField(default=False)
 
     chat = fields.ForeignKeyField('models.Chat', related_name='messages')
     author = fields.ForeignKeyField('models.User', related_name='chat_messages')
+
+    class Meta:
+        indexes = (('chat', 'id'),)
+
+
+class ChatReadMarker(models.Model):
+    """The last message of the chat read by the user."""
+    # not a foreign key, messages are written behind and may be marked read before they are in the table
+    last_read_id = fields.IntField(default=0)
+    updated_at = fields.DatetimeField(auto_now=True)
+
+    chat = fields.ForeignKeyField('models.Chat', related_name='read_markers')
+    user = fields.ForeignKeyField('models.User', related_name='chat_read_markers')
+
+    class Meta:
+        unique_together = (('user', 'chat'),)
@@ -1,16 +1,33 @@
 from typing import List
 
-from chatrooms.apps.common.pagination import PageNumberPagination
-from chatrooms.apps.chats.schemas import ChatDetail, ChatOwn, ChatMessageDetail
+from chatrooms.apps.common.pagination import CursorPagination, PageNumberPagination
+from chatrooms.apps.chats.schemas import ChatDetail, ChatOwn, ChatMessageDetail, ChatMessageSearchResult
 
 
 class ChatPagination(PageNumberPagination):
     results: List[ChatDetail]
 
 
+class ChatCursorPagination(CursorPagination):
+    results: List[ChatDetail]
+
+
 class ChatOwnPagination(PageNumberPagination):
     results: List[ChatOwn]
 
 
+class ChatOwnCursorPagination(CursorPagination):
+    results: List[ChatOwn]
+
+
 class ChatMessagePagination(PageNumberPagination):
     results: List[ChatMessageDetail]
+
+
+class ChatMessageCursorPagination(CursorPagination):
+    results: List[ChatMessageDetail]
+
+
+class ChatMessageSearchPagination(CursorPagination):
+    """Best matches first; the cursors only lead forward."""
+    results: List[ChatMessageSearchResult]
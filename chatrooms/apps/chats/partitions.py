@@ -0,0 +1,193 @@
+"""
+Monthly range partitions of the chat messages by `created_at`, kept up by running
+
+    $ python -m chatrooms.apps.chats.partitions
+
+daily, e.g. from cron. The partitioning migration leaves the messages written before it in `chatmessage_legacy`,
+as the default partition. The first run bounds that one to the messages before the next month and puts an empty
+default partition in its place. Every run creates the partitions of the following `--months-ahead` months, moving
+any of their messages out of the default partition, and drops the ones older than `--retention-months` if it's set.
+"""
+import argparse
+import asyncio
+from datetime import datetime, timedelta, timezone
+import logging
+from typing import Dict, List, NamedTuple, Optional
+
+from tortoise import Tortoise
+from tortoise.transactions import in_transaction
+
+from chatrooms.apps.chats.models import ChatMessage
+from chatrooms.config import settings
+from chatrooms.config.tortoise_conf import TORTOISE_ORM
+
+
+logger = logging.getLogger(__name__)
+
+PARENT_TABLE = 'chatmessage'  # the names are those of the partitioning migration
+LEGACY_PARTITION = f'{PARENT_TABLE}_legacy'
+DEFAULT_PARTITION = f'{PARENT_TABLE}_default'
+LEGACY_BOUND_CONSTRAINT = f'{LEGACY_PARTITION}_created_at_check'
+COLUMNS = '"id", "text", "created_at", "is_deleted", "author_id", "chat_id"'
+
+PARTITIONS_QUERY = (
+    'SELECT "partition"."relname" AS "name", "bound"."expr" = \'DEFAULT\' AS "is_default", '
+    'substring("bound"."expr" FROM $2)::TIMESTAMPTZ AS "start", '
+    'substring("bound"."expr" FROM $3)::TIMESTAMPTZ AS "end" '
+    'FROM "pg_inherits" '
+    'JOIN "pg_class" AS "partition" ON "partition"."oid" = "pg_inherits"."inhrelid" '
+    'CROSS JOIN LATERAL pg_get_expr("partition"."relpartbound", "partition"."oid") AS "bound"("expr") '
+    'WHERE "pg_inherits"."inhparent" = $1::REGCLASS'
+)
+START_BOUND_PATTERN = r"FROM \('([^']+)'\)"  # MINVALUE doesn't match
+END_BOUND_PATTERN = r"TO \('([^']+)'\)"
+
+
+class Partition(NamedTuple):
+    name: str
+    start: Optional[datetime]  # none for the default partition and the one from MINVALUE
+    end: Optional[datetime]
+    is_default: bool
+
+
+def get_month_start(moment: datetime) -> datetime:
+    return moment.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(month_start: datetime, months: int) -> datetime:
+    month = month_start.month - 1 + months
+    return month_start.replace(year=month_start.year + month // 12, month=month % 12 + 1)
+
+
+def get_partition_name(month_start: datetime) -> str:
+    return f'{PARENT_TABLE}_p{month_start:%Y_%m}'
+
+
+async def get_partitions() -> List[Partition]:
+    """Partitions of the messages table, ordered by their ranges, the default one last."""
+    rows = await ChatMessage._meta.db.execute_query_dict(
+        PARTITIONS_QUERY, [f'"{PARENT_TABLE}"', START_BOUND_PATTERN, END_BOUND_PATTERN],
+    )
+    partitions = [Partition(**row) for row in rows]
+    return sorted(partitions, key=lambda partition: (partition.is_default, partition.end is None, partition.end))
+
+
+async def is_partitioned() -> bool:
+    rows = await ChatMessage._meta.db.execute_query_dict(
+        'SELECT "relkind" = \'p\' AS "is_partitioned" FROM "pg_class" WHERE "oid" = $1::REGCLASS',
+        [f'"{PARENT_TABLE}"'],
+    )
+    return rows[0]['is_partitioned']
+
+
+async def bound_legacy_partition(bound: datetime) -> None:
+    """Turns the legacy partition from the default one into that of the messages before `bound`."""
+    connection = ChatMessage._meta.db
+    # validating the constraint doesn't block the writes, and lets attaching the partition skip scanning it again
+    await connection.execute_script(
+        f'ALTER TABLE "{LEGACY_PARTITION}" DROP CONSTRAINT IF EXISTS "{LEGACY_BOUND_CONSTRAINT}"',
+    )
+    await connection.execute_script(
+        f'ALTER TABLE "{LEGACY_PARTITION}" ADD CONSTRAINT "{LEGACY_BOUND_CONSTRAINT}" '
+        f'CHECK ("created_at" < \'{bound.isoformat()}\') NOT VALID',
+    )
+    await connection.execute_script(
+        f'ALTER TABLE "{LEGACY_PARTITION}" VALIDATE CONSTRAINT "{LEGACY_BOUND_CONSTRAINT}"',
+    )
+
+    async with in_transaction(ChatMessage._meta.default_connection) as transaction:
+        await transaction.execute_script(f'ALTER TABLE "{PARENT_TABLE}" DETACH PARTITION "{LEGACY_PARTITION}"')
+        await transaction.execute_script(
+            f'ALTER TABLE "{PARENT_TABLE}" ATTACH PARTITION "{LEGACY_PARTITION}" '
+            f'FOR VALUES FROM (MINVALUE) TO (\'{bound.isoformat()}\')',
+        )
+        await transaction.execute_script(
+            f'ALTER TABLE "{LEGACY_PARTITION}" DROP CONSTRAINT "{LEGACY_BOUND_CONSTRAINT}"',
+        )
+        await transaction.execute_script(f'CREATE TABLE "{DEFAULT_PARTITION}" PARTITION OF "{PARENT_TABLE}" DEFAULT')
+
+
+async def create_partition(start: datetime) -> str:
+    """Creates the partition of the month starting at `start`, moving its messages out of the default partition."""
+    name, end = get_partition_name(start), add_months(start, 1)
+    async with in_transaction(ChatMessage._meta.default_connection) as transaction:
+        await transaction.execute_script(f'CREATE TABLE "{name}" (LIKE "{PARENT_TABLE}" INCLUDING DEFAULTS)')
+        await transaction.execute_query(
+            f'WITH "moved" AS ('
+            f'DELETE FROM "{DEFAULT_PARTITION}" WHERE "created_at" >= $1 AND "created_at" < $2 RETURNING {COLUMNS}) '
+            f'INSERT INTO "{name}" ({COLUMNS}) SELECT {COLUMNS} FROM "moved"',
+            [start, end],
+        )
+        await transaction.execute_script(
+            f'ALTER TABLE "{PARENT_TABLE}" ATTACH PARTITION "{name}" '
+            f'FOR VALUES FROM (\'{start.isoformat()}\') TO (\'{end.isoformat()}\')',
+        )
+    return name
+
+
+async def drop_partition(name: str) -> None:
+    async with in_transaction(ChatMessage._meta.default_connection) as transaction:
+        await transaction.execute_script(f'ALTER TABLE "{PARENT_TABLE}" DETACH PARTITION "{name}"')
+        await transaction.execute_script(f'DROP TABLE "{name}"')
+
+
+async def maintain_partitions(now: datetime, months_ahead: int, retention_months: int = 0) -> Dict[str, List[str]]:
+    """
+    Creates the missing partitions up to `months_ahead` months after the current one and drops the ones
+    of the messages older than `retention_months` months, unless it's zero. Returns the changed partitions.
+    """
+    if not await is_partitioned():
+        raise RuntimeError(f"{PARENT_TABLE} is not partitioned, apply the migrations first")
+
+    changes: Dict[str, List[str]] = {'bounded': [], 'created': [], 'dropped': []}
+    partitions = await get_partitions()
+    if any(partition.name == LEGACY_PARTITION and partition.is_default for partition in partitions):
+        # at least a day ahead, so new messages don't reach the bound before the partitions after it exist
+        await bound_legacy_partition(add_months(get_month_start(now + timedelta(days=1)), 1))
+        changes['bounded'].append(LEGACY_PARTITION)
+        partitions = await get_partitions()
+
+    month_start = get_month_start(now)
+    start = max(partition.end for partition in partitions if partition.end is not None)
+    while start <= add_months(month_start, months_ahead):
+        changes['created'].append(await create_partition(start))
+        start = add_months(start, 1)
+
+    if retention_months > 0:
+        cutoff = add_months(month_start, -retention_months)
+        for partition in partitions:
+            if partition.end is not None and partition.end <= cutoff:
+                await drop_partition(partition.name)
+                changes['dropped'].append(partition.name)
+    return changes
+
+
+async def run(months_ahead: int, retention_months: int) -> None:
+    await Tortoise.init(config=TORTOISE_ORM)
+    try:
+        changes = await maintain_partitions(datetime.now(timezone.utc), months_ahead, retention_months)
+    finally:
+        await Tortoise.close_connections()
+    for change, names in changes.items():
+        for name in names:
+            logger.info("%s %s", change.capitalize(), name)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '--months-ahead', type=int, default=settings.CHAT_MESSAGE_PARTITIONS_AHEAD,
+        help="months after the current one to create the partitions of",
+    )
+    parser.add_argument(
+        '--retention-months', type=int, default=settings.CHAT_MESSAGE_RETENTION_MONTHS,
+        help="months before the current one to keep the messages of, zero keeps all of them",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(run(args.months_ahead, args.retention_months))
+
+
+if __name__ == '__main__':
+    main()
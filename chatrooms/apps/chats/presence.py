@@ -0,0 +1,208 @@
+import asyncio
+from collections import defaultdict
+from functools import partial
+import json
+import logging
+import time
+from typing import Callable, DefaultDict, Dict, Iterator, List, Optional, Set
+from uuid import UUID, uuid4
+
+from chatrooms.apps.chats.schemas import ChatPresenceDiff
+from chatrooms.apps.common.broadcast import BroadcastBackend
+from chatrooms.apps.common.encoders import json_dumps
+
+
+logger = logging.getLogger(__name__)
+
+DIFF_KINDS = ('online', 'offline', 'typing')
+SYNC_REQUEST = '{"sync":true}'
+
+
+class ChatPresence:
+    """
+    Online and typing users of the chats, shared between the workers through the broadcast backend
+    and never stored in the database.
+
+    Changes are coalesced per chat: every `interval` seconds each worker publishes a single diff of the users
+    who came online, went offline or typed there since its previous one, and every worker passes the diffs on
+    to its websockets of the chat. A user's typing is published at most once per `typing_debounce` seconds,
+    so clients should show it for about that long. Users of a worker that dies without shutting down
+    stay online for the other workers until they are restarted.
+
+    A worker only learns of the users online at the others from their diffs, so when a chat gets its first
+    local websocket, the worker requests a sync and the others republish all their users online there.
+    """
+    CHANNEL = 'presence'
+    CHUNK_SIZE = 500  # user ids per broadcast message, NOTIFY payloads are limited to 8000 bytes
+
+    interval: float
+    typing_debounce: float
+
+    _connections: DefaultDict[UUID, DefaultDict[int, int]]  # local websockets by chat and user
+    _published: DefaultDict[UUID, Set[int]]  # local users published as online, by chat
+    _typing: DefaultDict[UUID, Set[int]]  # to be published
+    _typing_published_at: DefaultDict[UUID, Dict[int, float]]
+    _changed: Set[UUID]
+    _sync: Set[UUID]  # chats to request the online users of from the other workers
+    _resync: Set[UUID]  # chats to republish all the local online users of
+    _online: DefaultDict[UUID, DefaultDict[int, Set[str]]]  # workers a user is online at, by chat
+
+    def __init__(
+            self,
+            broadcast_backend: BroadcastBackend,
+            send: Callable[[UUID, ChatPresenceDiff], None],
+            interval: float,
+            typing_debounce: float,
+    ):
+        self.interval = interval
+        self.typing_debounce = typing_debounce
+
+        self._worker_id = uuid4().hex
+        self._send = send
+        self._connections = defaultdict(partial(defaultdict, int))
+        self._published = defaultdict(set)
+        self._typing = defaultdict(set)
+        self._typing_published_at = defaultdict(dict)
+        self._changed = set()
+        self._sync = set()
+        self._resync = set()
+        self._online = defaultdict(partial(defaultdict, set))
+        self._has_changes = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._broadcast = broadcast_backend
+        self._broadcast.subscribe(self.CHANNEL, self._on_broadcast)
+
+    def connect(self, chat_id: UUID, user_id: int) -> None:
+        if chat_id not in self._connections:
+            self._sync.add(chat_id)
+        self._connections[chat_id][user_id] += 1
+        self._mark_changed(chat_id)
+
+    def disconnect(self, chat_id: UUID, user_id: int) -> None:
+        users_connections = self._connections[chat_id]
+        users_connections[user_id] -= 1
+        if users_connections[user_id] <= 0:
+            del users_connections[user_id]
+        if not users_connections:
+            del self._connections[chat_id]
+        self._mark_changed(chat_id)
+
+    def typing(self, chat_id: UUID, user_id: int) -> None:
+        now = time.monotonic()
+        published_at = self._typing_published_at[chat_id].get(user_id)
+        if published_at is not None and now - published_at < self.typing_debounce:
+            return
+        self._typing_published_at[chat_id][user_id] = now
+        self._typing[chat_id].add(user_id)
+        self._mark_changed(chat_id)
+
+    def get_online(self, chat_id: UUID) -> List[int]:
+        """Users online in the chat at any worker; the ones of this worker are included before being published."""
+        return sorted({*self._online.get(chat_id, ()), *self._connections.get(chat_id, ())})
+
+    async def flush(self) -> None:
+        changed, self._changed = self._changed, set()
+        sync, self._sync = self._sync, set()
+        resync, self._resync = self._resync, set()
+        self._has_changes.clear()
+        for chat_id in sync:
+            await self._broadcast.publish(self.CHANNEL, f'{self._worker_id}:{chat_id}:{SYNC_REQUEST}')
+
+        now = time.monotonic()
+        for chat_id in changed:
+            connected = set(self._connections.get(chat_id, ()))
+            published = self._published.pop(chat_id, set())
+            diff = {
+                'online': sorted(connected if chat_id in resync else connected - published),
+                'offline': sorted(published - connected),
+                'typing': sorted(self._typing.pop(chat_id, set()) & connected),
+            }
+            if connected:
+                self._published[chat_id] = connected
+            self._forget_typing(chat_id, now)
+            for chunk in self._chunk_diff(diff):
+                data = json_dumps(chunk).decode('utf-8')
+                await self._broadcast.publish(self.CHANNEL, f'{self._worker_id}:{chat_id}:{data}')
+
+    def clear(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        self._connections.clear()
+        self._published.clear()
+        self._typing.clear()
+        self._typing_published_at.clear()
+        self._changed.clear()
+        self._sync.clear()
+        self._resync.clear()
+        self._online.clear()
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def _mark_changed(self, chat_id: UUID) -> None:
+        self._changed.add(chat_id)
+        self._has_changes.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await self._has_changes.wait()
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to publish chat presence")
+
+    def _forget_typing(self, chat_id: UUID, now: float) -> None:
+        published_at = self._typing_published_at.get(chat_id, {})
+        for user_id in [user_id for user_id, at in published_at.items() if now - at >= self.typing_debounce]:
+            del published_at[user_id]
+        if not published_at:
+            self._typing_published_at.pop(chat_id, None)
+
+    def _chunk_diff(self, diff: Dict[str, List[int]]) -> Iterator[Dict[str, List[int]]]:
+        items = [(kind, user_id) for kind in DIFF_KINDS for user_id in diff[kind]]
+        for start in range(0, len(items), self.CHUNK_SIZE):
+            chunk: Dict[str, List[int]] = {}
+            for kind, user_id in items[start:start + self.CHUNK_SIZE]:
+                chunk.setdefault(kind, []).append(user_id)
+            yield chunk
+
+    async def _on_broadcast(self, message: str) -> None:
+        worker_id, chat_id, data = message.split(':', 2)
+        chat_id = UUID(chat_id)
+        diff = json.loads(data)
+        if diff.get('sync'):
+            if worker_id != self._worker_id and chat_id in self._connections:
+                self._resync.add(chat_id)
+                self._mark_changed(chat_id)
+            return
+
+        users_workers = self._online[chat_id]
+
+        online = []
+        for user_id in diff.get('online', ()):
+            if not users_workers[user_id]:
+                online.append(user_id)
+            users_workers[user_id].add(worker_id)
+        offline = []
+        for user_id in diff.get('offline', ()):
+            workers = users_workers.get(user_id)
+            if workers is None:
+                continue
+            workers.discard(worker_id)
+            if not workers:
+                del users_workers[user_id]
+                offline.append(user_id)
+        if not users_workers:
+            del self._online[chat_id]
+
+        typing = diff.get('typing', [])
+        if online or offline or typing:
+            self._send(chat_id, ChatPresenceDiff(online=online, offline=offline, typing=typing))
+
@@ -0,0 +1,182 @@
+import asyncio
+import logging
+from typing import Dict, List, Optional, Tuple
+from uuid import UUID
+
+from tortoise.exceptions import IntegrityError, OperationalError
+
+from chatrooms.apps.chats.models import MESSAGES_CLOCK_SKEW, ChatReadMarker
+from chatrooms.apps.common.db import get_read_connection
+from chatrooms.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+# the ids past the latest message of the chat are clamped to it, looked up in the partitions since the chat
+# was created; the markers of deleted chats are skipped
+UPSERT_READ_MARKERS_QUERY = (
+    'INSERT INTO "chatreadmarker" ("chat_id", "user_id", "last_read_id", "updated_at") '
+    'SELECT "marker"."chat_id", "marker"."user_id", LEAST("marker"."last_read_id", ('
+    'SELECT COALESCE(max("id"), 0) FROM "chatmessage" WHERE "chatmessage"."chat_id" = "marker"."chat_id" '
+    'AND "chatmessage"."created_at" >= "chat"."created_at" - $4::interval)), now() '
+    'FROM unnest($1::uuid[], $2::int[], $3::int[]) AS "marker"("chat_id", "user_id", "last_read_id") '
+    'JOIN "chat" ON "chat"."id" = "marker"."chat_id" '
+    'ON CONFLICT ("user_id", "chat_id") DO UPDATE '
+    'SET "last_read_id" = GREATEST("chatreadmarker"."last_read_id", EXCLUDED."last_read_id"), '
+    '"updated_at" = EXCLUDED."updated_at"'
+)
+
+# the chats of the user with the ids of their last read messages, the ones pending in memory included,
+# and the count of the messages after those, up to $2, each taken from the ("chat_id", "id") index
+# of the partitions since the chat was created
+UNREAD_COUNTS_QUERY = '''
+SELECT "chats"."chat_id",
+    GREATEST("marker"."last_read_id", "pending"."last_read_id", 0) AS "last_read_id",
+    "unread"."count" AS "unread_count"
+FROM (
+    SELECT "chat"."id", "chat"."created_at" FROM "chat_user"
+    JOIN "chat" ON "chat"."id" = "chat_user"."chat_id" WHERE "chat_user"."user_id" = $1
+    UNION
+    SELECT "id", "created_at" FROM "chat" WHERE "creator_id" = $1
+) AS "chats"("chat_id", "created_at")
+LEFT JOIN "chatreadmarker" AS "marker" ON "marker"."chat_id" = "chats"."chat_id" AND "marker"."user_id" = $1
+LEFT JOIN unnest($3::uuid[], $4::int[]) AS "pending"("chat_id", "last_read_id")
+    ON "pending"."chat_id" = "chats"."chat_id"
+CROSS JOIN LATERAL (
+    SELECT count(*) AS "count" FROM (
+        SELECT 1 FROM "chatmessage"
+        WHERE "chatmessage"."chat_id" = "chats"."chat_id"
+        AND "chatmessage"."id" > GREATEST("marker"."last_read_id", "pending"."last_read_id", 0)
+        AND "chatmessage"."created_at" >= "chats"."created_at" - $5::interval
+        LIMIT $2
+    ) AS "capped"
+) AS "unread"
+ORDER BY "chats"."chat_id"
+'''
+
+
+class ChatReadMarkers:
+    """
+    Write-behind buffer of the chat read markers: the markers of a user in a chat are combined in memory,
+    keeping the highest message id, and upserted in bulk once `batch_size` of them are pending
+    or `flush_interval` seconds have passed, so reading through a chat doesn't take a write per message.
+    """
+    batch_size: int
+    flush_interval: float
+
+    _pending: Dict[int, Dict[UUID, int]]  # last read message ids by user and chat
+
+    def __init__(self, batch_size: int, flush_interval: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._pending = {}
+        self._pending_count = 0
+        self._flush_lock = asyncio.Lock()
+        self._has_pending = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    def mark(self, chat_id: UUID, user_id: int, message_id: int) -> None:
+        if not self._merge(chat_id, user_id, message_id):
+            return
+        if self._pending_count >= self.batch_size:
+            self._batch_full.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def get_pending(self, user_id: int) -> Dict[UUID, int]:
+        return dict(self._pending.get(user_id, {}))
+
+    async def get_unread_counts(self, user_id: int) -> List[dict]:
+        """Unread messages of the chats the user created or joined, counted up to `CHAT_UNREAD_COUNT_LIMIT`."""
+        pending = self.get_pending(user_id)
+        return await get_read_connection(ChatReadMarker, user_id).execute_query_dict(
+            UNREAD_COUNTS_QUERY,
+            [
+                user_id, settings.CHAT_UNREAD_COUNT_LIMIT, list(pending.keys()), list(pending.values()),
+                MESSAGES_CLOCK_SKEW,
+            ],
+        )
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            pending, self._pending, self._pending_count = self._pending, {}, 0
+            self._has_pending.clear()
+            self._batch_full.clear()
+
+            markers = [
+                (chat_id, user_id, last_read_id)
+                for user_id, user_markers in pending.items()
+                for chat_id, last_read_id in user_markers.items()
+            ]
+            for start in range(0, len(markers), self.batch_size):
+                try:
+                    await self._write(markers[start:start + self.batch_size])
+                except BaseException:  # cancelled too, so the markers are written by the next flush
+                    for chat_id, user_id, last_read_id in markers[start:]:
+                        self._merge(chat_id, user_id, last_read_id)
+                    raise
+
+    def clear(self) -> None:
+        """Forgets the pending markers, e.g. when the database is recreated."""
+        self._pending.clear()
+        self._pending_count = 0
+
+    async def close(self) -> None:
+        """Stops the background writes and writes the pending markers, after the write in progress if any."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def _merge(self, chat_id: UUID, user_id: int, message_id: int) -> bool:
+        """Keeps the marker pending unless a higher one is, returns whether it was kept."""
+        user_markers = self._pending.setdefault(user_id, {})
+        last_read_id = user_markers.get(chat_id)
+        if last_read_id is None:
+            self._pending_count += 1
+        elif last_read_id >= message_id:
+            return False
+        user_markers[chat_id] = message_id
+        self._has_pending.set()
+        return True
+
+    @classmethod
+    async def _write(cls, markers: List[Tuple[UUID, int, int]]) -> None:
+        """
+        Upserts the markers, dropping the ones that can't be written, e.g. of a deleted user,
+        so that they don't fail the rest of the batch over and over.
+        """
+        chat_ids, user_ids, last_read_ids = map(list, zip(*markers))
+        try:
+            await ChatReadMarker._meta.db.execute_query(
+                UPSERT_READ_MARKERS_QUERY, [chat_ids, user_ids, last_read_ids, MESSAGES_CLOCK_SKEW],
+            )
+        except (IntegrityError, OperationalError):
+            if len(markers) == 1:
+                logger.warning("Dropped chat read marker %s", markers[0], exc_info=True)
+                return
+            for marker in markers:
+                await cls._write([marker])
+
+    async def _run(self) -> None:
+        while True:
+            await self._has_pending.wait()
+            try:
+                await asyncio.wait_for(self._batch_full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            try:
+                # a write in progress is finished even if the task is cancelled, see `close`
+                await asyncio.shield(self.flush())
+            except Exception:
+                logger.exception("Failed to write chat read markers, retrying")
+                await asyncio.sleep(self.flush_interval)
+
+
+chat_read_markers = ChatReadMarkers(
+    batch_size=settings.CHAT_READ_MARKERS_BATCH_SIZE,
+    flush_interval=settings.CHAT_READ_MARKERS_FLUSH_INTERVAL,
+)
@@ -0,0 +1,243 @@
+import asyncio
+from bisect import bisect_left
+from collections import OrderedDict
+import json
+from typing import Dict, List, NamedTuple, Optional, Set
+from uuid import UUID
+
+from chatrooms.apps.chats.models import Chat
+from chatrooms.apps.chats.schemas import ChatMessageDetail
+from chatrooms.apps.common.broadcast import BroadcastBackend, broadcast
+from chatrooms.apps.common.encoders import json_dumps
+from chatrooms.apps.common.metrics import metrics
+from chatrooms.config import settings
+
+
+RECENT_MESSAGES_REQUESTS = metrics.counter(
+    'chat_recent_messages_requests_total', "Reads of the recent chat messages cache.", ('result',),
+)
+
+
+class LatestMessages(NamedTuple):
+    ids: List[int]
+    payloads: List[bytes]
+    count: int
+
+
+class RecentChatMessages:
+    """The newest messages of a chat, sorted by id, encoded as `ChatMessageDetail` JSON."""
+    __slots__ = ('ids', 'payloads', 'count', 'size', 'deleted_ids')
+
+    ids: List[int]
+    payloads: List[bytes]
+    count: Optional[int]  # of all messages of the chat, None until loaded from the database
+    size: int  # of the payloads, in bytes
+    deleted_ids: Set[int]  # deleted while not loaded yet
+
+    def __init__(self):
+        self.ids = []
+        self.payloads = []
+        self.count = None
+        self.size = 0
+        self.deleted_ids = set()
+
+    @property
+    def is_loaded(self) -> bool:
+        return self.count is not None
+
+    def insert(self, message_id: int, payload: bytes, max_length: int) -> bool:
+        """Keeps the message if it's among the newest `max_length` ones; returns False if it's there already."""
+        index = bisect_left(self.ids, message_id)
+        if index < len(self.ids) and self.ids[index] == message_id:
+            return False
+        if len(self.ids) >= max_length and index == 0:
+            return True
+
+        self.ids.insert(index, message_id)
+        self.payloads.insert(index, payload)
+        self.size += len(payload)
+        if len(self.ids) > max_length:
+            del self.ids[0]
+            self.size -= len(self.payloads.pop(0))
+        return True
+
+    def replace(self, message_id: int, payload: bytes) -> bool:
+        index = bisect_left(self.ids, message_id)
+        if index == len(self.ids) or self.ids[index] != message_id:
+            return False
+        self.size += len(payload) - len(self.payloads[index])
+        self.payloads[index] = payload
+        return True
+
+
+class RecentMessagesCache:
+    """
+    Per process cache of the last `size` messages of the chats, so the first page of messages is served
+    without querying the database. Chats are loaded on the first read and kept up to date by the messages
+    published through the broadcast backend; the least recently used chats are evicted once the payloads
+    take more than `max_bytes`.
+    """
+    CHANNEL = 'chat_recent_messages'
+    ADD_ACTION = 'add'
+    DELETE_ACTION = 'delete'
+    DISCARD_ACTION = 'discard'
+
+    size: int
+    max_bytes: int
+
+    _chats: 'OrderedDict[UUID, RecentChatMessages]'
+    _loading: Dict[UUID, asyncio.Future]
+    _broadcast: BroadcastBackend
+
+    def __init__(self, broadcast_backend: BroadcastBackend, size: int, max_bytes: int):
+        self.size = size
+        self.max_bytes = max_bytes
+        self._chats = OrderedDict()
+        self._loading = {}
+        self._total_size = 0
+        self._broadcast = broadcast_backend
+        self._broadcast.subscribe(self.CHANNEL, self._on_broadcast)
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    async def get_latest(self, chat: Chat, limit: int) -> Optional[LatestMessages]:
+        """Newest `limit` messages of the chat, newest first, and the count of all its messages."""
+        if not self.enabled or limit > self.size:
+            return None
+
+        chat_messages = self._chats.get(chat.id)
+        if chat_messages is not None and chat_messages.is_loaded:
+            RECENT_MESSAGES_REQUESTS.labels('hit').inc()
+            self._chats.move_to_end(chat.id)
+        else:
+            RECENT_MESSAGES_REQUESTS.labels('miss').inc()
+            chat_messages = await self._load(chat)
+        return LatestMessages(
+            ids=chat_messages.ids[:-limit - 1:-1],
+            payloads=chat_messages.payloads[:-limit - 1:-1],
+            count=chat_messages.count,
+        )
+
+    async def add(self, chat_id: UUID, message: ChatMessageDetail) -> None:
+        if self.enabled:
+            await self._publish(self.ADD_ACTION, chat_id, f'{message.id}:{json_dumps(message.dict()).decode()}')
+
+    async def delete(self, chat_id: UUID, message_id: int) -> None:
+        if self.enabled:
+            await self._publish(self.DELETE_ACTION, chat_id, str(message_id))
+
+    async def discard_chat(self, chat_id: UUID) -> None:
+        if self.enabled:
+            await self._publish(self.DISCARD_ACTION, chat_id, '')
+
+    def clear(self) -> None:
+        self._chats.clear()
+        self._loading.clear()
+        self._total_size = 0
+
+    async def _publish(self, action: str, chat_id: UUID, data: str) -> None:
+        await self._broadcast.publish(self.CHANNEL, f'{action}:{chat_id}:{data}')
+
+    async def _on_broadcast(self, message: str) -> None:
+        action, chat_id, data = message.split(':', 2)
+        chat_id = UUID(chat_id)
+        if action == self.ADD_ACTION:
+            message_id, payload = data.split(':', 1)
+            self._add_local(chat_id, int(message_id), payload.encode())
+        elif action == self.DELETE_ACTION:
+            self._delete_local(chat_id, int(data))
+        elif action == self.DISCARD_ACTION:
+            self._discard_local(chat_id)
+
+    def _add_local(self, chat_id: UUID, message_id: int, payload: bytes) -> None:
+        # messages of chats that are not loaded yet are kept too, they might not be in the database yet
+        chat_messages = self._get_or_create(chat_id)
+        size = chat_messages.size
+        if chat_messages.insert(message_id, payload, self.size) and chat_messages.is_loaded:
+            chat_messages.count += 1
+        self._resize(chat_messages, size)
+
+    def _delete_local(self, chat_id: UUID, message_id: int) -> None:
+        chat_messages = self._chats.get(chat_id)
+        if chat_messages is None:
+            return
+
+        size = chat_messages.size
+        if not chat_messages.is_loaded:
+            chat_messages.deleted_ids.add(message_id)
+        index = bisect_left(chat_messages.ids, message_id)
+        if index < len(chat_messages.ids) and chat_messages.ids[index] == message_id:
+            chat_messages.replace(message_id, self._get_deleted_payload(chat_messages.payloads[index]))
+        self._resize(chat_messages, size)
+
+    def _discard_local(self, chat_id: UUID) -> None:
+        chat_messages = self._chats.pop(chat_id, None)
+        if chat_messages is not None:
+            self._total_size -= chat_messages.size
+
+    async def _load(self, chat: Chat) -> RecentChatMessages:
+        future = self._loading.get(chat.id)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(chat))
+            self._loading[chat.id] = future
+            future.add_done_callback(lambda __: self._loading.pop(chat.id, None))
+        return await asyncio.shield(future)
+
+    async def _fetch(self, chat: Chat) -> RecentChatMessages:
+        messages, count = await asyncio.gather(
+            chat.get_messages().select_related('author').order_by('-id').limit(self.size),
+            chat.get_messages().count(),
+        )
+
+        chat_messages = self._get_or_create(chat.id)
+        size = chat_messages.size
+        if chat_messages.is_loaded:  # loaded meanwhile, so it's up to date already
+            return chat_messages
+
+        # messages published while loading, or not written to the database yet, aren't counted
+        fetched_ids = {message.id for message in messages}
+        is_complete = len(messages) < self.size
+        min_fetched_id = min(fetched_ids, default=0)
+        count += sum(
+            1 for message_id in chat_messages.ids
+            if message_id not in fetched_ids and (is_complete or message_id > min_fetched_id)
+        )
+
+        for message in messages:
+            payload = json_dumps(ChatMessageDetail.from_orm(message).dict())
+            if message.id in chat_messages.deleted_ids:
+                payload = self._get_deleted_payload(payload)
+            chat_messages.insert(message.id, payload, self.size)
+        chat_messages.count = count
+        chat_messages.deleted_ids.clear()
+        self._resize(chat_messages, size)
+        return chat_messages
+
+    def _get_or_create(self, chat_id: UUID) -> RecentChatMessages:
+        chat_messages = self._chats.get(chat_id)
+        if chat_messages is None:
+            chat_messages = self._chats[chat_id] = RecentChatMessages()
+        else:
+            self._chats.move_to_end(chat_id)
+        return chat_messages
+
+    def _resize(self, chat_messages: RecentChatMessages, previous_size: int) -> None:
+        self._total_size += chat_messages.size - previous_size
+        while self._total_size > self.max_bytes and len(self._chats) > 1:
+            __, evicted = self._chats.popitem(last=False)
+            self._total_size -= evicted.size
+
+    @staticmethod
+    def _get_deleted_payload(payload: bytes) -> bytes:
+        message = json.loads(payload)
+        message.update(text='', is_deleted=True)
+        return json_dumps(message)
+
+
+recent_messages = RecentMessagesCache(
+    broadcast,
+    size=settings.CHAT_RECENT_MESSAGES_SIZE,
+    max_bytes=settings.CHAT_RECENT_MESSAGES_MAX_BYTES,
+)
@@ -1,6 +1,7 @@
 from datetime import datetime
+from typing import List, Optional
 from uuid import UUID
-from pydantic import BaseModel, EmailStr, constr
+from pydantic import BaseModel, EmailStr, conint, conlist, constr, root_validator
 
 
 class ChatCreate(BaseModel):
@@ -38,6 +39,37 @@ class ChatMessageCreate(BaseModel):
     text: constr(min_length=1, max_length=500, strip_whitespace=True)
 
 
+class ServerRestart(BaseModel):
+    reconnect_after: float  # seconds
+
+
+class ChatAction(BaseModel):
+    action: constr(regex='^(typing|presence|read)$')
+    message_id: Optional[conint(ge=0, le=2 ** 31 - 1)] = None  # the last one read
+
+    @root_validator(skip_on_failure=True)
+    def check_message_id(cls, values):
+        if values['action'] == 'read' and values['message_id'] is None:
+            raise ValueError("Provide the id of the last read message.")
+        return values
+
+
+class ChatPresenceDiff(BaseModel):
+    online: List[int]
+    offline: List[int]
+    typing: List[int]
+
+
+class ChatPresenceSnapshot(BaseModel):
+    online: List[int]
+
+
+class ChatUnread(BaseModel):
+    chat_id: UUID
+    last_read_id: int
+    unread_count: int
+
+
 class ChatMessageAuthor(BaseModel):
     id: int
     email: EmailStr
@@ -55,3 +87,29 @@ class ChatMessageDetail(BaseModel):
 
     class Config:
         orm_mode = True
+
+
+class ChatMessageSearchResult(ChatMessageDetail):
+    chat_id: UUID
+    rank: float
+
+
+class ChatMembersChange(BaseModel):
+    user_ids: conlist(int, max_items=10000) = []
+    emails: conlist(EmailStr, max_items=10000) = []
+
+    @root_validator(skip_on_failure=True)
+    def check_not_empty(cls, values):
+        if not values['user_ids'] and not values['emails']:
+            raise ValueError("Provide user ids or emails.")
+        return values
+
+
+class ChatMemberResult(BaseModel):
+    user_id: Optional[int] = None
+    email: Optional[str] = None
+    status: str
+
+
+class ChatMembersResult(BaseModel):
+    results: List[ChatMemberResult]
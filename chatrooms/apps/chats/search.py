@@ -0,0 +1,97 @@
+from typing import List, Optional, Tuple
+
+from fastapi import Request
+
+from chatrooms.apps.chats.models import MESSAGES_CLOCK_SKEW, Chat, ChatMessage
+from chatrooms.apps.chats.pagination import ChatMessageSearchPagination
+from chatrooms.apps.chats.schemas import ChatMessageSearchResult
+from chatrooms.apps.common.db import get_read_connection
+from chatrooms.apps.common.exceptions import BadInputError
+from chatrooms.apps.users.models import User
+
+
+# the expression must stay the same as the one of the "idx_chatmessage_text_search" index, for it to be used
+SEARCH_VECTOR = 'to_tsvector(\'simple\', "chatmessage"."text")'
+SEARCH_QUERY = 'plainto_tsquery(\'simple\', $1)'
+SEARCH_RANK = f'ts_rank({SEARCH_VECTOR}, {SEARCH_QUERY})'
+
+SEARCH_SQL = f'''
+SELECT
+    "chatmessage"."id", "chatmessage"."chat_id", "chatmessage"."text", "chatmessage"."created_at",
+    "chatmessage"."is_deleted", "chatmessage"."author_id", "user"."email" AS "author_email", {SEARCH_RANK} AS "rank"
+FROM "chatmessage"
+JOIN "user" ON "user"."id" = "chatmessage"."author_id"
+WHERE {SEARCH_VECTOR} @@ {SEARCH_QUERY} AND NOT "chatmessage"."is_deleted" AND {{conditions}}
+ORDER BY "rank" DESC, "chatmessage"."id" DESC
+LIMIT $2
+'''
+ACCESSIBLE_CHATS = (
+    'SELECT "id", "created_at" FROM "chat" WHERE "creator_id" = ${user_id} '
+    'UNION ALL SELECT "chat"."id", "chat"."created_at" FROM "chat_user" '
+    'JOIN "chat" ON "chat"."id" = "chat_user"."chat_id" WHERE "chat_user"."user_id" = ${user_id}'
+)
+# none of the messages is older than its chat, so the partitions before the oldest chat are skipped
+ACCESSIBLE_CHATS_CONDITIONS = (
+    f'"chatmessage"."chat_id" IN (SELECT "id" FROM ({ACCESSIBLE_CHATS}) AS "chats")',
+    f'"chatmessage"."created_at" >= '
+    f'(SELECT min("created_at") FROM ({ACCESSIBLE_CHATS}) AS "chats") - ${{skew}}::interval',
+)
+
+
+async def search_chat_messages(
+        query: str, user: User, chat: Optional[Chat], after: Optional[Tuple[float, int]], limit: int,
+) -> List[ChatMessageSearchResult]:
+    """
+    Messages matching the words of `query`, ordered by rank and then by id, both descending, and following
+    the `after` rank and id. Searches the chat (its access must be checked already) or every chat available to the user.
+    """
+    values = [query, limit]
+    if chat is not None:
+        values.extend((chat.id, chat.created_at - MESSAGES_CLOCK_SKEW))
+        conditions = [f'"chatmessage"."chat_id" = ${len(values) - 1}', f'"chatmessage"."created_at" >= ${len(values)}']
+    else:
+        values.extend((user.id, MESSAGES_CLOCK_SKEW))
+        conditions = [
+            condition.format(user_id=len(values) - 1, skew=len(values)) for condition in ACCESSIBLE_CHATS_CONDITIONS
+        ]
+    if after is not None:
+        values.extend(after)
+        conditions.append(f'({SEARCH_RANK}, "chatmessage"."id") < (${len(values) - 1}::real, ${len(values)})')
+
+    connection = get_read_connection(ChatMessage, user.id)
+    rows = await connection.execute_query_dict(SEARCH_SQL.format(conditions=' AND '.join(conditions)), values)
+    return [
+        ChatMessageSearchResult(
+            id=row['id'],
+            chat_id=row['chat_id'],
+            text=row['text'],
+            created_at=row['created_at'],
+            is_deleted=row['is_deleted'],
+            author={'id': row['author_id'], 'email': row['author_email']},
+            rank=row['rank'],
+        )
+        for row in rows
+    ]
+
+
+async def paginate_search(
+        request: Request, query: str, user: User, chat: Optional[Chat], cursor: Optional[str], page_size: int,
+) -> ChatMessageSearchPagination:
+    after = decode_search_cursor(cursor) if cursor else None
+    results = await search_chat_messages(query, user, chat, after, limit=page_size + 1)
+
+    next_page = None
+    if len(results) > page_size:
+        results = results[:page_size]
+        next_page = ChatMessageSearchPagination.get_cursor_url(request, [results[-1].rank, results[-1].id], False)
+    return ChatMessageSearchPagination(next=next_page, previous=None, results=results)
+
+
+def decode_search_cursor(cursor: str) -> Tuple[float, int]:
+    position, is_reversed = ChatMessageSearchPagination.decode_raw_cursor(cursor)
+    if (
+            is_reversed or len(position) != 2
+            or not isinstance(position[0], (int, float)) or not isinstance(position[1], int)
+    ):
+        raise BadInputError({'cursor': "Invalid cursor."})
+    return float(position[0]), position[1]
@@ -1,21 +1,62 @@
 import asyncio
+import time
+from typing import AsyncIterator, Callable, Dict, List, Optional, Set, Tuple, Union
 
 from fastapi import status, WebSocket
 from pydantic import ValidationError
+from pydantic.error_wrappers import ErrorWrapper
+from pydantic.utils import ROOT_KEY
+from tortoise.exceptions import IntegrityError
+from tortoise.expressions import Q
 
-from chatrooms.apps.chats.schemas import ChatCreate, ChatMessageCreate, ChatMessageDetail
-from chatrooms.apps.chats.models import Chat, ChatMessage
-from chatrooms.apps.chats.websockets import chats_connections, get_event_payload
+from chatrooms.apps.chats.access import chat_access_cache
+from chatrooms.apps.chats.frames import JSON_ENCODING, EventEncoding
+from chatrooms.apps.chats.schemas import (
+    ChatAction, ChatCreate, ChatMemberResult, ChatMembersChange, ChatMembersResult, ChatMessageCreate,
+    ChatMessageDetail, ChatPresenceSnapshot,
+)
+from chatrooms.apps.chats.models import MESSAGES_CLOCK_SKEW, Chat, ChatMessage
+from chatrooms.apps.chats.read_markers import chat_read_markers
+from chatrooms.apps.chats.recent_messages import recent_messages
+from chatrooms.apps.chats.sink import chat_messages_sink
+from chatrooms.apps.chats.websockets import ChatConnection, chats_connections, get_event_payload, get_new_message_id
+from chatrooms.apps.common.db import recent_writers
 from chatrooms.apps.common.exceptions import BadInputError, PermissionDeniedError
+from chatrooms.apps.common.metrics import metrics
+from chatrooms.apps.common.ratelimit import LocalRateLimit, check_rate_limit
+from chatrooms.apps.common.schemas import RateLimited
 from chatrooms.apps.users.models import User
+from chatrooms.config import settings
+
+
+CHAT_WEBSOCKET_SESSIONS = metrics.counter('chat_websocket_sessions_total', "Accepted chat websockets.")
+CHAT_MESSAGES_RECEIVED = metrics.counter(
+    'chat_messages_received_total', "Messages received over chat websockets.", ('result',),
+)
+CHAT_MESSAGE_HANDLING_SECONDS = metrics.histogram(
+    'chat_message_handling_duration_seconds', "Time from receiving a chat message to publishing it.",
+)
+
+CHAT_MEMBERS_BATCH_SIZE = 1000
+
+ADD_CHAT_MEMBERS_QUERY = (
+    'INSERT INTO "chat_user" ("chat_id", "user_id") '
+    'SELECT $1, "member"."id" FROM unnest($2::int[]) AS "member"("id") '
+    'WHERE NOT EXISTS (SELECT 1 FROM "chat_user" WHERE "chat_id" = $1 AND "user_id" = "member"."id") '
+    'ON CONFLICT DO NOTHING RETURNING "user_id"'
+)
+REMOVE_CHAT_MEMBERS_QUERY = (
+    'DELETE FROM "chat_user" WHERE "chat_id" = $1 AND "user_id" = ANY($2::int[]) RETURNING "user_id"'
+)
 
 
 async def create_chat(chat_data: ChatCreate, user: User) -> Chat:
-    is_title_taken = await Chat.filter(creator=user, title=chat_data.title).exists()
-    if is_title_taken:
+    try:
+        chat = await Chat.create(**chat_data.dict(), creator=user)
+    except IntegrityError:
         raise BadInputError({'title': "You already created chat with the title."})
 
-    chat = await Chat.create(**chat_data.dict(), creator=user)
+    await recent_writers.add(user.id)
     return chat
 
 
@@ -23,8 +64,12 @@ async def delete_chat(chat: Chat, user: User) -> None:
     if chat.creator_id != user.id:
         raise PermissionDeniedError("Can't delete not own chat")
 
+    chat_messages_sink.discard_chat(chat.id)
     await asyncio.gather(
         chat.delete(),
+        recent_writers.add(user.id),
+        chat_access_cache.invalidate_chat(chat.id),
+        recent_messages.discard_chat(chat.id),
         chats_connections.disconnect_chat(chat_id=chat.id, error_code=status.WS_1011_INTERNAL_ERROR),
     )
 
@@ -32,6 +77,92 @@ async def delete_chat(chat: Chat, user: User) -> None:
 async def join_chat(chat: Chat, user: User) -> None:
     if chat.creator_id != user.id:
         await chat.participants.add(user)
+        await asyncio.gather(
+            recent_writers.add(user.id),
+            chat_access_cache.invalidate_user(chat.id, user.id),
+        )
+
+
+async def leave_chat(chat: Chat, user: User) -> None:
+    if chat.creator_id != user.id:
+        await chat.participants.remove(user)
+        await asyncio.gather(
+            recent_writers.add(user.id),
+            chat_access_cache.invalidate_user(chat.id, user.id),
+            chats_connections.disconnect_chat_users(chat.id, [user.id], error_code=status.WS_1008_POLICY_VIOLATION),
+        )
+
+
+async def add_chat_members(chat: Chat, user: User, data: ChatMembersChange) -> ChatMembersResult:
+    if chat.creator_id != user.id:
+        raise PermissionDeniedError("Can't change members of not own chat")
+
+    found_ids, ids_by_email = await get_members(data)
+    candidate_ids = sorted(found_ids - {chat.creator_id})
+    joined_ids = await execute_in_batches(ADD_CHAT_MEMBERS_QUERY, chat, candidate_ids)
+    if joined_ids:
+        await asyncio.gather(recent_writers.add(user.id), chat_access_cache.invalidate_chat(chat.id))
+
+    def get_status(member_id: int) -> str:
+        if member_id == chat.creator_id:
+            return 'creator'
+        return 'joined' if member_id in joined_ids else 'already_joined'
+
+    return get_members_result(data, found_ids, ids_by_email, get_status)
+
+
+async def remove_chat_members(chat: Chat, user: User, data: ChatMembersChange) -> ChatMembersResult:
+    if chat.creator_id != user.id:
+        raise PermissionDeniedError("Can't change members of not own chat")
+
+    found_ids, ids_by_email = await get_members(data)
+    candidate_ids = sorted(found_ids - {chat.creator_id})
+    removed_ids = await execute_in_batches(REMOVE_CHAT_MEMBERS_QUERY, chat, candidate_ids)
+    if removed_ids:
+        await asyncio.gather(
+            recent_writers.add(user.id),
+            chat_access_cache.invalidate_chat(chat.id),
+            chats_connections.disconnect_chat_users(
+                chat.id, sorted(removed_ids), error_code=status.WS_1008_POLICY_VIOLATION,
+            ),
+        )
+
+    def get_status(member_id: int) -> str:
+        if member_id == chat.creator_id:
+            return 'creator'
+        return 'removed' if member_id in removed_ids else 'not_joined'
+
+    return get_members_result(data, found_ids, ids_by_email, get_status)
+
+
+async def get_members(data: ChatMembersChange) -> Tuple[Set[int], Dict[str, int]]:
+    """Resolves the requested users with one query, returns the found ids and the ids by email."""
+    users = await User.filter(Q(id__in=data.user_ids) | Q(email__in=data.emails)).values('id', 'email')
+    return {user['id'] for user in users}, {user['email']: user['id'] for user in users}
+
+
+async def execute_in_batches(query: str, chat: Chat, user_ids: List[int]) -> Set[int]:
+    """Runs the membership `query` for the users in batches of ids, returns the ids of the changed rows."""
+    changed_ids = set()
+    for start in range(0, len(user_ids), CHAT_MEMBERS_BATCH_SIZE):
+        rows = await Chat._meta.db.execute_query_dict(query, [chat.id, user_ids[start:start + CHAT_MEMBERS_BATCH_SIZE]])
+        changed_ids.update(row['user_id'] for row in rows)
+    return changed_ids
+
+
+def get_members_result(
+        data: ChatMembersChange, found_ids: Set[int], ids_by_email: Dict[str, int], get_status: Callable[[int], str],
+) -> ChatMembersResult:
+    results = [
+        ChatMemberResult(user_id=user_id, status=get_status(user_id) if user_id in found_ids else 'not_found')
+        for user_id in data.user_ids
+    ]
+    for email in data.emails:
+        user_id = ids_by_email.get(email)
+        results.append(
+            ChatMemberResult(user_id=user_id, email=email, status='not_found' if user_id is None else get_status(user_id)),
+        )
+    return ChatMembersResult(results=results)
 
 
 async def delete_chat_message(message: ChatMessage, user: User) -> None:
@@ -40,21 +171,144 @@ async def delete_chat_message(message: ChatMessage, user: User) -> None:
 
     message.text = ''
     message.is_deleted = True
-    await message.save()
+    await ChatMessage.filter(id=message.id, created_at=message.created_at).update(text='', is_deleted=True)
+    await asyncio.gather(
+        recent_writers.add(user.id),
+        recent_messages.delete(message.chat_id, message.id),
+    )
     return None
 
 
-async def handle_chat_connection(chat: Chat, user: User, websocket: WebSocket) -> None:
-    chats_connections.add_connection(chat.id, user.id, websocket)
-    async for text in websocket.iter_text():
-        try:
-            message_data = ChatMessageCreate(text=text)
-        except ValidationError as err:
-            await websocket.send_text(get_event_payload(event='validation_error', payload=err))
-        else:
-            chat_message = await ChatMessage.create(text=message_data.text, chat=chat, author=user)
-            chat_message_payload = ChatMessageDetail.from_orm(chat_message)
-            await chats_connections.send_chat_message(
-                chat_id=chat.id, message=get_event_payload(event='new_message', payload=chat_message_payload),
+async def replay_chat_messages(chat: Chat, connection: ChatConnection, since_id: int) -> Set[int]:
+    """
+    Sends the messages of the chat with ids greater than `since_id` to the held connection, oldest first,
+    reading them in batches. Returns the ids of the sent messages.
+
+    Messages are published once they are written, with the ids of a chat following the order they are
+    written in, so any message after `since_id` is either read here or published after the connection
+    was added, and held for it.
+    """
+    replayed_ids = set()
+    last_id = since_id
+    bound = await chat.get_messages_bound(since_id, after=True)
+    while not connection.is_closing:
+        qs = chat.get_messages().filter(bound, id__gt=last_id).select_related('author').order_by('id')
+        messages = await qs.limit(settings.WS_REPLAY_BATCH_SIZE)
+        for message in messages:
+            payload = ChatMessageDetail.from_orm(message)
+            await connection.send_now(get_event_payload(event='new_message', payload=payload))
+            replayed_ids.add(message.id)
+        if len(messages) < settings.WS_REPLAY_BATCH_SIZE:
+            break
+        last_id = messages[-1].id
+        bound = Q(created_at__gte=messages[-1].created_at - MESSAGES_CLOCK_SKEW)
+    return replayed_ids
+
+
+async def iter_frames(websocket: WebSocket) -> AsyncIterator[Union[str, bytes]]:
+    """
+    Data of the frames received until the client disconnects: text frames are chat messages and binary ones
+    actions, objects like `{"action": "typing"}` in the negotiated encoding, so that any text can be posted.
+    """
+    while True:
+        message = await websocket.receive()
+        if message['type'] == 'websocket.disconnect':
+            return
+        yield message['text'] if message.get('text') is not None else message['bytes']
+
+
+def parse_chat_action(data: bytes, encoding: EventEncoding) -> ChatAction:
+    try:
+        action = encoding.decode(data)
+    except ValueError as err:
+        raise ValidationError([ErrorWrapper(err, loc=ROOT_KEY)], ChatAction)
+    return ChatAction.parse_obj(action)
+
+
+def get_rate_limited_event(retry_after: float) -> str:
+    return get_event_payload(event='rate_limited', payload=RateLimited(retry_after=round(retry_after, 3)))
+
+
+async def handle_chat_action(chat: Chat, user: User, connection: ChatConnection, action: ChatAction) -> None:
+    presence = chats_connections.presence
+    if action.action == 'typing':
+        presence.typing(chat.id, user.id)
+    elif action.action == 'presence':
+        snapshot = ChatPresenceSnapshot(online=presence.get_online(chat.id))
+        connection.send(get_event_payload(event='presence_snapshot', payload=snapshot))
+    elif action.action == 'read':
+        chat_read_markers.mark(chat.id, user.id, action.message_id)
+        await recent_writers.add(user.id)
+
+
+async def handle_chat_connection(
+        chat: Chat,
+        user: User,
+        websocket: WebSocket,
+        since_id: Optional[int] = None,
+        batch: bool = False,
+        encoding: EventEncoding = JSON_ENCODING,
+) -> None:
+    # new messages are held back until the missed ones are sent, then the ones sent twice are skipped
+    connection = chats_connections.add_connection(
+        chat.id, user.id, websocket, held=since_id is not None, batching=batch, encoding=encoding,
+    )
+    CHAT_WEBSOCKET_SESSIONS.inc()
+    socket_rate_limit = LocalRateLimit(
+        'chat_socket_messages', settings.WS_MESSAGES_RATE_LIMIT_RATE, settings.WS_MESSAGES_RATE_LIMIT_BURST,
+    )
+    actions_rate_limit = LocalRateLimit(
+        'chat_socket_actions', settings.WS_ACTIONS_RATE_LIMIT_RATE, settings.WS_ACTIONS_RATE_LIMIT_BURST,
+    )
+    try:
+        if since_id is not None:
+            replayed_ids = await replay_chat_messages(chat, connection, since_id)
+            connection.release(skip=lambda message: get_new_message_id(message) in replayed_ids)
+
+        async for data in iter_frames(websocket):
+            started_at = time.perf_counter() if metrics.enabled else 0
+            if isinstance(data, bytes):  # an action, see iter_frames
+                retry_after = actions_rate_limit.check()
+                if retry_after:
+                    connection.send(get_rate_limited_event(retry_after))
+                    continue
+                try:
+                    action = parse_chat_action(data, encoding)
+                except ValidationError as err:
+                    connection.send(get_event_payload(event='validation_error', payload=err))
+                else:
+                    await handle_chat_action(chat, user, connection, action)
+                continue
+
+            retry_after = socket_rate_limit.check() or await check_rate_limit(
+                'chat_user_messages', str(user.id),
+                settings.USER_MESSAGES_RATE_LIMIT_RATE, settings.USER_MESSAGES_RATE_LIMIT_BURST,
             )
-    chats_connections.remove_connection(chat.id, user.id, websocket)
+            if retry_after:
+                CHAT_MESSAGES_RECEIVED.labels('rate_limited').inc()
+                connection.send(get_rate_limited_event(retry_after))
+                continue
+
+            try:
+                message_data = ChatMessageCreate(text=data)
+            except ValidationError as err:
+                CHAT_MESSAGES_RECEIVED.labels('invalid').inc()
+                connection.send(get_event_payload(event='validation_error', payload=err))
+            else:
+                chat_message = await chat_messages_sink.add(text=message_data.text, chat=chat, author=user)
+                if chat_message is None:  # the chat was deleted meanwhile
+                    continue
+                chat_read_markers.mark(chat.id, user.id, chat_message.id)
+                chat_message_payload = ChatMessageDetail.from_orm(chat_message)
+                await asyncio.gather(
+                    chats_connections.send_chat_message(
+                        chat_id=chat.id, message=get_event_payload(event='new_message', payload=chat_message_payload),
+                    ),
+                    recent_messages.add(chat.id, chat_message_payload),
+                    recent_writers.add(user.id),
+                )
+                CHAT_MESSAGES_RECEIVED.labels('valid').inc()
+                if metrics.enabled:
+                    CHAT_MESSAGE_HANDLING_SECONDS.observe(time.perf_counter() - started_at)
+    finally:
+        chats_connections.remove_connection(chat.id, user.id, connection)
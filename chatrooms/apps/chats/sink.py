@@ -0,0 +1,190 @@
+import asyncio
+from collections import deque
+import logging
+from typing import Deque, List, Optional, Tuple
+from uuid import UUID
+
+from tortoise import timezone
+from tortoise.exceptions import IntegrityError
+
+from chatrooms.apps.chats.models import Chat, ChatMessage
+from chatrooms.apps.users.models import User
+from chatrooms.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+RETRY_INTERVAL = 0.5  # seconds between the attempts to write after a failure
+# the first key of the advisory locks taken on the chats while their messages are inserted
+CHAT_MESSAGES_LOCK_KEY = 0x63686174
+
+# a single statement, so a single round trip: the locks are taken first, by the one-time filter,
+# then the ids in the order of the messages, and all are released as the statement commits
+INSERT_MESSAGES_QUERY = (
+    'WITH "lock" AS ('
+    'SELECT pg_advisory_xact_lock($1, "chat"."key") '
+    'FROM (SELECT DISTINCT hashtext("chat_id"::TEXT) AS "key" FROM unnest($5::uuid[]) AS "chat"("chat_id") '
+    'ORDER BY "key") AS "chat") '
+    'INSERT INTO "chatmessage" ("id", "text", "created_at", "is_deleted", "author_id", "chat_id") '
+    'SELECT nextval(\'chatmessage_id_seq\'), "text", "created_at", false, "author_id", "chat_id" '
+    'FROM unnest($2::text[], $3::timestamptz[], $4::int[], $5::uuid[]) '
+    'AS "message"("text", "created_at", "author_id", "chat_id") '
+    'WHERE (SELECT count(*) FROM "lock") >= 0 '
+    'RETURNING "id"'
+)
+
+PendingMessage = Tuple[ChatMessage, 'asyncio.Future[Optional[ChatMessage]]']
+
+
+class ChatMessageSink:
+    """
+    Group commit of new chat messages.
+
+    Adding a message waits until it is inserted, together with the other pending ones, up to `batch_size`
+    per INSERT; a write waits up to `flush_interval` seconds for its batch to fill, zero writes as soon as
+    the previous write is done. Adding waits while `max_pending` messages are not written yet.
+
+    Ids are taken from the table sequence by the INSERT itself, which first takes an advisory lock
+    on each chat of the batch, so the ids of a chat's messages follow the order they are committed in
+    across all the workers, and a message is never published before it can be read.
+    """
+    batch_size: int
+    flush_interval: float
+
+    _pending: Deque[PendingMessage]
+    _writing: List[PendingMessage]
+
+    def __init__(self, batch_size: int, flush_interval: float, max_pending: int):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._pending = deque()
+        self._writing = []
+        self._slots = asyncio.Semaphore(max_pending)
+        self._flush_lock = asyncio.Lock()
+        self._has_pending = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def add(self, text: str, chat: Chat, author: User) -> Optional[ChatMessage]:
+        """Returns the written message, or none if it was dropped, e.g. as the chat was deleted meanwhile."""
+        await self._slots.acquire()
+        message = ChatMessage(text=text, chat=chat, author=author, created_at=timezone.now())
+        written = asyncio.get_running_loop().create_future()
+        self._pending.append((message, written))
+        self._has_pending.set()
+        if len(self._pending) >= self.batch_size:
+            self._batch_full.set()
+        self._ensure_running()
+        # the message is still written if the caller is cancelled
+        return await asyncio.shield(written)
+
+    def discard_chat(self, chat_id: UUID) -> None:
+        kept = deque()
+        for message, written in self._pending:
+            if message.chat_id == chat_id:
+                self._resolve(written, None)
+                self._slots.release()
+            else:
+                kept.append((message, written))
+        self._pending = kept
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            while self._pending:
+                batch_size = min(self.batch_size, len(self._pending))
+                self._writing = [self._pending.popleft() for __ in range(batch_size)]
+                try:
+                    written_ids = await self._write([message for message, __ in self._writing])
+                except BaseException:  # cancelled too, so the batch is written by the next flush
+                    for message, __ in self._writing:
+                        message.id = None
+                    self._pending.extendleft(reversed(self._writing))
+                    raise
+                else:
+                    for message, written in self._writing:
+                        self._resolve(written, message if message.id in written_ids else None)
+                finally:
+                    self._writing = []
+                for __ in range(batch_size):
+                    self._slots.release()
+
+            self._has_pending.clear()
+            self._batch_full.clear()
+
+    def clear(self) -> None:
+        """Forgets the pending messages, e.g. when the database is recreated."""
+        for __, written in self._pending:
+            self._resolve(written, None)
+            self._slots.release()
+        self._pending.clear()
+
+    async def close(self) -> None:
+        """Stops the background writes and writes the pending messages, after the write in progress if any."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    def _ensure_running(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self) -> None:
+        while True:
+            await self._has_pending.wait()
+            try:
+                await asyncio.wait_for(self._batch_full.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+
+            try:
+                # a write in progress is finished even if the task is cancelled, see `close`
+                await asyncio.shield(self.flush())
+            except Exception:
+                logger.exception("Failed to write chat messages, retrying")
+                await asyncio.sleep(max(self.flush_interval, RETRY_INTERVAL))
+
+    @staticmethod
+    def _resolve(written: 'asyncio.Future[Optional[ChatMessage]]', message: Optional[ChatMessage]) -> None:
+        if not written.done():
+            written.set_result(message)
+
+    @classmethod
+    async def _write(cls, messages: List[ChatMessage]) -> List[int]:
+        """Inserts the messages, returns the ids of the written ones."""
+        try:
+            await cls._insert(messages)
+        except IntegrityError:
+            # e.g. the chat was deleted meanwhile, so write the rest of the batch one by one
+            written_ids = []
+            for message in messages:
+                message.id = None
+                try:
+                    await cls._insert([message])
+                except IntegrityError:
+                    message.id = None
+                    logger.warning("Dropped chat message of chat %s", message.chat_id)
+                else:
+                    written_ids.append(message.id)
+            return written_ids
+        return [message.id for message in messages]
+
+    @staticmethod
+    async def _insert(messages: List[ChatMessage]) -> None:
+        rows = await ChatMessage._meta.db.execute_query_dict(INSERT_MESSAGES_QUERY, [
+            CHAT_MESSAGES_LOCK_KEY,
+            [message.text for message in messages],
+            [message.created_at for message in messages],
+            [message.author_id for message in messages],
+            [message.chat_id for message in messages],
+        ])
+        for message, message_id in zip(messages, sorted(row['id'] for row in rows)):
+            message.id = message_id
+
+
+chat_messages_sink = ChatMessageSink(
+    batch_size=settings.CHAT_MESSAGES_BATCH_SIZE,
+    flush_interval=settings.CHAT_MESSAGES_FLUSH_INTERVAL,
+    max_pending=settings.CHAT_MESSAGES_MAX_PENDING,
+)
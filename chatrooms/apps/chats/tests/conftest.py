@@ -4,8 +4,8 @@ import asyncio
 from dataclasses import dataclass, field
 from typing import Optional
 
-import uvicorn
-
+from chatrooms.apps.chats.websockets import chats_connections
+from chatrooms.config.server import DrainingServer, get_config
 from main import app
 
 
@@ -13,11 +13,11 @@ from main import app
 class LiveServer:
     host: str
     port: int
-    _server: uvicorn.Server = field(init=False, repr=False)
+    _server: DrainingServer = field(init=False, repr=False)
     _task: Optional[asyncio.Task] = field(init=False, repr=False)
 
     def __post_init__(self):
-        self._server = uvicorn.Server(config=uvicorn.Config(app, host=self.host, port=self.port, log_level='error'))
+        self._server = DrainingServer(config=get_config(app, host=self.host, port=self.port, log_level='error'))
         self._task = None
 
     async def start(self):
@@ -42,6 +42,7 @@ class LiveServer:
 async def live_server(mocker):
     mocker.patch('tortoise.Tortoise.init')  # mock app startup event to prevent connect of real db
     mocker.patch('tortoise.Tortoise.close_connections')
+    mocker.patch.object(chats_connections, '_draining', False)  # stopping the server drains the connections
 
     server = LiveServer(host="127.0.0.1", port=3003)
     await server.start()
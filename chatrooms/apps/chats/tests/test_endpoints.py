@@ -1,14 +1,20 @@
+import asyncio
 import json
 from uuid import uuid4
 
 from fastapi import status
+import pytest
 import websockets
 
-from chatrooms.apps.chats.models import Chat, ChatMessage
+from chatrooms.apps.chats.models import Chat, ChatMessage, ChatReadMarker
+from chatrooms.apps.chats.read_markers import chat_read_markers
+from chatrooms.apps.chats.recent_messages import recent_messages
 from chatrooms.apps.chats.tests.factories import ChatFactory, ChatMessageFactory
+from chatrooms.apps.chats.websockets import chats_connections
 from chatrooms.apps.users.models import Token
 from chatrooms.apps.users.tests.factories import UserFactory
 from chatrooms.apps.users.tests.utils import authenticate
+from chatrooms.config import settings
 
 
 async def test_create_chat(async_client, user):
@@ -104,6 +110,79 @@ async def test_join_chat(async_client, user):
     assert data['detail'] == 'Joined'
 
 
+async def test_leave_chat(async_client, user):
+    chat = await ChatFactory()
+    await chat.participants.add(user)
+
+    await authenticate(async_client, user)
+    response = await async_client.delete(f'/api/v1/chats/{chat.id}/access')
+    assert response.status_code == status.HTTP_200_OK
+    assert not await chat.participants.filter(id=user.id).exists()
+    data = response.json()
+    assert data['detail'] == 'Left'
+
+
+async def test_add_chat_members(async_client):
+    chat = await ChatFactory()
+    joined_user, new_user, email_user = await UserFactory(), await UserFactory(), await UserFactory()
+    await chat.participants.add(joined_user)
+
+    payload = {
+        'user_ids': [joined_user.id, new_user.id, chat.creator_id, 0],
+        'emails': [email_user.email, 'missing@example.com'],
+    }
+    await authenticate(async_client, chat.creator)
+    response = await async_client.post(f'/api/v1/chats/{chat.id}/members', json=payload)
+    assert response.status_code == status.HTTP_200_OK
+
+    data = response.json()
+    assert [result['status'] for result in data['results']] == [
+        'already_joined', 'joined', 'creator', 'not_found', 'joined', 'not_found',
+    ]
+    assert data['results'][4]['user_id'] == email_user.id
+    assert set(await chat.participants.all().values_list('id', flat=True)) == {
+        joined_user.id, new_user.id, email_user.id,
+    }
+
+    response = await async_client.post(f'/api/v1/chats/{chat.id}/members', json=payload)
+    data = response.json()
+    assert [result['status'] for result in data['results']] == [
+        'already_joined', 'already_joined', 'creator', 'not_found', 'already_joined', 'not_found',
+    ]
+
+
+async def test_add_chat_members_not_own_chat(async_client, user):
+    chat = await ChatFactory()
+
+    await authenticate(async_client, user)
+    response = await async_client.post(f'/api/v1/chats/{chat.id}/members', json={'user_ids': [user.id]})
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+    assert not await chat.participants.filter(id=user.id).exists()
+
+
+async def test_add_chat_members_empty(async_client):
+    chat = await ChatFactory()
+
+    await authenticate(async_client, chat.creator)
+    response = await async_client.post(f'/api/v1/chats/{chat.id}/members', json={})
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
+
+
+async def test_remove_chat_members(async_client):
+    chat = await ChatFactory()
+    member, other_member, not_member = await UserFactory(), await UserFactory(), await UserFactory()
+    await chat.participants.add(member, other_member)
+
+    payload = {'user_ids': [member.id, not_member.id, chat.creator_id], 'emails': [other_member.email]}
+    await authenticate(async_client, chat.creator)
+    response = await async_client.post(f'/api/v1/chats/{chat.id}/members/remove', json=payload)
+    assert response.status_code == status.HTTP_200_OK
+
+    data = response.json()
+    assert [result['status'] for result in data['results']] == ['removed', 'not_joined', 'creator', 'removed']
+    assert not await chat.participants.all().exists()
+
+
 async def test_list_joined_chats(async_client, user):
     chat2 = await ChatFactory(title='B')
     await chat2.participants.add(user)
@@ -140,6 +219,19 @@ async def test_retrieve_chat_details_own_chat(async_client, user):
     assert data['creator']['email'] == user.email
 
 
+async def test_list_unread_counts(async_client, user):
+    chat = await ChatFactory()
+    await chat.participants.add(user)
+    messages = [await ChatMessageFactory(chat=chat) for __ in range(3)]
+    await ChatReadMarker.create(chat=chat, user=user, last_read_id=messages[0].id)
+    await ChatFactory()
+
+    await authenticate(async_client, user)
+    response = await async_client.get('/api/v1/chats/unread')
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == [{'chat_id': str(chat.id), 'last_read_id': messages[0].id, 'unread_count': 2}]
+
+
 async def test_retrieve_chat_details_joined_chat(async_client, user):
     chat = await ChatFactory()
     await chat.participants.add(user)
@@ -203,6 +295,254 @@ async def test_send_chat_messages(live_server, user):
     assert not data2['is_deleted']
 
 
+async def test_send_chat_messages_rate_limited(live_server, user, mocker):
+    mocker.patch.object(settings, 'WS_MESSAGES_RATE_LIMIT_BURST', 2)
+    mocker.patch.object(settings, 'USER_MESSAGES_RATE_LIMIT_BURST', 3)
+    chat = await ChatFactory(creator=user)
+    await Token.create(user=user, key="111")
+
+    url = f'ws://{live_server.netloc}/api/v1/chats/ws/{chat.id}'
+    async with websockets.connect(f'{url}?token=111') as ws1, websockets.connect(f'{url}?token=111') as ws2:
+        for text in ("text 1", "text 2"):
+            await ws1.send(text)
+            assert json.loads(await ws1.recv())['event'] == 'new_message'
+            assert json.loads(await ws2.recv())['event'] == 'new_message'
+        await ws1.send("text 3")
+        data = json.loads(await ws1.recv())
+        assert data['event'] == 'rate_limited'
+        assert data['payload']['retry_after'] > 0
+
+        # the socket's own limit is not reached, but the user's one across the sockets is
+        await ws2.send("text 4")
+        data = json.loads(await ws2.recv())
+        assert data['event'] == 'new_message'
+        assert json.loads(await ws1.recv())['event'] == 'new_message'
+        await ws2.send("text 5")
+        data = json.loads(await ws2.recv())
+        assert data['event'] == 'rate_limited'
+
+    assert await ChatMessage.filter(chat=chat).count() == 3
+
+
+async def test_send_chat_messages_server_restart(live_server, user):
+    chat = await ChatFactory(creator=user)
+    await Token.create(user=user, key="111")
+
+    url = f'ws://{live_server.netloc}/api/v1/chats/ws/{chat.id}'
+    async with websockets.connect(f'{url}?token=111') as ws:
+        await ws.send("test text")
+        assert json.loads(await ws.recv())['event'] == 'new_message'
+
+        await live_server.stop()
+        data = json.loads(await ws.recv())
+        assert data['event'] == 'server_restart'
+        assert data['payload']['reconnect_after'] >= 0
+        await ws.wait_closed()
+        assert ws.close_code == status.WS_1012_SERVICE_RESTART
+
+    assert await ChatMessage.filter(chat=chat, text="test text").exists()
+
+
+async def test_send_chat_messages_draining(live_server, user, mocker):
+    chat = await ChatFactory(creator=user)
+    await Token.create(user=user, key="111")
+    mocker.patch.object(chats_connections, '_draining', True)
+
+    url = f'ws://{live_server.netloc}/api/v1/chats/ws/{chat.id}'
+    async with websockets.connect(f'{url}?token=111') as ws:
+        await ws.wait_closed()
+        assert ws.close_code == status.WS_1012_SERVICE_RESTART
+
+
+async def test_chat_presence(live_server, user):
+    chat = await ChatFactory(creator=user)
+    await Token.create(user=user, key="111")
+    other_user = await UserFactory()
+    await chat.participants.add(other_user)
+    await Token.create(user=other_user, key="222")
+
+    url = f'ws://{live_server.netloc}/api/v1/chats/ws/{chat.id}'
+    async with websockets.connect(f'{url}?token=111') as ws1, websockets.connect(f'{url}?token=222') as ws2:
+        await ws1.send(json.dumps({"action": "presence"}).encode())
+        data = json.loads(await ws1.recv())
+        assert data['event'] == 'presence_snapshot'
+        assert data['payload']['online'] == sorted([user.id, other_user.id])
+
+        await ws2.send(json.dumps({"action": "typing"}).encode())
+        online, typing = set(), []
+        while not typing:
+            data = json.loads(await asyncio.wait_for(ws1.recv(), timeout=1))
+            assert data['event'] == 'presence'
+            online.update(data['payload']['online'])
+            typing = data['payload']['typing']
+        assert online == {user.id, other_user.id}
+        assert typing == [other_user.id]
+
+        await ws2.send(json.dumps({"action": "unknown"}).encode())
+        data = json.loads(await ws2.recv())
+        while data['event'] == 'presence':
+            data = json.loads(await ws2.recv())
+        assert data['event'] == 'validation_error'
+
+        # a text frame is a message, whatever it looks like
+        await ws2.send(json.dumps({"action": "typing"}))
+        data = json.loads(await ws2.recv())
+        while data['event'] == 'presence':
+            data = json.loads(await ws2.recv())
+        assert data['event'] == 'new_message'
+        assert data['payload']['text'] == '{"action": "typing"}'
+
+
+async def test_chat_actions_rate_limited(live_server, user, mocker):
+    mocker.patch.object(settings, 'WS_ACTIONS_RATE_LIMIT_BURST', 1)
+    chat = await ChatFactory(creator=user)
+    await Token.create(user=user, key="111")
+
+    url = f'ws://{live_server.netloc}/api/v1/chats/ws/{chat.id}'
+    async with websockets.connect(f'{url}?token=111') as ws:
+        events = []
+        for __ in range(2):
+            await ws.send(json.dumps({"action": "presence"}).encode())
+        while len(events) < 2:
+            data = json.loads(await ws.recv())
+            if data['event'] != 'presence':
+                events.append(data['event'])
+        assert events == ['presence_snapshot', 'rate_limited']
+
+        # messages have limits of their own
+        await ws.send("test text")
+        data = json.loads(await ws.recv())
+        while data['event'] == 'presence':
+            data = json.loads(await ws.recv())
+        assert data['event'] == 'new_message'
+
+
+async def test_chat_read_marker(live_server, user):
+    chat = await ChatFactory()
+    await chat.participants.add(user)
+    message = await ChatMessageFactory(chat=chat)
+    await Token.create(user=user, key="111")
+
+    url = f'ws://{live_server.netloc}/api/v1/chats/ws/{chat.id}'
+    async with websockets.connect(f'{url}?token=111') as ws:
+        await ws.send(json.dumps({"action": "read", "message_id": message.id}).encode())
+        for action in ({"action": "read"}, {"action": "read", "message_id": 2 ** 31}):
+            await ws.send(json.dumps(action).encode())
+            data = json.loads(await ws.recv())
+            while data['event'] == 'presence':
+                data = json.loads(await ws.recv())
+            assert data['event'] == 'validation_error'
+
+        # own messages are read
+        await ws.send("test text")
+        data = json.loads(await ws.recv())
+        while data['event'] == 'presence':
+            data = json.loads(await ws.recv())
+        assert data['event'] == 'new_message'
+        assert chat_read_markers.get_pending(user.id) == {chat.id: data['payload']['id']}
+
+    await chat_read_markers.flush()
+    marker = await ChatReadMarker.get(chat=chat, user=user)
+    assert marker.last_read_id == data['payload']['id']
+
+
+async def test_send_chat_messages_batched(live_server, user, mocker):
+    mocker.patch.object(chats_connections, 'batch_hot_rate', 1)
+    mocker.patch.object(chats_connections, 'batch_delay', 0.2)
+    chat = await ChatFactory(creator=user)
+    await Token.create(user=user, key="111")
+
+    url = f'ws://{live_server.netloc}/api/v1/chats/ws/{chat.id}'
+    async with websockets.connect(f'{url}?token=111&batch=1') as ws1, websockets.connect(f'{url}?token=111') as ws2:
+        for text in ("text 1", "text 2", "text 3"):
+            await ws2.send(text)
+        single_events = [json.loads(await ws2.recv()) for __ in range(3)]
+        assert [event['payload']['text'] for event in single_events] == ["text 1", "text 2", "text 3"]
+
+        frame = json.loads(await ws1.recv())
+        while isinstance(frame, dict) and frame['event'] == 'presence':
+            frame = json.loads(await ws1.recv())
+        assert frame == single_events
+
+
+async def test_send_chat_messages_msgpack(live_server, user):
+    msgpack = pytest.importorskip('msgpack')
+    chat = await ChatFactory(creator=user)
+    await Token.create(user=user, key="111")
+
+    url = f'ws://{live_server.netloc}/api/v1/chats/ws/{chat.id}?token=111'
+    async with websockets.connect(url, subprotocols=['msgpack', 'json']) as ws1, websockets.connect(url) as ws2:
+        assert ws1.subprotocol == 'msgpack'
+        assert ws2.subprotocol is None
+        assert [extension.name for extension in ws1.extensions] == ['permessage-deflate']
+
+        await ws2.send("test text")
+        data = await ws1.recv()
+        while msgpack.unpackb(data)['event'] == 'presence':
+            data = await ws1.recv()
+        assert isinstance(data, bytes)
+        event = msgpack.unpackb(data)
+        assert event['event'] == 'new_message'
+        assert event['payload']['text'] == "test text"
+
+        await ws1.send("")
+        data = await ws1.recv()
+        while msgpack.unpackb(data)['event'] == 'presence':
+            data = await ws1.recv()
+        assert msgpack.unpackb(data)['event'] == 'validation_error'
+
+        # actions are in the encoding of the connection too
+        await ws1.send(msgpack.packb({"action": "presence"}))
+        data = await ws1.recv()
+        while msgpack.unpackb(data)['event'] == 'presence':
+            data = await ws1.recv()
+        assert msgpack.unpackb(data)['event'] == 'presence_snapshot'
+
+        for action in (json.dumps({"action": "presence"}).encode(), msgpack.packb(["presence"]), b'\xc1'):
+            await ws1.send(action)
+            data = await ws1.recv()
+            while msgpack.unpackb(data)['event'] == 'presence':
+                data = await ws1.recv()
+            assert msgpack.unpackb(data)['event'] == 'validation_error'
+
+
+async def test_send_chat_messages_since_id(live_server, user):
+    chat = await ChatFactory(creator=user)
+    await Token.create(user=user, key="111")
+    messages = await ChatMessageFactory.create_batch(size=5, chat=chat)
+
+    url = f'ws://{live_server.netloc}/api/v1/chats/ws/{chat.id}'
+    async with websockets.connect(f'{url}?token=111&since_id={messages[1].id}') as ws:
+        replayed = [json.loads(await ws.recv()) for __ in range(3)]
+        assert [event['event'] for event in replayed] == ['new_message'] * 3
+        assert [event['payload']['id'] for event in replayed] == [message.id for message in messages[2:]]
+
+        await ws.send("test text")
+        data = json.loads(await ws.recv())
+        assert data['payload']['text'] == "test text"
+
+    async with websockets.connect(f'{url}?token=111&since_id={messages[-1].id}') as ws:
+        data = json.loads(await ws.recv())
+        assert data['payload']['text'] == "test text"
+
+
+async def test_send_chat_messages_since_id_batches(live_server, user, mocker):
+    mocker.patch.object(settings, 'WS_REPLAY_BATCH_SIZE', 2)
+    chat = await ChatFactory(creator=user)
+    await Token.create(user=user, key="111")
+    messages = await ChatMessageFactory.create_batch(size=5, chat=chat)
+
+    url = f'ws://{live_server.netloc}/api/v1/chats/ws/{chat.id}'
+    async with websockets.connect(f'{url}?token=111&since_id=0') as ws:
+        replayed = [json.loads(await ws.recv()) for __ in range(5)]
+        assert [event['payload']['id'] for event in replayed] == [message.id for message in messages]
+
+        await ws.send("test text")
+        data = json.loads(await ws.recv())
+        assert data['payload']['text'] == "test text"
+        assert data['payload']['id'] > messages[-1].id
+
+
 async def test_list_chat_messages(async_client, user):
     chat = await ChatFactory()
     await chat.participants.add(user)
@@ -227,6 +567,64 @@ async def test_list_chat_messages(async_client, user):
     assert results[0]['author']['email'] == msg1.author.email
 
 
+async def test_list_chat_messages_cursor_pagination(async_client, user):
+    chat = await ChatFactory()
+    await chat.participants.add(user)
+
+    messages = await ChatMessageFactory.create_batch(size=25, chat=chat)
+
+    await authenticate(async_client, user)
+    response = await async_client.get(f'/api/v1/chats/{chat.id}/messages', params={'pagination': 'cursor'})
+    assert response.status_code == status.HTTP_200_OK
+
+    data = response.json()
+    assert 'count' not in data
+    assert data['previous'] is None
+    assert [result['id'] for result in data['results']] == [message.id for message in messages[:4:-1]]
+
+    response = await async_client.get(data['next'])
+    assert response.status_code == status.HTTP_200_OK
+
+    data = response.json()
+    assert data['next'] is None
+    assert data['previous'] is not None
+    assert [result['id'] for result in data['results']] == [message.id for message in messages[4::-1]]
+
+
+async def test_list_chat_messages_recent_messages(async_client, user, mocker):
+    chat = await ChatFactory()
+    await chat.participants.add(user)
+
+    messages = await ChatMessageFactory.create_batch(size=25, chat=chat, author=user)
+
+    await authenticate(async_client, user)
+    url = f'/api/v1/chats/{chat.id}/messages'
+    all_params = [{}, {'pagination': 'cursor'}]
+    mocker.patch.object(recent_messages, 'size', 0)
+    expected_responses = [await async_client.get(url, params=params) for params in all_params]
+    mocker.stopall()
+    for params, expected_response in zip(all_params, expected_responses):
+        response = await async_client.get(url, params=params)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json() == expected_response.json()
+    assert chat.id in recent_messages._chats
+
+    response = await async_client.delete(f'{url}/{messages[-1].id}')
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    response = await async_client.get(url)
+    assert response.json()['results'][0]['is_deleted']
+    assert response.json()['count'] == 25
+
+
+async def test_list_chat_messages_invalid_cursor(async_client, user):
+    chat = await ChatFactory(creator=user)
+
+    await authenticate(async_client, user)
+    response = await async_client.get(f'/api/v1/chats/{chat.id}/messages', params={'cursor': 'foo'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json()['cursor'] == "Invalid cursor."
+
+
 async def test_delete_chat_message(async_client, user):
     chat = await ChatFactory()
     await chat.participants.add(user)
@@ -257,3 +655,117 @@ async def test_delete_chat_message_not_own_message(async_client, user):
 
     data = response.json()
     assert data['detail'] == "Can't delete not own chat"
+
+
+async def test_export_chat_messages_ndjson(async_client, user):
+    chat = await ChatFactory()
+    await chat.participants.add(user)
+    msg1, msg2 = await ChatMessageFactory.create_batch(size=2, chat=chat)
+    await ChatMessageFactory()
+
+    await authenticate(async_client, user)
+    response = await async_client.get(f'/api/v1/chats/{chat.id}/export')
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers['content-type'] == 'application/x-ndjson'
+    assert response.headers['content-disposition'] == f'attachment; filename="chat-{chat.id}.ndjson"'
+
+    results = [json.loads(line) for line in response.text.splitlines()]
+    assert [result['id'] for result in results] == [msg1.id, msg2.id]
+    assert results[0]['text'] == msg1.text
+    assert results[0]['created_at'] == msg1.created_at.isoformat()
+    assert not results[0]['is_deleted']
+    assert results[0]['author'] == {'id': msg1.author_id, 'email': msg1.author.email}
+
+
+async def test_export_chat_messages_csv(async_client, user):
+    chat = await ChatFactory(creator=user)
+    message = await ChatMessageFactory(chat=chat, text='hello, "world"')
+
+    await authenticate(async_client, user)
+    response = await async_client.get(f'/api/v1/chats/{chat.id}/export', params={'format': 'csv'})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers['content-type'] == 'text/csv; charset=utf-8'
+
+    author = await message.author
+    assert response.text.splitlines() == [
+        'id,created_at,author_id,author_email,is_deleted,text',
+        f'{message.id},{message.created_at.isoformat()},{author.id},{author.email},False,"hello, ""world"""',
+    ]
+
+
+async def test_export_chat_messages_not_accessible(async_client, user):
+    chat = await ChatFactory()
+
+    await authenticate(async_client, user)
+    response = await async_client.get(f'/api/v1/chats/{chat.id}/export')
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+async def test_search_chat_messages(async_client, user):
+    chat = await ChatFactory()
+    await chat.participants.add(user)
+    weak_match = await ChatMessageFactory(chat=chat, text='the quick brown fox')
+    strong_match = await ChatMessageFactory(chat=chat, text='fox jumps over a fox')
+    await ChatMessageFactory(chat=chat, text='the lazy dog')
+    await ChatMessageFactory(chat=chat, text='', is_deleted=True)
+    await ChatMessageFactory(text='another fox')
+
+    await authenticate(async_client, user)
+    response = await async_client.get(f'/api/v1/chats/{chat.id}/messages/search', params={'q': 'Fox'})
+    assert response.status_code == status.HTTP_200_OK
+
+    data = response.json()
+    assert data['next'] is None
+    assert [result['id'] for result in data['results']] == [strong_match.id, weak_match.id]
+    assert data['results'][0]['chat_id'] == str(chat.id)
+    assert data['results'][0]['text'] == strong_match.text
+    assert data['results'][0]['author']['id'] == strong_match.author_id
+
+
+async def test_search_messages_accessible_chats(async_client, user):
+    own_chat, joined_chat, other_chat = await ChatFactory(creator=user), await ChatFactory(), await ChatFactory()
+    await joined_chat.participants.add(user)
+    messages = [
+        await ChatMessageFactory(chat=chat, text='hello world')
+        for chat in (own_chat, joined_chat, other_chat, own_chat)
+    ]
+    deleted_message = await ChatMessageFactory(chat=own_chat, text='hello world')
+    deleted_message.is_deleted = True
+    await deleted_message.save()
+
+    await authenticate(async_client, user)
+    response = await async_client.get('/api/v1/chats/messages/search', params={'q': 'hello'})
+    assert response.status_code == status.HTTP_200_OK
+
+    data = response.json()
+    assert [result['id'] for result in data['results']] == [messages[3].id, messages[1].id, messages[0].id]
+
+
+async def test_search_chat_messages_pagination(async_client, user, mocker):
+    mocker.patch('chatrooms.apps.chats.endpoints.MESSAGES_PAGE_SIZE', 2)
+    chat = await ChatFactory(creator=user)
+    messages = await ChatMessageFactory.create_batch(size=5, chat=chat, text='search me')
+
+    await authenticate(async_client, user)
+    url = f'/api/v1/chats/{chat.id}/messages/search'
+    found_ids = []
+    response = await async_client.get(url, params={'q': 'search'})
+    while True:
+        assert response.status_code == status.HTTP_200_OK
+        data = response.json()
+        found_ids.extend(result['id'] for result in data['results'])
+        if data['next'] is None:
+            break
+        response = await async_client.get(data['next'])
+    assert found_ids == [message.id for message in reversed(messages)]
+
+    response = await async_client.get(url, params={'q': 'search', 'cursor': 'invalid'})
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
+async def test_search_chat_messages_not_accessible(async_client, user):
+    chat = await ChatFactory()
+
+    await authenticate(async_client, user)
+    response = await async_client.get(f'/api/v1/chats/{chat.id}/messages/search', params={'q': 'fox'})
+    assert response.status_code == status.HTTP_404_NOT_FOUND
@@ -0,0 +1,22 @@
+from chatrooms.apps.chats.export import export_csv, iter_chat_messages_batches
+from chatrooms.apps.chats.models import ChatMessage
+from chatrooms.apps.chats.tests.factories import ChatFactory, ChatMessageFactory
+
+
+async def test_iter_chat_messages_batches():
+    chat = await ChatFactory()
+    messages = await ChatMessageFactory.create_batch(size=5, chat=chat)
+    await ChatMessageFactory()
+
+    batches = [batch async for batch in iter_chat_messages_batches(chat, ChatMessage._meta.db, batch_size=2)]
+    assert [[row['id'] for row in batch] for batch in batches] == [
+        [messages[0].id, messages[1].id], [messages[2].id, messages[3].id], [messages[4].id],
+    ]
+    assert batches[0][0]['author_email'] == (await messages[0].author).email
+
+
+async def test_export_csv_no_messages():
+    chat = await ChatFactory()
+
+    chunks = [chunk async for chunk in export_csv(chat, ChatMessage._meta.db)]
+    assert chunks == [b'id,created_at,author_id,author_email,is_deleted,text\r\n']
@@ -0,0 +1,78 @@
+import json
+from pathlib import Path
+from typing import Iterator
+
+from aerich.utils import get_version_content_from_file
+import pytest
+from tortoise.queryset import QuerySet
+
+from chatrooms.apps.chats.models import Chat, ChatMessage
+from chatrooms.apps.users.models import User
+
+
+MIGRATION_PATH = Path(__file__).parents[3] / 'migrations' / 'models' / '3_20261017093512_add_indexes.sql'
+
+
+def iter_index_names(plan: dict) -> Iterator[str]:
+    if 'Index Name' in plan:
+        yield plan['Index Name']
+    for subplan in plan.get('Plans', []):
+        yield from iter_index_names(subplan)
+
+
+async def get_used_indexes(qs: QuerySet) -> set:
+    plan = await qs.explain()
+    return set(iter_index_names(json.loads(plan[0]['QUERY PLAN'])[0]['Plan']))
+
+
+@pytest.fixture
+async def seeded_db():
+    connection = Chat._meta.db
+    for statement in get_version_content_from_file(MIGRATION_PATH)['upgrade']:
+        await connection.execute_script(statement)
+
+    # enough rows for the planner to choose the indexes by itself, with fresh statistics
+    await connection.execute_script('''
+        INSERT INTO "user" ("email", "password")
+        SELECT 'user' || i || '@example.com', '' FROM generate_series(1, 2000) AS i;
+        INSERT INTO "chat" ("id", "title", "creator_id")
+        SELECT md5(i::TEXT)::UUID, 'chat ' || i, i % 400 + 1 FROM generate_series(1, 2000) AS i;
+        INSERT INTO "chat_user" ("chat_id", "user_id")
+        SELECT "chat"."id", "user"."id" FROM "chat" JOIN "user" ON ("user"."id" * 7 + hashtext("chat"."title")) % 200 = 0;
+        INSERT INTO "chatmessage" ("text", "chat_id", "author_id")
+        SELECT 'message ' || i, md5((i % 2000 + 1)::TEXT)::UUID, i % 2000 + 1 FROM generate_series(1, 50000) AS i;
+        ANALYZE;
+    ''')
+    user = await User.get(email='user1@example.com')
+    return user, await Chat.filter(creator=user).first(), await Chat.filter(participants=user).first()
+
+
+async def test_list_chat_messages_index(seeded_db):
+    __, chat, __ = seeded_db
+    qs = ChatMessage.filter(chat=chat).order_by('-id').limit(20)
+    assert 'idx_chatmessage_chat_id_e8bf98' in await get_used_indexes(qs)
+
+
+async def test_list_own_chats_index(seeded_db):
+    user, __, __ = seeded_db
+    qs = Chat.filter(creator=user).order_by('-created_at').limit(20)
+    assert 'idx_chat_creator_29baa5' in await get_used_indexes(qs)
+
+
+async def test_chat_title_unique_index(seeded_db):
+    user, chat, __ = seeded_db
+    qs = Chat.filter(creator=user, title=chat.title)
+    assert 'uid_chat_creator_8784b5' in await get_used_indexes(qs)
+
+
+async def test_list_joined_chats_index(seeded_db):
+    user, __, __ = seeded_db
+    qs = Chat.filter(participants=user).order_by('title').limit(20)
+    assert 'idx_chat_user_user_id_chat_id' in await get_used_indexes(qs)
+
+
+async def test_chat_participant_unique_index(seeded_db):
+    user, __, joined_chat = seeded_db
+    qs = Chat.filter(id=joined_chat.id, participants=user)
+    # either index has both columns, for the same cost
+    assert {'uid_chat_user_chat_id_user_id', 'idx_chat_user_user_id_chat_id'} & await get_used_indexes(qs)
@@ -0,0 +1,77 @@
+import pytest
+from tortoise.exceptions import DoesNotExist
+
+from chatrooms.apps.chats import services as chat_services
+from chatrooms.apps.chats.access import chat_access_cache
+from chatrooms.apps.chats.models import MESSAGES_CLOCK_SKEW, Chat
+from chatrooms.apps.chats.tests.factories import ChatFactory, ChatMessageFactory
+from chatrooms.apps.users.tests.factories import UserFactory
+
+
+async def test_available_to_user(user):
+    own_chat = await ChatFactory(creator=user)
+    joined_chat = await ChatFactory()
+    await joined_chat.participants.add(user, await UserFactory())
+    await ChatFactory()
+
+    chats = await Chat.available_to_user(user).order_by('created_at')
+    assert [chat.id for chat in chats] == [own_chat.id, joined_chat.id]
+
+
+async def test_get_accessible(user, mocker):
+    chat = await ChatFactory()
+    with pytest.raises(DoesNotExist):
+        await Chat.get_accessible(chat.id, user)
+    assert chat_access_cache.get(chat.id, user.id) is False
+
+    # the denied access is taken from the cache
+    mocker.patch.object(Chat, 'available_to_user', side_effect=AssertionError)
+    with pytest.raises(DoesNotExist):
+        await Chat.get_accessible(chat.id, user)
+    mocker.stopall()
+
+    await chat_services.join_chat(chat, user)
+    assert chat_access_cache.get(chat.id, user.id) is None
+
+    accessible_chat = await Chat.get_accessible(chat.id, user, 'creator')
+    assert accessible_chat.id == chat.id
+    assert accessible_chat.creator.id == chat.creator_id
+    assert chat_access_cache.get(chat.id, user.id) is True
+
+
+async def test_get_accessible_deleted_chat(user):
+    chat = await ChatFactory(creator=user)
+    await Chat.get_accessible(chat.id, user)
+    assert chat_access_cache.get(chat.id, user.id) is True
+
+    await chat_services.delete_chat(chat, user)
+    assert chat_access_cache.get(chat.id, user.id) is None
+    with pytest.raises(DoesNotExist):
+        await Chat.get_accessible(chat.id, user)
+
+
+async def test_get_accessible_connection(user, mocker):
+    chat = await ChatFactory(creator=user)
+    replica = mocker.Mock()
+
+    # the access is checked on the primary, the replica is not used until it's cached
+    accessible_chat = await Chat.get_accessible(chat.id, user, connection=replica)
+    assert accessible_chat.id == chat.id
+    assert not replica.method_calls
+
+    with pytest.raises(TypeError):  # the mock can't run the query
+        await Chat.get_accessible(chat.id, user, connection=replica)
+    assert replica.method_calls
+
+
+async def test_get_messages_bound():
+    chat = await ChatFactory()
+    message = await ChatMessageFactory(chat=chat)
+    other_message = await ChatMessageFactory()
+
+    after = await chat.get_messages_bound(message.id, after=True)
+    assert after.filters == {'created_at__gte': message.created_at - MESSAGES_CLOCK_SKEW}
+    assert await chat.get_messages().filter(after).count() == 1
+    before = await chat.get_messages_bound(message.id, after=False)
+    assert before.filters == {'created_at__lte': message.created_at + MESSAGES_CLOCK_SKEW}
+    assert not (await chat.get_messages_bound(other_message.id, after=True)).filters
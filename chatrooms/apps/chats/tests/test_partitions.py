@@ -0,0 +1,134 @@
+from datetime import datetime, timedelta, timezone
+import json
+from pathlib import Path
+from typing import Iterator
+
+from aerich.utils import get_version_content_from_file
+import pytest
+from tortoise.transactions import in_transaction
+
+from chatrooms.apps.chats import partitions
+from chatrooms.apps.chats.models import ChatMessage
+from chatrooms.apps.chats.sink import ChatMessageSink
+from chatrooms.apps.chats.tests.factories import ChatFactory, ChatMessageFactory
+
+
+MIGRATIONS_PATH = Path(__file__).parents[3] / 'migrations' / 'models'
+SEARCH_MIGRATION_PATH = MIGRATIONS_PATH / '4_20261017151205_add_chat_message_search.sql'
+PARTITION_MIGRATION_PATH = MIGRATIONS_PATH / '6_20261017204512_partition_chat_messages.sql'
+
+NOW = datetime(2026, 10, 17, 12, tzinfo=timezone.utc)
+
+
+async def apply_migration(path: Path, direction: str = 'upgrade') -> None:
+    connection = ChatMessage._meta.db
+    for statement in get_version_content_from_file(path)[direction]:
+        await connection.execute_script(statement)
+
+
+async def get_partition_of(message_id: int) -> str:
+    rows = await ChatMessage._meta.db.execute_query_dict(
+        'SELECT "tableoid"::REGCLASS::TEXT AS "partition" FROM "chatmessage" WHERE "id" = $1', [message_id],
+    )
+    return rows[0]['partition']
+
+
+def iter_relation_names(plan: dict) -> Iterator[str]:
+    if 'Relation Name' in plan:
+        yield plan['Relation Name']
+    for subplan in plan.get('Plans', []):
+        yield from iter_relation_names(subplan)
+
+
+@pytest.fixture
+async def partitioned_db():
+    await apply_migration(SEARCH_MIGRATION_PATH)
+    await apply_migration(PARTITION_MIGRATION_PATH)
+
+
+async def test_migration_keeps_messages(user):
+    message = await ChatMessageFactory(author=user)
+    await apply_migration(SEARCH_MIGRATION_PATH)
+    await apply_migration(PARTITION_MIGRATION_PATH)
+
+    assert await partitions.is_partitioned()
+    assert await get_partition_of(message.id) == partitions.LEGACY_PARTITION
+    new_message = await ChatMessageFactory(chat=message.chat, author=user)
+    assert new_message.id > message.id
+    assert await get_partition_of(new_message.id) == partitions.LEGACY_PARTITION
+
+    await apply_migration(PARTITION_MIGRATION_PATH, 'downgrade')
+    assert not await partitions.is_partitioned()
+    assert await ChatMessage.filter(chat=message.chat).count() == 2
+
+
+async def test_maintain_partitions(partitioned_db, user):
+    old_message = await ChatMessageFactory(author=user, created_at=datetime(2024, 1, 1, tzinfo=timezone.utc))
+
+    changes = await partitions.maintain_partitions(NOW, months_ahead=2)
+    assert changes == {
+        'bounded': ['chatmessage_legacy'],
+        'created': ['chatmessage_p2026_11', 'chatmessage_p2026_12'],
+        'dropped': [],
+    }
+    assert [(partition.name, partition.start, partition.end) for partition in await partitions.get_partitions()] == [
+        ('chatmessage_legacy', None, datetime(2026, 11, 1, tzinfo=timezone.utc)),
+        ('chatmessage_p2026_11', datetime(2026, 11, 1, tzinfo=timezone.utc), datetime(2026, 12, 1, tzinfo=timezone.utc)),
+        ('chatmessage_p2026_12', datetime(2026, 12, 1, tzinfo=timezone.utc), datetime(2027, 1, 1, tzinfo=timezone.utc)),
+        ('chatmessage_default', None, None),
+    ]
+    assert await get_partition_of(old_message.id) == 'chatmessage_legacy'
+    message = await ChatMessageFactory(author=user, created_at=datetime(2026, 11, 2, tzinfo=timezone.utc))
+    assert await get_partition_of(message.id) == 'chatmessage_p2026_11'
+
+    assert await partitions.maintain_partitions(NOW, months_ahead=2) == {'bounded': [], 'created': [], 'dropped': []}
+
+
+async def test_maintain_partitions_moves_default_messages(partitioned_db, user):
+    await partitions.maintain_partitions(NOW, months_ahead=0)
+    message = await ChatMessageFactory(author=user, created_at=datetime(2027, 1, 2, tzinfo=timezone.utc))
+    assert await get_partition_of(message.id) == 'chatmessage_default'
+
+    # the command didn't run for a while
+    changes = await partitions.maintain_partitions(datetime(2027, 1, 1, tzinfo=timezone.utc), months_ahead=0)
+    assert changes['created'] == ['chatmessage_p2026_11', 'chatmessage_p2026_12', 'chatmessage_p2027_01']
+    assert await get_partition_of(message.id) == 'chatmessage_p2027_01'
+    assert await ChatMessage.get(id=message.id)
+
+
+async def test_maintain_partitions_drops_old_ones(partitioned_db, user):
+    await partitions.maintain_partitions(NOW, months_ahead=1)
+    message = await ChatMessageFactory(author=user, created_at=datetime(2026, 11, 2, tzinfo=timezone.utc))
+
+    changes = await partitions.maintain_partitions(datetime(2027, 1, 1, tzinfo=timezone.utc), 1, retention_months=1)
+    assert changes['dropped'] == ['chatmessage_legacy', 'chatmessage_p2026_11']
+    assert not await ChatMessage.filter(id=message.id).exists()
+
+
+async def test_maintain_partitions_not_partitioned():
+    with pytest.raises(RuntimeError):
+        await partitions.maintain_partitions(NOW, months_ahead=1)
+
+
+async def test_sink_writes_partitioned(partitioned_db, user):
+    await partitions.maintain_partitions(datetime.now(timezone.utc), months_ahead=1)
+    chat = await ChatFactory()
+    sink = ChatMessageSink(batch_size=3, flush_interval=0, max_pending=5)
+
+    message = await sink.add(text="message", chat=chat, author=user)
+    await sink.close()
+    assert (await ChatMessage.get(id=message.id)).text == "message"
+
+
+async def test_chat_messages_pruned(partitioned_db, user):
+    await partitions.maintain_partitions(NOW - timedelta(days=90), months_ahead=4)
+    chat = await ChatFactory(created_at=NOW)
+    await ChatMessageFactory(chat=chat, author=user, created_at=NOW)
+
+    # the search index is on every partition, so the messages index must be forced
+    async with in_transaction('models') as connection:
+        await connection.execute_script('SET LOCAL enable_seqscan = off; SET LOCAL enable_bitmapscan = off')
+        plan = await chat.get_messages().order_by('-id').limit(20).using_db(connection).explain()
+    assert set(iter_relation_names(json.loads(plan[0]['QUERY PLAN'])[0]['Plan'])) == {
+        'chatmessage_p2026_10', 'chatmessage_p2026_11', 'chatmessage_default',
+    }
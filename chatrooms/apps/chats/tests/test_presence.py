@@ -0,0 +1,131 @@
+import asyncio
+from uuid import uuid4
+
+import pytest
+
+from chatrooms.apps.chats.presence import ChatPresence
+from chatrooms.apps.common.broadcast import MemoryBroadcast
+
+
+class Worker:
+
+    def __init__(self, broadcast: MemoryBroadcast):
+        self.diffs = []
+        self.presence = ChatPresence(
+            broadcast, send=lambda chat_id, diff: self.diffs.append((chat_id, diff.dict())),
+            interval=10, typing_debounce=3,
+        )
+
+
+@pytest.fixture
+async def workers():
+    broadcast = MemoryBroadcast()
+    workers = [Worker(broadcast), Worker(broadcast)]
+    yield workers
+    for worker in workers:
+        await worker.presence.close()
+
+
+async def test_changes_coalesced(workers):
+    worker, other_worker = workers
+    chat_id = uuid4()
+    worker.presence.connect(chat_id, 1)
+    worker.presence.connect(chat_id, 2)
+    worker.presence.disconnect(chat_id, 2)
+    assert worker.presence.get_online(chat_id) == [1]
+    assert other_worker.presence.get_online(chat_id) == []
+
+    await worker.presence.flush()
+    assert worker.diffs == other_worker.diffs == [(chat_id, {'online': [1], 'offline': [], 'typing': []})]
+    assert other_worker.presence.get_online(chat_id) == [1]
+
+    worker.presence.disconnect(chat_id, 1)
+    worker.presence.connect(chat_id, 1)
+    await worker.presence.flush()
+    assert len(other_worker.diffs) == 1
+
+    worker.presence.disconnect(chat_id, 1)
+    await worker.presence.flush()
+    assert other_worker.diffs[-1] == (chat_id, {'online': [], 'offline': [1], 'typing': []})
+    assert other_worker.presence.get_online(chat_id) == []
+
+
+async def test_online_at_several_workers(workers):
+    worker, other_worker = workers
+    chat_id = uuid4()
+    worker.presence.connect(chat_id, 1)
+    other_worker.presence.connect(chat_id, 1)
+    await worker.presence.flush()
+    await other_worker.presence.flush()
+    assert worker.diffs == [(chat_id, {'online': [1], 'offline': [], 'typing': []})]
+
+    worker.presence.disconnect(chat_id, 1)
+    await worker.presence.flush()
+    assert len(worker.diffs) == 1
+    assert worker.presence.get_online(chat_id) == [1]
+
+    other_worker.presence.disconnect(chat_id, 1)
+    await other_worker.presence.flush()
+    assert worker.diffs[-1] == (chat_id, {'online': [], 'offline': [1], 'typing': []})
+
+
+async def test_new_worker_synced(workers):
+    worker, other_worker = workers
+    chat_id = uuid4()
+    worker.presence.connect(chat_id, 1)
+    await worker.presence.flush()
+
+    # started after the user came online
+    new_worker = Worker(worker.presence._broadcast)
+    new_worker.presence.connect(chat_id, 2)
+    assert new_worker.presence.get_online(chat_id) == [2]
+    await new_worker.presence.flush()
+    await worker.presence.flush()
+    assert new_worker.presence.get_online(chat_id) == [1, 2]
+    assert new_worker.diffs[-1] == (chat_id, {'online': [1], 'offline': [], 'typing': []})
+    assert other_worker.presence.get_online(chat_id) == [1, 2]
+    assert len(other_worker.diffs) == 2
+    await new_worker.presence.close()
+
+
+async def test_typing_debounced(workers, mocker):
+    monotonic_mock = mocker.patch('time.monotonic', return_value=100)
+    worker, other_worker = workers
+    chat_id = uuid4()
+    worker.presence.connect(chat_id, 1)
+    await worker.presence.flush()
+
+    worker.presence.typing(chat_id, 1)
+    worker.presence.typing(chat_id, 1)
+    await worker.presence.flush()
+    monotonic_mock.return_value = 102
+    worker.presence.typing(chat_id, 1)
+    await worker.presence.flush()
+    assert other_worker.diffs[1:] == [(chat_id, {'online': [], 'offline': [], 'typing': [1]})]
+
+    monotonic_mock.return_value = 103
+    worker.presence.typing(chat_id, 1)
+    await worker.presence.flush()
+    assert len(other_worker.diffs) == 3
+
+
+async def test_published_periodically(mocker):
+    presence = ChatPresence(MemoryBroadcast(), send=mocker.Mock(), interval=0.05, typing_debounce=3)
+    chat_id = uuid4()
+    presence.connect(chat_id, 1)
+    presence.connect(chat_id, 2)
+    await asyncio.sleep(0.1)
+    presence._send.assert_called_once()
+    assert presence._send.call_args[0][1].online == [1, 2]
+    await presence.close()
+
+
+async def test_diff_chunked(workers, mocker):
+    worker, other_worker = workers
+    mocker.patch.object(ChatPresence, 'CHUNK_SIZE', 2)
+    chat_id = uuid4()
+    for user_id in range(3):
+        worker.presence.connect(chat_id, user_id)
+    await worker.presence.flush()
+    assert [diff['online'] for __, diff in other_worker.diffs] == [[0, 1], [2]]
+    assert other_worker.presence.get_online(chat_id) == [0, 1, 2]
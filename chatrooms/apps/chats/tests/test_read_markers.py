@@ -0,0 +1,141 @@
+import asyncio
+from datetime import timedelta
+from uuid import uuid4
+
+import pytest
+
+from chatrooms.apps.chats.models import MESSAGES_CLOCK_SKEW, Chat, ChatReadMarker
+from chatrooms.apps.chats.read_markers import ChatReadMarkers
+from chatrooms.apps.chats.tests.factories import ChatFactory, ChatMessageFactory
+
+
+@pytest.fixture
+async def read_markers():
+    read_markers = ChatReadMarkers(batch_size=3, flush_interval=10)
+    yield read_markers
+    await read_markers.close()
+
+
+async def test_mark(read_markers, user):
+    chat = await ChatFactory()
+    messages = [await ChatMessageFactory(chat=chat) for __ in range(3)]
+
+    read_markers.mark(chat.id, user.id, messages[0].id)
+    read_markers.mark(chat.id, user.id, messages[2].id)
+    read_markers.mark(chat.id, user.id, messages[1].id)
+    assert read_markers.get_pending(user.id) == {chat.id: messages[2].id}
+    assert not await ChatReadMarker.filter(chat=chat).exists()
+
+    await read_markers.flush()
+    assert read_markers.get_pending(user.id) == {}
+    marker = await ChatReadMarker.get(chat=chat, user=user)
+    assert marker.last_read_id == messages[2].id
+
+    # an older marker, e.g. from another worker, doesn't move it back
+    read_markers.mark(chat.id, user.id, messages[0].id)
+    await read_markers.flush()
+    marker = await ChatReadMarker.get(chat=chat, user=user)
+    assert marker.last_read_id == messages[2].id
+
+
+async def test_mark_clamps_to_latest_message(read_markers, user):
+    chat, empty_chat = await ChatFactory(), await ChatFactory()
+    message = await ChatMessageFactory(chat=chat)
+
+    read_markers.mark(chat.id, user.id, message.id + 100)
+    read_markers.mark(empty_chat.id, user.id, 100)
+    await read_markers.flush()
+    assert (await ChatReadMarker.get(chat=chat, user=user)).last_read_id == message.id
+    assert (await ChatReadMarker.get(chat=empty_chat, user=user)).last_read_id == 0
+
+
+async def test_mark_flushes_full_batch(read_markers, user):
+    chats = [await ChatFactory() for __ in range(3)]
+
+    for chat in chats:
+        message = await ChatMessageFactory(chat=chat)
+        read_markers.mark(chat.id, user.id, message.id - 1)
+        read_markers.mark(chat.id, user.id, message.id)
+    await asyncio.sleep(0.1)
+    assert await ChatReadMarker.filter(user=user).count() == 3
+
+
+async def test_close_during_write(user, mocker):
+    read_markers = ChatReadMarkers(batch_size=1, flush_interval=0)
+    chats = [await ChatFactory() for __ in range(2)]
+    messages = [await ChatMessageFactory(chat=chat) for chat in chats]
+    write = ChatReadMarkers._write
+    writing, resume = asyncio.Event(), asyncio.Event()
+
+    async def blocked_write(markers):
+        writing.set()
+        await resume.wait()
+        await write(markers)
+
+    mocker.patch.object(ChatReadMarkers, '_write', staticmethod(blocked_write))
+    read_markers.mark(chats[0].id, user.id, messages[0].id)
+    read_markers.mark(chats[1].id, user.id, messages[1].id)
+    await writing.wait()
+
+    close = asyncio.create_task(read_markers.close())
+    await asyncio.sleep(0.01)
+    resume.set()
+    await asyncio.wait_for(close, timeout=1)
+    assert await ChatReadMarker.filter(user=user).count() == 2
+    assert read_markers.get_pending(user.id) == {}
+
+
+async def test_flush_skips_deleted_chat(read_markers, user):
+    chat = await ChatFactory()
+
+    read_markers.mark(uuid4(), user.id, 1)
+    read_markers.mark(chat.id, user.id, 1)
+    await read_markers.flush()
+    assert await ChatReadMarker.filter(user=user).count() == 1
+
+
+async def test_flush_drops_bad_markers(read_markers, user):
+    chats = [await ChatFactory() for __ in range(3)]
+
+    read_markers.mark(chats[0].id, user.id, 1)
+    read_markers.mark(chats[1].id, user.id, 2 ** 31)  # out of the range of the ids
+    read_markers.mark(chats[2].id, user.id + 1, 1)  # of a missing user
+    await read_markers.flush()
+    assert await ChatReadMarker.filter(user=user).count() == 1
+    assert read_markers.get_pending(user.id) == {}
+
+
+async def test_get_unread_counts(read_markers, user, mocker):
+    mocker.patch('chatrooms.apps.chats.read_markers.settings.CHAT_UNREAD_COUNT_LIMIT', 3)
+    own_chat, joined_chat, other_chat = await ChatFactory(creator=user), await ChatFactory(), await ChatFactory()
+    await joined_chat.participants.add(user)
+    own_messages = [await ChatMessageFactory(chat=own_chat) for __ in range(5)]
+    joined_messages = [await ChatMessageFactory(chat=joined_chat) for __ in range(3)]
+    await ChatMessageFactory(chat=other_chat)
+    await ChatReadMarker.create(chat=joined_chat, user=user, last_read_id=joined_messages[0].id)
+
+    counts = {row['chat_id']: row for row in await read_markers.get_unread_counts(user.id)}
+    assert set(counts) == {own_chat.id, joined_chat.id}
+    assert counts[own_chat.id]['last_read_id'] == 0
+    assert counts[own_chat.id]['unread_count'] == 3
+    assert counts[joined_chat.id]['last_read_id'] == joined_messages[0].id
+    assert counts[joined_chat.id]['unread_count'] == 2
+
+    # the pending markers are counted before they are written
+    read_markers.mark(own_chat.id, user.id, own_messages[3].id)
+    read_markers.mark(joined_chat.id, user.id, joined_messages[0].id - 1)
+    counts = {row['chat_id']: row for row in await read_markers.get_unread_counts(user.id)}
+    assert counts[own_chat.id]['last_read_id'] == own_messages[3].id
+    assert counts[own_chat.id]['unread_count'] == 1
+    assert counts[joined_chat.id]['last_read_id'] == joined_messages[0].id
+    assert counts[joined_chat.id]['unread_count'] == 2
+
+
+async def test_get_unread_counts_skips_messages_older_than_chat(read_markers, user):
+    chat = await ChatFactory(creator=user)
+    await ChatMessageFactory(chat=chat)
+    # the messages are then older than the chat, past the clock skew allowed
+    await Chat.filter(id=chat.id).update(created_at=chat.created_at + MESSAGES_CLOCK_SKEW + timedelta(minutes=1))
+
+    counts = await read_markers.get_unread_counts(user.id)
+    assert [row['unread_count'] for row in counts] == [0]
@@ -0,0 +1,102 @@
+import json
+
+import pytest
+
+from chatrooms.apps.chats.recent_messages import RecentMessagesCache
+from chatrooms.apps.chats.schemas import ChatMessageDetail
+from chatrooms.apps.chats.tests.factories import ChatFactory, ChatMessageFactory
+from chatrooms.apps.common.broadcast import MemoryBroadcast
+
+
+@pytest.fixture
+def cache():
+    return RecentMessagesCache(MemoryBroadcast(), size=5, max_bytes=10000)
+
+
+def get_ids(latest_messages):
+    return [json.loads(payload)['id'] for payload in latest_messages.payloads]
+
+
+async def test_get_latest(cache):
+    chat = await ChatFactory()
+    messages = await ChatMessageFactory.create_batch(size=7, chat=chat)
+
+    latest_messages = await cache.get_latest(chat, limit=3)
+    assert latest_messages.ids == [message.id for message in messages[:3:-1]]
+    assert get_ids(latest_messages) == latest_messages.ids
+    assert latest_messages.count == 7
+    assert json.loads(latest_messages.payloads[0]) == json.loads(ChatMessageDetail.from_orm(messages[-1]).json())
+
+    assert await cache.get_latest(chat, limit=6) is None
+
+
+async def test_add(cache):
+    chat = await ChatFactory()
+    messages = await ChatMessageFactory.create_batch(size=5, chat=chat)
+    await cache.get_latest(chat, limit=5)
+
+    new_message = ChatMessageDetail.from_orm(await ChatMessageFactory(chat=chat))
+    await cache.add(chat.id, new_message)
+    latest_messages = await cache.get_latest(chat, limit=5)
+    assert latest_messages.ids == [new_message.id, *(message.id for message in messages[:0:-1])]
+    assert latest_messages.count == 6
+
+    # older than the kept messages, e.g. sent through another worker
+    old_message = ChatMessageDetail.from_orm(messages[0])
+    old_message.id = messages[0].id - 1
+    await cache.add(chat.id, old_message)
+    latest_messages = await cache.get_latest(chat, limit=5)
+    assert latest_messages.ids[-1] == messages[1].id
+    assert latest_messages.count == 7
+
+
+async def test_add_before_load(cache):
+    chat = await ChatFactory()
+    message = await ChatMessageFactory(chat=chat)
+    pending_message = ChatMessageDetail.from_orm(message)
+    pending_message.id = message.id + 1000  # not in the database yet
+    await cache.add(chat.id, pending_message)
+
+    latest_messages = await cache.get_latest(chat, limit=5)
+    assert latest_messages.ids == [pending_message.id, message.id]
+    assert latest_messages.count == 2
+
+
+async def test_delete(cache):
+    chat = await ChatFactory()
+    message1, message2 = await ChatMessageFactory.create_batch(size=2, chat=chat)
+    await cache.delete(chat.id, message1.id)  # not loaded yet
+    await cache.get_latest(chat, limit=5)
+    await cache.delete(chat.id, message2.id)
+
+    latest_messages = await cache.get_latest(chat, limit=5)
+    assert [json.loads(payload)['is_deleted'] for payload in latest_messages.payloads] == [True, False]
+    assert json.loads(latest_messages.payloads[0])['text'] == ''
+    assert latest_messages.count == 2
+
+
+async def test_discard_chat(cache):
+    chat = await ChatFactory()
+    await cache.get_latest(chat, limit=5)
+    message = await ChatMessageFactory(chat=chat)
+
+    await cache.discard_chat(chat.id)
+    latest_messages = await cache.get_latest(chat, limit=5)
+    assert latest_messages.ids == [message.id]
+
+
+async def test_eviction():
+    cache = RecentMessagesCache(MemoryBroadcast(), size=5, max_bytes=1)
+    chat1, chat2 = await ChatFactory(), await ChatFactory()
+    await ChatMessageFactory(chat=chat1)
+    await ChatMessageFactory(chat=chat2)
+
+    await cache.get_latest(chat1, limit=5)
+    await cache.get_latest(chat2, limit=5)
+    assert list(cache._chats) == [chat2.id]
+
+
+async def test_disabled():
+    cache = RecentMessagesCache(MemoryBroadcast(), size=0, max_bytes=10000)
+    chat = await ChatFactory()
+    assert await cache.get_latest(chat, limit=5) is None
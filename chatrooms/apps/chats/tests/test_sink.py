@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+
+from chatrooms.apps.chats.models import ChatMessage
+from chatrooms.apps.chats.sink import ChatMessageSink
+from chatrooms.apps.chats.tests.factories import ChatFactory
+
+
+@pytest.fixture
+async def sink():
+    sink = ChatMessageSink(batch_size=3, flush_interval=10, max_pending=5)
+    yield sink
+    await sink.close()
+
+
+async def test_add(sink, user):
+    chat = await ChatFactory()
+
+    add1 = asyncio.create_task(sink.add(text="first", chat=chat, author=user))
+    add2 = asyncio.create_task(sink.add(text="second", chat=chat, author=user))
+    await asyncio.sleep(0.01)
+    assert not add1.done()
+    assert not await ChatMessage.filter(chat=chat).exists()
+
+    await sink.flush()
+    message1, message2 = await add1, await add2
+    assert message1.id < message2.id
+    saved_message = await ChatMessage.get(id=message1.id)
+    assert saved_message.text == "first"
+    assert saved_message.author_id == user.id
+    assert saved_message.created_at == message1.created_at
+
+
+async def test_add_writes_full_batch(sink, user):
+    chat = await ChatFactory()
+
+    messages = await asyncio.wait_for(
+        asyncio.gather(*(sink.add(text=f"message {i}", chat=chat, author=user) for i in range(3))), timeout=1,
+    )
+    assert [message.text for message in messages] == ["message 0", "message 1", "message 2"]
+    assert await ChatMessage.filter(chat=chat).count() == 3
+
+
+async def test_add_writes_after_interval(user):
+    sink = ChatMessageSink(batch_size=3, flush_interval=0, max_pending=5)
+    chat = await ChatFactory()
+
+    message = await asyncio.wait_for(sink.add(text="message", chat=chat, author=user), timeout=1)
+    assert await ChatMessage.filter(id=message.id).exists()
+    await sink.close()
+
+
+async def test_add_ids_follow_posting_order(user):
+    # the sinks of two workers
+    sink1 = ChatMessageSink(batch_size=3, flush_interval=0, max_pending=5)
+    sink2 = ChatMessageSink(batch_size=3, flush_interval=0, max_pending=5)
+    chat = await ChatFactory()
+
+    message1 = await sink1.add(text="first", chat=chat, author=user)
+    message2 = await sink2.add(text="second", chat=chat, author=user)
+    message3 = await sink1.add(text="third", chat=chat, author=user)
+    assert message1.id < message2.id < message3.id
+    await sink1.close()
+    await sink2.close()
+
+
+async def test_add_waits_for_pending_slot(user):
+    sink = ChatMessageSink(batch_size=3, flush_interval=10, max_pending=1)
+    chat = await ChatFactory()
+
+    add1 = asyncio.create_task(sink.add(text="first", chat=chat, author=user))
+    await asyncio.sleep(0)
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(sink.add(text="second", chat=chat, author=user), timeout=0.05)
+
+    await sink.flush()
+    await add1
+    add2 = asyncio.create_task(sink.add(text="second", chat=chat, author=user))
+    await asyncio.sleep(0)
+    await sink.close()
+    await add2
+    assert await ChatMessage.filter(chat=chat).count() == 2
+
+
+async def test_close_during_write(user, mocker):
+    sink = ChatMessageSink(batch_size=3, flush_interval=0, max_pending=5)
+    chat = await ChatFactory()
+    insert = ChatMessageSink._insert
+    inserting, resume = asyncio.Event(), asyncio.Event()
+
+    async def blocked_insert(messages):
+        inserting.set()
+        await resume.wait()
+        await insert(messages)
+
+    mocker.patch.object(ChatMessageSink, '_insert', blocked_insert)
+    add1 = asyncio.create_task(sink.add(text="first", chat=chat, author=user))
+    await inserting.wait()
+    add2 = asyncio.create_task(sink.add(text="second", chat=chat, author=user))
+    await asyncio.sleep(0)
+
+    close = asyncio.create_task(sink.close())
+    await asyncio.sleep(0.01)
+    resume.set()
+    await asyncio.wait_for(close, timeout=1)
+    message1, message2 = await asyncio.wait_for(asyncio.gather(add1, add2), timeout=1)
+    assert message1.id < message2.id
+    assert await ChatMessage.filter(chat=chat).count() == 2
+
+
+async def test_discard_chat(sink, user):
+    chat = await ChatFactory()
+    other_chat = await ChatFactory()
+
+    add = asyncio.create_task(sink.add(text="message", chat=chat, author=user))
+    other_add = asyncio.create_task(sink.add(text="other message", chat=other_chat, author=user))
+    await asyncio.sleep(0)
+    sink.discard_chat(chat.id)
+    await sink.flush()
+    assert await add is None
+    assert not await ChatMessage.filter(chat=chat).exists()
+    assert await ChatMessage.filter(id=(await other_add).id).exists()
+
+
+async def test_flush_skips_messages_of_deleted_chat(sink, user):
+    chat = await ChatFactory()
+    other_chat = await ChatFactory()
+
+    add = asyncio.create_task(sink.add(text="message", chat=chat, author=user))
+    other_add = asyncio.create_task(sink.add(text="other message", chat=other_chat, author=user))
+    await asyncio.sleep(0)
+    await chat.delete()
+    await sink.flush()
+    assert await add is None
+    assert await ChatMessage.all().count() == 1
+    assert await ChatMessage.filter(id=(await other_add).id).exists()
@@ -0,0 +1,393 @@
+import asyncio
+import json
+from uuid import uuid4
+
+from fastapi import status
+import pytest
+from uvicorn.server import ServerState
+
+from chatrooms.apps.chats.frames import JSON_ENCODING, negotiate_encoding
+from chatrooms.apps.chats.websockets import (
+    ChatRate, ChatsConnectionManager, chats_connections, get_chats_by_connections, get_new_message_id,
+)
+from chatrooms.apps.common.broadcast import MemoryBroadcast
+from chatrooms.config import settings
+from chatrooms.config.server import ChatWebSocketProtocol, get_config
+from main import app
+
+
+class FakeWebSocket:
+
+    def __init__(self, send_delay: float = 0):
+        self.sent = []
+        self.close_code = None
+        self.send_delay = send_delay
+
+    async def send_text(self, data: str):
+        await asyncio.sleep(self.send_delay)
+        self.sent.append(data)
+
+    async def send_bytes(self, data: bytes):
+        await asyncio.sleep(self.send_delay)
+        self.sent.append(data)
+
+    async def close(self, code: int):
+        self.close_code = code
+
+
+def remove_connections(*managers: ChatsConnectionManager):
+    for manager in managers:
+        for chat_id, users_connections in list(manager._chats_users_connections.items()):
+            for user_id, user_connections in list(users_connections.items()):
+                for connection in list(user_connections):
+                    manager.remove_connection(chat_id, user_id, connection)
+        manager.presence.clear()
+
+
+async def test_send_chat_message_across_managers():
+    broker = MemoryBroadcast()  # stands in for the cross-process backend shared by two workers
+    manager1 = ChatsConnectionManager(broker)
+    manager2 = ChatsConnectionManager(broker)
+
+    chat_id = uuid4()
+    ws1, ws2, other_chat_ws = FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+    manager1.add_connection(chat_id, 1, ws1)
+    manager2.add_connection(chat_id, 2, ws2)
+    manager2.add_connection(uuid4(), 2, other_chat_ws)
+
+    await manager1.send_chat_message(chat_id, '{"event": "new_message"}')
+    await asyncio.sleep(0.01)
+    assert ws1.sent == ['{"event": "new_message"}']
+    assert ws2.sent == ['{"event": "new_message"}']
+    assert other_chat_ws.sent == []
+    remove_connections(manager1, manager2)
+
+
+async def test_disconnect_chat_across_managers():
+    broker = MemoryBroadcast()
+    manager1 = ChatsConnectionManager(broker)
+    manager2 = ChatsConnectionManager(broker)
+
+    chat_id = uuid4()
+    ws1, ws2 = FakeWebSocket(), FakeWebSocket()
+    manager1.add_connection(chat_id, 1, ws1)
+    manager2.add_connection(chat_id, 2, ws2)
+
+    await manager2.disconnect_chat(chat_id, error_code=status.WS_1011_INTERNAL_ERROR)
+    assert ws1.close_code == status.WS_1011_INTERNAL_ERROR
+    assert ws2.close_code == status.WS_1011_INTERNAL_ERROR
+    remove_connections(manager1, manager2)
+
+
+async def test_disconnect_chat_users_across_managers(mocker):
+    mocker.patch.object(ChatsConnectionManager, 'CLOSE_USERS_CHUNK_SIZE', 2)
+    broker = MemoryBroadcast()
+    manager1 = ChatsConnectionManager(broker)
+    manager2 = ChatsConnectionManager(broker)
+
+    chat_id = uuid4()
+    ws1, ws2, ws3, other_chat_ws = FakeWebSocket(), FakeWebSocket(), FakeWebSocket(), FakeWebSocket()
+    manager1.add_connection(chat_id, 1, ws1)
+    manager2.add_connection(chat_id, 2, ws2)
+    manager2.add_connection(chat_id, 3, ws3)
+    manager1.add_connection(uuid4(), 1, other_chat_ws)
+
+    await manager2.disconnect_chat_users(chat_id, [1, 3, 4], error_code=status.WS_1008_POLICY_VIOLATION)
+    assert ws1.close_code == status.WS_1008_POLICY_VIOLATION
+    assert ws3.close_code == status.WS_1008_POLICY_VIOLATION
+    assert ws2.close_code is None
+    assert other_chat_ws.close_code is None
+    remove_connections(manager1, manager2)
+
+
+async def test_send_chat_message_no_connections():
+    manager = ChatsConnectionManager(MemoryBroadcast())
+    await manager.send_chat_message(uuid4(), 'text')
+    assert not manager._chats_users_connections
+
+
+async def test_send_chat_message_slow_connection():
+    manager = ChatsConnectionManager(MemoryBroadcast(), send_queue_size=10)
+
+    chat_id = uuid4()
+    slow_ws, fast_ws = FakeWebSocket(send_delay=10), FakeWebSocket()
+    slow_connection = manager.add_connection(chat_id, 1, slow_ws)
+    manager.add_connection(chat_id, 2, fast_ws)
+
+    await asyncio.wait_for(manager.send_chat_message(chat_id, 'first'), timeout=0.1)
+    await asyncio.wait_for(manager.send_chat_message(chat_id, 'second'), timeout=0.1)
+    await asyncio.sleep(0.01)
+    assert fast_ws.sent == ['first', 'second']
+    assert slow_ws.sent == []
+    assert slow_connection.queue_size == 1  # the first one is being sent
+
+    stats = manager.get_send_queue_stats()
+    assert stats['connections'] == 2
+    assert stats['queued_messages'] == 1
+    assert stats['max_queue_size'] == 1
+    remove_connections(manager)
+
+
+async def test_send_chat_message_queue_overflow_drop_oldest():
+    manager = ChatsConnectionManager(MemoryBroadcast(), send_queue_size=2, send_queue_overflow='drop_oldest')
+
+    chat_id = uuid4()
+    ws = FakeWebSocket(send_delay=0.01)
+    manager.add_connection(chat_id, 1, ws)
+
+    for message in ['first', 'second', 'third', 'fourth']:
+        await manager.send_chat_message(chat_id, message)
+    await asyncio.sleep(0.1)
+    assert ws.sent == ['first', 'third', 'fourth']
+    assert manager.get_send_queue_stats()['dropped_messages'] == 1
+    remove_connections(manager)
+
+
+async def test_send_chat_message_queue_overflow_disconnect():
+    manager = ChatsConnectionManager(
+        MemoryBroadcast(),
+        send_queue_size=2,
+        send_queue_overflow='disconnect',
+        send_queue_close_code=status.WS_1013_TRY_AGAIN_LATER,
+    )
+
+    chat_id = uuid4()
+    ws = FakeWebSocket(send_delay=0.01)
+    manager.add_connection(chat_id, 1, ws)
+
+    for message in ['first', 'second', 'third', 'fourth']:
+        await manager.send_chat_message(chat_id, message)
+    await asyncio.sleep(0.1)
+    assert ws.sent == []
+    assert ws.close_code == status.WS_1013_TRY_AGAIN_LATER
+    assert manager.get_send_queue_stats()['overflow_disconnects'] == 1
+    remove_connections(manager)
+
+
+async def test_send_queue_overflow_disconnects_once():
+    manager = ChatsConnectionManager(
+        MemoryBroadcast(),
+        send_queue_size=2,
+        send_queue_overflow='disconnect',
+        send_queue_close_code=status.WS_1013_TRY_AGAIN_LATER,
+    )
+
+    chat_id = uuid4()
+    ws = FakeWebSocket(send_delay=0.01)
+    connection = manager.add_connection(chat_id, 1, ws)
+
+    # in a single tick, before the close task runs
+    for message in ['first', 'second', 'third', 'fourth', 'fifth']:
+        connection.send(message)
+    assert connection.is_closing
+    await asyncio.sleep(0.05)
+    assert ws.close_code == status.WS_1013_TRY_AGAIN_LATER
+    assert manager.get_send_queue_stats()['overflow_disconnects'] == 1
+    remove_connections(manager)
+
+
+async def test_held_connection():
+    manager = ChatsConnectionManager(MemoryBroadcast())
+
+    chat_id = uuid4()
+    ws = FakeWebSocket()
+    connection = manager.add_connection(chat_id, 1, ws, held=True)
+
+    await manager.send_chat_message(chat_id, '{"event":"new_message","payload":{"id":2}}')
+    await manager.send_chat_message(chat_id, '{"event":"new_message","payload":{"id":3}}')
+    await asyncio.sleep(0.01)
+    assert ws.sent == []
+
+    await connection.send_now('{"event":"new_message","payload":{"id":1}}')
+    await connection.send_now('{"event":"new_message","payload":{"id":2}}')
+    connection.release(skip=lambda message: get_new_message_id(message) in {1, 2})
+    await asyncio.sleep(0.01)
+    assert [get_new_message_id(message) for message in ws.sent] == [1, 2, 3]
+    remove_connections(manager)
+
+
+async def test_held_connection_queue_overflow():
+    manager = ChatsConnectionManager(
+        MemoryBroadcast(),
+        send_queue_size=2,
+        send_queue_overflow='drop_oldest',
+        send_queue_close_code=status.WS_1013_TRY_AGAIN_LATER,
+    )
+
+    chat_id = uuid4()
+    ws = FakeWebSocket()
+    connection = manager.add_connection(chat_id, 1, ws, held=True)
+
+    for message in ['first', 'second', 'third']:
+        await manager.send_chat_message(chat_id, message)
+    await asyncio.sleep(0.01)
+    assert connection.is_closing
+    assert ws.close_code == status.WS_1013_TRY_AGAIN_LATER
+    assert manager.get_send_queue_stats()['dropped_messages'] == 0
+    remove_connections(manager)
+
+
+async def test_drain():
+    manager = ChatsConnectionManager(MemoryBroadcast())
+
+    chat_id = uuid4()
+    websockets = [FakeWebSocket(send_delay=0.01) for __ in range(3)]
+    for user_id, ws in enumerate(websockets):
+        manager.add_connection(chat_id, user_id, ws)
+    await manager.send_chat_message(chat_id, 'first')
+
+    started_at = asyncio.get_running_loop().time()
+    await manager.drain(batch_size=2, batch_interval=0.05, flush_timeout=1, reconnect_jitter=5)
+    assert asyncio.get_running_loop().time() - started_at >= 0.05
+    assert manager.is_draining
+    for ws in websockets:
+        assert ws.sent[0] == 'first'
+        event = json.loads(ws.sent[1])
+        assert event['event'] == 'server_restart'
+        assert 0 <= event['payload']['reconnect_after'] <= 5
+        assert ws.close_code == status.WS_1012_SERVICE_RESTART
+    remove_connections(manager)
+
+
+async def test_drain_flush_timeout():
+    manager = ChatsConnectionManager(MemoryBroadcast())
+
+    chat_id = uuid4()
+    ws = FakeWebSocket(send_delay=10)
+    manager.add_connection(chat_id, 1, ws)
+    await manager.send_chat_message(chat_id, 'first')
+
+    await asyncio.wait_for(manager.drain(flush_timeout=0.05), timeout=1)
+    assert ws.sent == []
+    assert ws.close_code == status.WS_1012_SERVICE_RESTART
+    remove_connections(manager)
+
+
+def new_message(message_id: int) -> str:
+    return f'{{"event":"new_message","payload":{{"id":{message_id}}}}}'
+
+
+async def test_batching_hot_chat():
+    manager = ChatsConnectionManager(MemoryBroadcast(), batch_hot_rate=3, batch_delay=0.01, batch_max_size=10)
+
+    chat_id = uuid4()
+    batching_ws, plain_ws = FakeWebSocket(), FakeWebSocket()
+    manager.add_connection(chat_id, 1, batching_ws, batching=True)
+    manager.add_connection(chat_id, 2, plain_ws)
+
+    for message_id in range(1, 6):
+        await manager.send_chat_message(chat_id, new_message(message_id))
+    await asyncio.sleep(0)
+    assert plain_ws.sent == [new_message(message_id) for message_id in range(1, 6)]
+    assert batching_ws.sent == [new_message(1), new_message(2)]
+
+    await asyncio.sleep(0.02)
+    assert batching_ws.sent[2:] == [f'[{new_message(3)},{new_message(4)},{new_message(5)}]']
+    assert [event['payload']['id'] for event in json.loads(batching_ws.sent[2])] == [3, 4, 5]
+    remove_connections(manager)
+
+
+async def test_batching_max_size():
+    manager = ChatsConnectionManager(MemoryBroadcast(), batch_hot_rate=1, batch_delay=10, batch_max_size=2)
+
+    chat_id = uuid4()
+    ws = FakeWebSocket()
+    manager.add_connection(chat_id, 1, ws, batching=True)
+
+    for message_id in range(1, 4):
+        await manager.send_chat_message(chat_id, new_message(message_id))
+    await asyncio.sleep(0.01)
+    assert ws.sent == [f'[{new_message(1)},{new_message(2)}]']
+
+    remove_connections(manager)
+    await asyncio.sleep(0.01)
+    assert ws.sent == [f'[{new_message(1)},{new_message(2)}]']
+
+
+async def test_batching_held_connection():
+    manager = ChatsConnectionManager(MemoryBroadcast(), batch_hot_rate=1, batch_delay=0.01)
+
+    chat_id = uuid4()
+    ws = FakeWebSocket()
+    connection = manager.add_connection(chat_id, 1, ws, held=True, batching=True)
+    for message_id in (2, 3, 4):
+        await manager.send_chat_message(chat_id, new_message(message_id))
+    await asyncio.sleep(0.02)
+    assert ws.sent == []
+
+    await connection.send_now(new_message(1))
+    await connection.send_now(new_message(2))
+    connection.release(skip=lambda message: get_new_message_id(message) in {1, 2})
+    await asyncio.sleep(0.01)
+    assert ws.sent == [new_message(1), new_message(2), f'[{new_message(3)},{new_message(4)}]']
+    remove_connections(manager)
+
+
+async def test_get_chats_by_connections():
+    chat_id, other_chat_id = uuid4(), uuid4()
+    chats_connections.add_connection(chat_id, 1, FakeWebSocket())
+    for user_id in range(2, 4):
+        chats_connections.add_connection(other_chat_id, user_id, FakeWebSocket())
+
+    assert get_chats_by_connections() == [
+        (('1.0',), 1), (('10.0',), 2), (('100.0',), 2), (('1000.0',), 2), (('+Inf',), 2),
+    ]
+    remove_connections(chats_connections)
+
+
+def test_chat_rate():
+    chat_rate = ChatRate(now=100)
+    assert [chat_rate.add(100 + i * 0.1) for i in range(5)] == [1, 2, 3, 4, 5]
+    assert chat_rate.add(102) == 5 / 2
+    assert chat_rate.add(102.5) == 5 / 2
+    assert chat_rate.add(103.5) == 2 / 1.5
+    assert chat_rate.add(200) == 1
+
+
+def test_negotiate_encoding():
+    assert negotiate_encoding([]) == (None, JSON_ENCODING)
+    assert negotiate_encoding(['unknown', 'json']) == ('json', JSON_ENCODING)
+    assert negotiate_encoding(['unknown']) == (None, JSON_ENCODING)
+
+
+async def test_send_chat_message_msgpack():
+    msgpack = pytest.importorskip('msgpack')
+    subprotocol, encoding = negotiate_encoding(['msgpack', 'json'])
+    assert subprotocol == 'msgpack'
+    manager = ChatsConnectionManager(MemoryBroadcast(), batch_hot_rate=2, batch_delay=0.01)
+
+    chat_id = uuid4()
+    websockets = [FakeWebSocket() for __ in range(4)]
+    manager.add_connection(chat_id, 1, websockets[0], encoding=encoding)
+    manager.add_connection(chat_id, 2, websockets[1], encoding=encoding, batching=True)
+    manager.add_connection(chat_id, 3, websockets[2], encoding=encoding, batching=True)
+    manager.add_connection(chat_id, 4, websockets[3], batching=True)
+
+    for message_id in range(1, 4):
+        await manager.send_chat_message(chat_id, new_message(message_id))
+    await asyncio.sleep(0.02)
+    assert [msgpack.unpackb(data) for data in websockets[0].sent] == [
+        {'event': 'new_message', 'payload': {'id': message_id}} for message_id in range(1, 4)
+    ]
+    assert [msgpack.unpackb(data) for data in websockets[1].sent] == [
+        {'event': 'new_message', 'payload': {'id': 1}},
+        [{'event': 'new_message', 'payload': {'id': message_id}} for message_id in (2, 3)],
+    ]
+    assert websockets[2].sent == websockets[1].sent
+    assert websockets[2].sent[1] is websockets[1].sent[1]  # encoded once
+    assert websockets[3].sent == [new_message(1), f'[{new_message(2)},{new_message(3)}]']
+    remove_connections(manager)
+
+
+async def test_deflate_settings(mocker):
+    mocker.patch.object(settings, 'WS_DEFLATE_MAX_WINDOW_BITS', 10)
+    protocol = ChatWebSocketProtocol(config=get_config(app), server_state=ServerState())
+    [extension_factory] = protocol.available_extensions
+    assert extension_factory.server_max_window_bits == 10
+    assert extension_factory.compress_settings == {
+        'level': settings.WS_DEFLATE_COMPRESS_LEVEL, 'memLevel': settings.WS_DEFLATE_MEMORY_LEVEL,
+    }
+
+    mocker.patch.object(settings, 'WS_PER_MESSAGE_DEFLATE', False)
+    protocol = ChatWebSocketProtocol(config=get_config(app), server_state=ServerState())
+    assert protocol.available_extensions == []
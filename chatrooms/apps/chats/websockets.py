@@ -1,19 +1,54 @@
 import asyncio
-from collections import defaultdict
+from collections import defaultdict, deque
+from dataclasses import dataclass
 from functools import partial
 import json
-from typing import Any, Dict, Set, Optional
+import random
+import time
+from typing import Any, Callable, Deque, Dict, Iterable, List, Sequence, Set, Optional, Union
 from uuid import UUID
 
 from fastapi import status, Query, WebSocket
 from pydantic import BaseModel, ValidationError
-from tortoise.exceptions import DoesNotExist
 
-from chatrooms.apps.users.models import User, Token
+from chatrooms.apps.chats.frames import JSON_ENCODING, EventEncoding, Frame
+from chatrooms.apps.chats.presence import ChatPresence
+from chatrooms.apps.chats.schemas import ChatPresenceDiff, ServerRestart
+from chatrooms.apps.common.broadcast import BroadcastBackend, broadcast
+from chatrooms.apps.common.encoders import json_dumps
+from chatrooms.apps.common.metrics import format_value, metrics
+from chatrooms.apps.users.authentication import token_cache
+from chatrooms.apps.users.models import User
+from chatrooms.config import settings
 
 
-def get_event_payload(event: str, payload: [BaseModel, ValidationError]) -> str:
-    return json.dumps({"event": event, "payload": "[PAYLOAD]"}).replace('"[PAYLOAD]"', payload.json())
+CHAT_PUBLISH_SECONDS = metrics.histogram(
+    'chat_broadcast_publish_duration_seconds', "Time spent publishing chat messages to the broadcast backend.",
+)
+CHAT_FANOUT_SECONDS = metrics.histogram(
+    'chat_fanout_duration_seconds', "Time spent queueing a chat message to the local websockets of the chat.",
+)
+CHAT_FANOUT_DELIVERIES = metrics.counter(
+    'chat_fanout_deliveries_total', "Chat messages queued to local websockets.",
+)
+CHAT_FANOUT_BATCHES = metrics.counter(
+    'chat_fanout_batches_total', "Batched frames of chat messages queued to local websockets.",
+)
+CHAT_CONNECTIONS_BUCKETS = (1, 10, 100, 1000, float('inf'))
+
+
+def encode_event(event: str, payload: Union[BaseModel, ValidationError]) -> bytes:
+    data = payload.errors() if isinstance(payload, ValidationError) else payload.dict()
+    return json_dumps({"event": event, "payload": data})
+
+
+def get_event_payload(event: str, payload: Union[BaseModel, ValidationError]) -> str:
+    return encode_event(event, payload).decode('utf-8')
+
+
+def get_new_message_id(event_payload: str) -> Optional[int]:
+    event = json.loads(event_payload)
+    return event['payload']['id'] if event['event'] == 'new_message' else None
 
 
 async def get_ws_user(websocket: WebSocket, token: Optional[str] = Query(None)) -> Optional[User]:
@@ -21,46 +56,472 @@ async def get_ws_user(websocket: WebSocket, token: Optional[str] = Query(None))
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return None
 
-    try:
-        token_obj = await Token.all().select_related('user').get(key=token)
-    except DoesNotExist:
+    user = await token_cache.get_user(token)
+    if user is None:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
         return None
 
-    return token_obj.user
+    return user
+
+
+class ChatRate:
+    """Messages per second published to a chat, counted over the last full second and the current one."""
+    __slots__ = ('window_start', 'count', 'rate')
+
+    def __init__(self, now: float):
+        self.window_start = now
+        self.count = 0
+        self.rate = 0.0
+
+    def add(self, now: float) -> float:
+        elapsed = now - self.window_start
+        if elapsed >= 1:
+            self.rate = self.count / elapsed
+            self.window_start = now
+            self.count = 0
+        self.count += 1
+        return max(self.rate, self.count)
+
+
+@dataclass
+class SendQueueStats:
+    dropped_messages: int = 0
+    overflow_disconnects: int = 0
+
+
+class ChatConnection:
+    """
+    A chat websocket with its own bounded queue of outbound frames, drained by a separate writer task,
+    so a slow client can't hold up the broadcast to the others.
+    """
+    DROP_OLDEST = 'drop_oldest'
+    DISCONNECT = 'disconnect'
+
+    websocket: WebSocket
+    max_queue_size: int
+    overflow_policy: str
+    overflow_close_code: int
+    batching: bool  # the client accepts batched frames
+    encoding: EventEncoding
+
+    _queue: Deque[Union[str, Frame]]  # JSON events or frames already encoded for the connection
+
+    def __init__(
+            self,
+            websocket: WebSocket,
+            max_queue_size: int,
+            overflow_policy: str,
+            overflow_close_code: int,
+            stats: SendQueueStats,
+            batching: bool = False,
+            encoding: EventEncoding = JSON_ENCODING,
+    ):
+        self.websocket = websocket
+        self.max_queue_size = max_queue_size
+        self.overflow_policy = overflow_policy
+        self.overflow_close_code = overflow_close_code
+        self.batching = batching
+        self.encoding = encoding
+
+        self._queue = deque()
+        self._stats = stats
+        self._has_messages = asyncio.Event()
+        self._flushed = asyncio.Event()
+        self._flushed.set()
+        self._writer: Optional[asyncio.Task] = None
+        self._closer: Optional[asyncio.Task] = None
+        self._closing = False
+        self._is_held = False
+
+    @property
+    def queue_size(self) -> int:
+        return len(self._queue)
+
+    @property
+    def is_closing(self) -> bool:
+        return self._closing
+
+    def start(self):
+        self._writer = asyncio.create_task(self._write())
+
+    def hold(self):
+        """Queues messages without sending them until `release`, while `send_now` sends older ones."""
+        self._is_held = True
+
+    def release(self, skip: Callable[[str], bool]):
+        self._is_held = False
+        queue = deque()
+        for item in self._queue:
+            if isinstance(item, Frame):
+                messages = [message for message in item.messages if not skip(message)]
+                if len(messages) == len(item.messages):
+                    queue.append(item)
+                elif messages:
+                    queue.append(self.encoding.encode(messages))
+            elif not skip(item):
+                queue.append(item)
+        self._queue = queue
+        self.start()
+        if self._queue:
+            self._has_messages.set()
+
+    async def send_now(self, message: str):
+        await self._send_frame(self.encoding.encode([message]))
+
+    async def flush(self, timeout: float) -> bool:
+        """Waits for the queued messages to be sent, for at most `timeout` seconds."""
+        try:
+            await asyncio.wait_for(self._flushed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def stop(self):
+        self._closing = True
+        self._queue.clear()
+        self._flushed.set()
+        if self._writer is not None:
+            self._writer.cancel()
+
+    def send(self, message: Union[str, Frame]):
+        """Queues a JSON event, or a frame encoded with the connection's encoding."""
+        if self._closing:
+            return
+        if self.encoding.binary and isinstance(message, str):
+            message = self.encoding.encode([message])
+
+        if len(self._queue) >= self.max_queue_size:
+            # dropping messages of a held connection would leave a gap after the ones sent meanwhile
+            if self.overflow_policy == self.DISCONNECT or self._is_held:
+                self._stats.overflow_disconnects += 1
+                self.stop()
+                self._closer = asyncio.create_task(self.close(code=self.overflow_close_code))
+                return
+            self._queue.popleft()
+            self._stats.dropped_messages += 1
+
+        self._queue.append(message)
+        self._flushed.clear()
+        self._has_messages.set()
+
+    async def close(self, code: int):
+        self.stop()
+        try:
+            await self.websocket.close(code=code)
+        except RuntimeError:  # already closed
+            pass
+
+    async def _send_frame(self, frame: Union[str, Frame]):
+        data = frame.data if isinstance(frame, Frame) else frame
+        if isinstance(data, bytes):
+            await self.websocket.send_bytes(data)
+        else:
+            await self.websocket.send_text(data)
+
+    async def _write(self):
+        try:
+            while True:
+                await self._has_messages.wait()
+                while self._queue:
+                    await self._send_frame(self._queue.popleft())
+                self._has_messages.clear()
+                self._flushed.set()
+        except asyncio.CancelledError:
+            raise
+        except Exception:  # the client is gone, the receive loop will remove the connection
+            self._closing = True
+            self._queue.clear()
+            self._flushed.set()
+
+
+def send_frames(connections: Iterable[ChatConnection], messages: List[str]):
+    """Sends the messages in a single frame to each connection, encoding it once per encoding."""
+    frames: Dict[EventEncoding, Union[str, Frame]] = {}
+    for connection in connections:
+        frame = frames.get(connection.encoding)
+        if frame is None:
+            frame = frames[connection.encoding] = connection.encoding.encode(messages)
+        connection.send(frame)
 
 
 class ChatsConnectionManager:
-    _chats_users_connections: Dict[UUID, Dict[int, Set[WebSocket]]]
+    CHANNEL = 'chats'
+    SEND_ACTION = 'send'
+    CLOSE_ACTION = 'close'
+    CLOSE_USERS_ACTION = 'close_users'
+    CLOSE_USERS_CHUNK_SIZE = 500  # user ids per broadcast message, NOTIFY payloads are limited to 8000 bytes
+
+    send_queue_size: int
+    send_queue_overflow: str
+    send_queue_close_code: int
+    batch_hot_rate: float
+    batch_delay: float
+    batch_max_size: int
 
-    def __init__(self):
+    presence: ChatPresence
+
+    _chats_users_connections: Dict[UUID, Dict[int, Set[ChatConnection]]]
+    _broadcast: BroadcastBackend
+    _send_queue_stats: SendQueueStats
+    _chat_rates: Dict[UUID, ChatRate]
+    _chat_batches: Dict[UUID, List[str]]  # messages of the hot chats, to be sent to the batching connections
+    _batch_timers: Dict[UUID, asyncio.TimerHandle]
+
+    def __init__(
+            self,
+            broadcast_backend: BroadcastBackend,
+            send_queue_size: int = settings.WS_SEND_QUEUE_SIZE,
+            send_queue_overflow: str = settings.WS_SEND_QUEUE_OVERFLOW,
+            send_queue_close_code: int = settings.WS_SEND_QUEUE_CLOSE_CODE,
+            presence_interval: float = settings.CHAT_PRESENCE_INTERVAL,
+            typing_debounce: float = settings.CHAT_TYPING_DEBOUNCE,
+            batch_hot_rate: float = settings.WS_BATCH_HOT_CHAT_RATE,
+            batch_delay: float = settings.WS_BATCH_DELAY,
+            batch_max_size: int = settings.WS_BATCH_MAX_SIZE,
+    ):
         self._chats_users_connections = defaultdict(partial(defaultdict, set))
+        self._broadcast = broadcast_backend
+        self._broadcast.subscribe(self.CHANNEL, self._on_broadcast)
+        self.presence = ChatPresence(
+            broadcast_backend, self._send_local_presence, interval=presence_interval, typing_debounce=typing_debounce,
+        )
+
+        self.send_queue_size = send_queue_size
+        self.send_queue_overflow = send_queue_overflow
+        self.send_queue_close_code = send_queue_close_code
+        self._send_queue_stats = SendQueueStats()
+        self._draining = False
+
+        self.batch_hot_rate = batch_hot_rate
+        self.batch_delay = batch_delay
+        self.batch_max_size = batch_max_size
+        self._chat_rates = {}
+        self._chat_batches = {}
+        self._batch_timers = {}
+
+    @property
+    def is_draining(self) -> bool:
+        return self._draining
 
-    def add_connection(self, chat_id: UUID, user_id: int, connection: WebSocket):
+    def add_connection(
+            self,
+            chat_id: UUID,
+            user_id: int,
+            websocket: WebSocket,
+            held: bool = False,
+            batching: bool = False,
+            encoding: EventEncoding = JSON_ENCODING,
+    ) -> ChatConnection:
+        connection = ChatConnection(
+            websocket,
+            max_queue_size=self.send_queue_size,
+            overflow_policy=self.send_queue_overflow,
+            overflow_close_code=self.send_queue_close_code,
+            stats=self._send_queue_stats,
+            batching=batching,
+            encoding=encoding,
+        )
+        if held:
+            connection.hold()
+        else:
+            connection.start()
         self._chats_users_connections[chat_id][user_id].add(connection)
+        self.presence.connect(chat_id, user_id)
+        return connection
 
-    def remove_connection(self, chat_id: UUID, user_id: int, connection: WebSocket):
+    def remove_connection(self, chat_id: UUID, user_id: int, connection: ChatConnection):
+        connection.stop()
         self._chats_users_connections[chat_id][user_id].remove(connection)
         if not self._chats_users_connections[chat_id][user_id]:
             del self._chats_users_connections[chat_id][user_id]
         if not self._chats_users_connections[chat_id]:
             del self._chats_users_connections[chat_id]
+            self._chat_rates.pop(chat_id, None)
+            self._flush_chat_batch(chat_id)
+        self.presence.disconnect(chat_id, user_id)
 
     async def send_chat_message(self, chat_id: UUID, message: str):
-        tasks = [
-            connection.send_text(message)
-            for user_connections in self._chats_users_connections[chat_id].values()
+        if not metrics.enabled:
+            await self._publish(self.SEND_ACTION, chat_id, message)
+            return
+
+        started_at = time.perf_counter()
+        await self._publish(self.SEND_ACTION, chat_id, message)
+        CHAT_PUBLISH_SECONDS.observe(time.perf_counter() - started_at)
+
+    async def disconnect_chat(self, chat_id: UUID, error_code: int):
+        await self._publish(self.CLOSE_ACTION, chat_id, str(error_code))
+
+    async def disconnect_chat_users(self, chat_id: UUID, user_ids: Sequence[int], error_code: int):
+        for start in range(0, len(user_ids), self.CLOSE_USERS_CHUNK_SIZE):
+            chunk = user_ids[start:start + self.CLOSE_USERS_CHUNK_SIZE]
+            await self._publish(self.CLOSE_USERS_ACTION, chat_id, f'{error_code}:{",".join(map(str, chunk))}')
+
+    async def drain(
+            self,
+            batch_size: int = settings.WS_DRAIN_BATCH_SIZE,
+            batch_interval: float = settings.WS_DRAIN_BATCH_INTERVAL,
+            flush_timeout: float = settings.WS_DRAIN_FLUSH_TIMEOUT,
+            reconnect_jitter: float = settings.WS_DRAIN_RECONNECT_JITTER,
+    ):
+        """
+        Stops accepting websockets and closes the local ones with 1012 Service Restart, a batch at a time,
+        after sending them their queued messages and a `server_restart` event telling when to reconnect,
+        so the clients don't all come back to the next worker at once.
+        """
+        self._draining = True
+        for chat_id in list(self._chat_batches):
+            self._flush_chat_batch(chat_id)
+        connections = [
+            connection
+            for users_connections in self._chats_users_connections.values()
+            for user_connections in users_connections.values()
+            for connection in user_connections
+        ]
+        for start in range(0, len(connections), batch_size):
+            if start:
+                await asyncio.sleep(batch_interval)
+            await asyncio.gather(*[
+                self._drain_connection(connection, flush_timeout, reconnect_jitter)
+                for connection in connections[start:start + batch_size]
+            ])
+
+    def get_send_queue_stats(self) -> Dict[str, int]:
+        queue_sizes = [
+            connection.queue_size
+            for users_connections in self._chats_users_connections.values()
+            for user_connections in users_connections.values()
+            for connection in user_connections
+        ]
+        return {
+            'connections': len(queue_sizes),
+            'queued_messages': sum(queue_sizes),
+            'max_queue_size': max(queue_sizes, default=0),
+            'dropped_messages': self._send_queue_stats.dropped_messages,
+            'overflow_disconnects': self._send_queue_stats.overflow_disconnects,
+        }
+
+    def get_connection_counts(self) -> Dict[UUID, int]:
+        return {
+            chat_id: sum(len(user_connections) for user_connections in users_connections.values())
+            for chat_id, users_connections in self._chats_users_connections.items()
+        }
+
+    async def _drain_connection(self, connection: ChatConnection, flush_timeout: float, reconnect_jitter: float):
+        reconnect_after = round(random.uniform(0, reconnect_jitter), 3)
+        connection.send(get_event_payload(event='server_restart', payload=ServerRestart(reconnect_after=reconnect_after)))
+        await connection.flush(flush_timeout)
+        await connection.close(code=status.WS_1012_SERVICE_RESTART)
+
+    async def _publish(self, action: str, chat_id: UUID, data: str):
+        await self._broadcast.publish(self.CHANNEL, f'{action}:{chat_id}:{data}')
+
+    async def _on_broadcast(self, message: str):
+        action, chat_id, data = message.split(':', 2)
+        if action == self.SEND_ACTION:
+            self._send_local_chat_message(UUID(chat_id), data)
+        elif action == self.CLOSE_ACTION:
+            await self._disconnect_local_chat(UUID(chat_id), int(data))
+        elif action == self.CLOSE_USERS_ACTION:
+            error_code, user_ids = data.split(':', 1)
+            await self._disconnect_local_chat_users(UUID(chat_id), map(int, user_ids.split(',')), int(error_code))
+
+    def _get_chat_connections(self, chat_id: UUID) -> List[ChatConnection]:
+        return [
+            connection
+            for user_connections in self._chats_users_connections.get(chat_id, {}).values()
             for connection in user_connections
         ]
+
+    def _send_local_chat_message(self, chat_id: UUID, message: str):
+        """
+        Queues the message to the local connections of the chat. While the chat gets `batch_hot_rate` messages
+        per second or more, the connections accepting batches get them every `batch_delay` seconds instead,
+        up to `batch_max_size` at a time, in a single frame.
+        """
+        started_at = time.perf_counter() if metrics.enabled else 0
+        connections = self._get_chat_connections(chat_id)
+        batch = self._chat_batches.get(chat_id)
+        if connections and self.batch_hot_rate > 0:
+            now = time.monotonic()
+            chat_rate = self._chat_rates.get(chat_id)
+            if chat_rate is None:
+                chat_rate = self._chat_rates[chat_id] = ChatRate(now)
+            is_hot = chat_rate.add(now) >= self.batch_hot_rate
+            if batch is None and is_hot and any(connection.batching for connection in connections):
+                batch = self._chat_batches[chat_id] = []
+                self._batch_timers[chat_id] = asyncio.get_running_loop().call_later(
+                    self.batch_delay, self._flush_chat_batch, chat_id,
+                )
+
+        if batch is not None:
+            connections = [connection for connection in connections if not connection.batching]
+            batch.append(message)
+        send_frames(connections, [message])
+        if batch is not None and len(batch) >= self.batch_max_size:
+            self._flush_chat_batch(chat_id)
+
+        if metrics.enabled:
+            CHAT_FANOUT_SECONDS.observe(time.perf_counter() - started_at)
+            CHAT_FANOUT_DELIVERIES.inc(len(connections))
+
+    def _flush_chat_batch(self, chat_id: UUID):
+        timer = self._batch_timers.pop(chat_id, None)
+        if timer is not None:
+            timer.cancel()
+        messages = self._chat_batches.pop(chat_id, None)
+        if not messages:
+            return
+
+        connections = [connection for connection in self._get_chat_connections(chat_id) if connection.batching]
+        send_frames(connections, messages)
+        if metrics.enabled:
+            CHAT_FANOUT_BATCHES.inc(len(connections))
+            CHAT_FANOUT_DELIVERIES.inc(len(connections) * len(messages))
+
+    def _send_local_presence(self, chat_id: UUID, diff: ChatPresenceDiff):
+        send_frames(self._get_chat_connections(chat_id), [get_event_payload(event='presence', payload=diff)])
+
+    async def _disconnect_local_chat(self, chat_id: UUID, error_code: int):
+        tasks = [connection.close(code=error_code) for connection in self._get_chat_connections(chat_id)]
         await asyncio.gather(*tasks)
 
-    async def disconnect_chat(self, chat_id: UUID, error_code: int):
+    async def _disconnect_local_chat_users(self, chat_id: UUID, user_ids: Iterable[int], error_code: int):
+        users_connections = self._chats_users_connections.get(chat_id, {})
         tasks = [
             connection.close(code=error_code)
-            for user_connections in self._chats_users_connections[chat_id].values()
-            for connection in user_connections
+            for user_id in user_ids
+            for connection in list(users_connections.get(user_id, ()))
         ]
         await asyncio.gather(*tasks)
 
 
-chats_connections = ChatsConnectionManager()
+chats_connections = ChatsConnectionManager(broadcast)
+
+
+def get_chats_by_connections():
+    """Cumulative counts of the chats with local websockets by the upper bounds of their websockets."""
+    counts = list(chats_connections.get_connection_counts().values())
+    return [((format_value(bound),), sum(count <= bound for count in counts)) for bound in CHAT_CONNECTIONS_BUCKETS]
+
+
+metrics.register_callback(
+    'chat_websocket_connections', "Open chat websockets of this process.",
+    lambda: [((), sum(chats_connections.get_connection_counts().values()))],
+)
+metrics.register_callback(
+    'chat_websocket_chats', "Chats with open websockets in this process, by their websockets at most.",
+    get_chats_by_connections, ('le',),
+)
+metrics.register_callback(
+    'chat_send_queue_messages', "Messages queued to be sent over chat websockets.",
+    lambda: [((), chats_connections.get_send_queue_stats()['queued_messages'])],
+)
+metrics.register_callback(
+    'chat_send_queue_dropped_messages_total', "Messages dropped from overflown websocket send queues.",
+    lambda: [((), chats_connections.get_send_queue_stats()['dropped_messages'])], type='counter',
+)
+metrics.register_callback(
+    'chat_send_queue_overflow_disconnects_total', "Websockets closed because of overflown send queues.",
+    lambda: [((), chats_connections.get_send_queue_stats()['overflow_disconnects'])], type='counter',
+)
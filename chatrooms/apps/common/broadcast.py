@@ -0,0 +1,158 @@
+from abc import ABC, abstractmethod
+import asyncio
+from collections import defaultdict
+import logging
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from tortoise.transactions import get_connection
+
+from chatrooms.config import settings
+
+
+logger = logging.getLogger(__name__)
+
+RECONNECT_INTERVAL = 1  # seconds between the attempts to listen again after losing the connection
+
+Listener = Callable[[str], Awaitable[None]]
+
+
+class BroadcastBackend(ABC):
+    """
+    Publish/subscribe channel shared by every worker process.
+
+    Listeners must be subscribed before the backend is connected; a message published on a channel
+    is delivered to the listeners of that channel in every process, the publishing one included.
+    """
+    _listeners: Dict[str, List[Listener]]
+
+    def __init__(self):
+        self._listeners = defaultdict(list)
+
+    def subscribe(self, channel: str, listener: Listener) -> None:
+        self._listeners[channel].append(listener)
+
+    async def connect(self) -> None:
+        pass
+
+    async def disconnect(self) -> None:
+        pass
+
+    @abstractmethod
+    async def publish(self, channel: str, message: str) -> None:
+        pass
+
+    async def _dispatch(self, channel: str, message: str) -> None:
+        await asyncio.gather(*(listener(message) for listener in self._listeners.get(channel, [])))
+
+
+class MemoryBroadcast(BroadcastBackend):
+    """Delivers messages within the current process only."""
+
+    async def publish(self, channel: str, message: str) -> None:
+        await self._dispatch(channel, message)
+
+
+class PostgresBroadcast(BroadcastBackend):
+    """
+    Delivers messages through PostgreSQL LISTEN/NOTIFY, using a connection from the Tortoise pool.
+    Notifications are dispatched one at a time, in the order they were received.
+
+    If the connection is lost, e.g. as the database restarts, another one is taken from the pool
+    and listens again; the messages published meanwhile are not delivered.
+    """
+    _connection_name: str
+    _connection: Optional[object]
+    _notifications: 'asyncio.Queue[Tuple[str, str]]'
+    _task: Optional[asyncio.Task]
+    _reconnect_task: Optional[asyncio.Task]
+
+    def __init__(self, connection_name: str = 'default'):
+        super().__init__()
+        self._connection_name = connection_name
+        self._connection = None
+        self._task = None
+        self._reconnect_task = None
+
+    async def connect(self) -> None:
+        self._notifications = asyncio.Queue()
+        self._task = asyncio.create_task(self._consume())
+        await self._listen()
+
+    async def disconnect(self) -> None:
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._connection is None:
+            return
+
+        connection, self._connection = self._connection, None
+        connection.remove_termination_listener(self._on_termination)
+        for channel in self._listeners:
+            await connection.remove_listener(channel, self._on_notification)
+        await get_connection(self._connection_name)._pool.release(connection)
+
+    async def publish(self, channel: str, message: str) -> None:
+        client = get_connection(self._connection_name)
+        await client.execute_query('SELECT pg_notify($1, $2)', [channel, message])
+
+    async def _listen(self) -> None:
+        pool = get_connection(self._connection_name)._pool
+        connection = await pool.acquire()
+        try:
+            for channel in self._listeners:
+                await connection.add_listener(channel, self._on_notification)
+        except BaseException:
+            await pool.release(connection)
+            raise
+        connection.add_termination_listener(self._on_termination)
+        self._connection = connection
+
+    async def _reconnect(self, lost_connection) -> None:
+        try:
+            await get_connection(self._connection_name)._pool.release(lost_connection)
+        except Exception:
+            logger.exception("Failed to release the lost broadcast connection")
+        while True:
+            try:
+                await self._listen()
+            except Exception:
+                logger.exception("Failed to reconnect the broadcast, retrying")
+                await asyncio.sleep(RECONNECT_INTERVAL)
+            else:
+                logger.warning("Broadcast reconnected")
+                self._reconnect_task = None
+                return
+
+    def _on_termination(self, connection) -> None:
+        if connection is not self._connection:
+            return
+        logger.warning("Broadcast connection lost, reconnecting")
+        self._connection = None
+        self._reconnect_task = asyncio.create_task(self._reconnect(connection))
+
+    def _on_notification(self, __, ___, channel: str, message: str) -> None:
+        self._notifications.put_nowait((channel, message))
+
+    async def _consume(self) -> None:
+        while True:
+            channel, message = await self._notifications.get()
+            try:
+                await self._dispatch(channel, message)
+            except Exception:
+                logger.exception("Broadcast listener failed")
+
+
+BROADCAST_BACKENDS = {
+    'memory': MemoryBroadcast,
+    'postgres': PostgresBroadcast,
+}
+
+
+def get_broadcast_backend(name: str) -> BroadcastBackend:
+    return BROADCAST_BACKENDS[name]()
+
+
+broadcast = get_broadcast_backend(settings.BROADCAST_BACKEND)
@@ -0,0 +1,53 @@
+from collections import OrderedDict
+import time
+from typing import Any, Hashable, Iterator, Optional, Tuple
+
+
+class TTLCache:
+    """Size bounded LRU cache, whose entries expire `ttl` seconds after they were set."""
+    max_size: int
+    ttl: float
+
+    _entries: 'OrderedDict[Hashable, Tuple[float, Any]]'
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        try:
+            expires_at, value = self._entries[key]
+        except KeyError:
+            return default
+
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return default
+
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        if self.max_size <= 0:
+            return
+
+        self._entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def items(self) -> Iterator[Tuple[Hashable, Any]]:
+        now = time.monotonic()
+        for key, (expires_at, value) in list(self._entries.items()):
+            if expires_at > now:
+                yield key, value
@@ -0,0 +1,203 @@
+"""
+Tortoise engine for PostgreSQL whose connection pools keep statistics: set `"engine": "chatrooms.apps.common.db"`
+in the connection config, everything else is the same as with `tortoise.backends.asyncpg`.
+
+Read-only queries that can bear replication lag may be routed to the "read" connection with `get_read_connection`.
+"""
+from collections import OrderedDict
+import inspect
+import time
+from typing import Dict, List, Optional, Tuple, Type
+
+import asyncpg
+from tortoise import Tortoise
+from tortoise.backends.asyncpg.client import AsyncpgDBClient
+from tortoise.backends.base.client import BaseDBAsyncClient
+from tortoise.exceptions import DBConnectionError
+from tortoise.models import Model
+
+from chatrooms.apps.common.broadcast import BroadcastBackend, broadcast
+from chatrooms.apps.common.metrics import LabelValues, metrics
+from chatrooms.config import settings
+
+
+READ_CONNECTION = 'read'
+
+# the pool is created directly, not with `asyncpg.create_pool`, which only fills in these defaults
+POOL_DEFAULTS = {
+    name: parameter.default
+    for name, parameter in inspect.signature(asyncpg.create_pool).parameters.items()
+    if parameter.kind is parameter.KEYWORD_ONLY
+}
+
+DB_POOL_ACQUIRE_SECONDS = metrics.histogram(
+    'db_pool_acquire_duration_seconds', "Time spent waiting for a connection from the database pools.",
+    ('connection',),
+)
+
+
+class InstrumentedPool(asyncpg.pool.Pool):
+    """asyncpg pool keeping count of the acquires in progress and of the time they take."""
+    connection_name: str
+    waiting: int
+    acquired: int
+    acquire_seconds: float
+    max_acquire_seconds: float
+
+    def __init__(self, *args, connection_name: str, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connection_name = connection_name
+        self.waiting = 0
+        self.acquired = 0
+        self.acquire_seconds = 0.0
+        self.max_acquire_seconds = 0.0
+        self._acquire_histogram = DB_POOL_ACQUIRE_SECONDS.labels(connection_name)
+
+    async def _acquire(self, timeout):
+        started_at = time.perf_counter()
+        self.waiting += 1
+        try:
+            return await super()._acquire(timeout)
+        finally:
+            self.waiting -= 1
+            elapsed = time.perf_counter() - started_at
+            self.acquired += 1
+            self.acquire_seconds += elapsed
+            self.max_acquire_seconds = max(self.max_acquire_seconds, elapsed)
+            self._acquire_histogram.observe(elapsed)
+
+
+class InstrumentedAsyncpgDBClient(AsyncpgDBClient):
+    pool_class: Type[InstrumentedPool] = InstrumentedPool
+
+    async def create_connection(self, with_db: bool) -> None:
+        # the same as the parent's, except for the pool class
+        if self.schema:
+            self.server_settings["search_path"] = self.schema
+        if self.application_name:
+            self.server_settings["application_name"] = self.application_name
+
+        self._template = {
+            "host": self.host,
+            "port": self.port,
+            "user": self.user,
+            "database": self.database if with_db else None,
+            "min_size": self.pool_minsize,
+            "max_size": self.pool_maxsize,
+            "connection_class": self.connection_class,
+            "loop": self.loop,
+            "server_settings": self.server_settings,
+            **self.extra,
+        }
+        try:
+            pool_kwargs = {**POOL_DEFAULTS, **self._template}
+            self._pool = await self.pool_class(
+                None, password=self.password, connection_name=self.connection_name, **pool_kwargs,
+            )
+            self.log.debug("Created connection pool %s with params: %s", self._pool, self._template)
+        except asyncpg.InvalidCatalogNameError:
+            raise DBConnectionError(f"Can't establish connection to database {self.database}")
+
+
+client_class = InstrumentedAsyncpgDBClient
+
+
+class RecentWriters:
+    """
+    Users who wrote to the primary database within the last `window` seconds, so their reads stay on the primary
+    while the replica may still lag behind their changes. Writers are shared between the workers through
+    the broadcast backend, each one is published at most about twice per window; the worker that handled
+    the write marks the user right away, not waiting for its own broadcast to come back.
+    """
+    CHANNEL = 'recent_writers'
+
+    window: float
+
+    _deadlines: 'OrderedDict[int, float]'  # by user id, the earliest to expire first
+    _broadcast: BroadcastBackend
+
+    def __init__(self, broadcast_backend: BroadcastBackend, window: float):
+        self.window = window
+        self._deadlines = OrderedDict()
+        self._broadcast = broadcast_backend
+        self._broadcast.subscribe(self.CHANNEL, self._on_broadcast)
+
+    @property
+    def enabled(self) -> bool:
+        return self.window > 0 and READ_CONNECTION in Tortoise._connections
+
+    async def add(self, user_id: int) -> None:
+        if not self.enabled:
+            return
+        deadline = self._deadlines.get(user_id)
+        if deadline is not None and deadline - time.monotonic() > self.window / 2:
+            return
+        self._mark(user_id)
+        await self._broadcast.publish(self.CHANNEL, str(user_id))
+
+    def is_recent(self, user_id: int) -> bool:
+        deadline = self._deadlines.get(user_id)
+        return deadline is not None and deadline > time.monotonic()
+
+    def clear(self) -> None:
+        self._deadlines.clear()
+
+    async def _on_broadcast(self, message: str) -> None:
+        self._mark(int(message))
+
+    def _mark(self, user_id: int) -> None:
+        now = time.monotonic()
+        self._deadlines[user_id] = now + self.window
+        self._deadlines.move_to_end(user_id)
+        while self._deadlines and next(iter(self._deadlines.values())) <= now:
+            self._deadlines.popitem(last=False)
+
+
+recent_writers = RecentWriters(broadcast, window=settings.DB_READ_YOUR_WRITES_WINDOW)
+
+
+def get_read_connection(model: Type[Model], user_id: Optional[int] = None) -> BaseDBAsyncClient:
+    """
+    The connection of the read pool if it's configured, the model's own one otherwise,
+    or if the user has written recently.
+    """
+    connection = Tortoise._connections.get(READ_CONNECTION)
+    if connection is None or (user_id is not None and recent_writers.is_recent(user_id)):
+        return model._meta.db
+    return connection
+
+
+def get_pool_stats() -> Dict[str, Dict[str, float]]:
+    stats = {}
+    for name, client in Tortoise._connections.items():
+        pool = getattr(client, '_pool', None)
+        if pool is None:
+            continue
+        size, idle = pool.get_size(), pool.get_idle_size()
+        acquired = getattr(pool, 'acquired', 0)
+        stats[name] = {
+            'min_size': pool.get_min_size(),
+            'max_size': pool.get_max_size(),
+            'size': size,
+            'idle': idle,
+            'in_use': size - idle,
+            'waiting': getattr(pool, 'waiting', 0),
+            'acquired': acquired,
+            'acquire_wait_avg_seconds': getattr(pool, 'acquire_seconds', 0.0) / acquired if acquired else 0.0,
+            'acquire_wait_max_seconds': getattr(pool, 'max_acquire_seconds', 0.0),
+        }
+    return stats
+
+
+def get_pool_samples() -> List[Tuple[LabelValues, float]]:
+    return [
+        ((name, state), pool_stats[state])
+        for name, pool_stats in get_pool_stats().items()
+        for state in ('size', 'idle', 'in_use', 'waiting', 'max_size')
+    ]
+
+
+metrics.register_callback(
+    'db_pool_connections', "Connections of the database pools, `waiting` counts the acquires in progress.",
+    get_pool_samples, ('connection', 'state'),
+)
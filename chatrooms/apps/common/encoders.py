@@ -0,0 +1,27 @@
+import json
+from typing import Any, Union
+
+from pydantic.json import pydantic_encoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def json_dumps(obj: Any) -> bytes:
+    """
+    Serialize an object to compact UTF-8 encoded JSON in one pass, using orjson when it's installed.
+    Pydantic models and the types they hold are encoded the same way as `BaseModel.json()` does.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=pydantic_encoder)
+    return json.dumps(
+        obj, default=pydantic_encoder, ensure_ascii=False, allow_nan=False, separators=(',', ':'),
+    ).encode('utf-8')
+
+
+def json_loads(data: Union[str, bytes]) -> Any:
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
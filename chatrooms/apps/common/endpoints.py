@@ -1,6 +1,11 @@
-from fastapi import APIRouter
+from typing import Dict
 
-from chatrooms.apps.common.schemas import HealthCheck
+from fastapi import APIRouter, HTTPException, status
+from fastapi.responses import PlainTextResponse
+
+from chatrooms.apps.common.db import get_pool_stats
+from chatrooms.apps.common.metrics import metrics
+from chatrooms.apps.common.schemas import HealthCheck, PoolStats
 
 health_router = APIRouter()
 
@@ -8,3 +13,15 @@ health_router = APIRouter()
 @health_router.get('/status', response_model=HealthCheck)
 def get_health_status():
     return {'status': "OK"}
+
+
+@health_router.get('/metrics', response_class=PlainTextResponse)
+def get_metrics():
+    if not metrics.enabled:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Metrics are disabled.")
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
+@health_router.get('/pool', response_model=Dict[str, PoolStats])
+def get_database_pool_stats():
+    return get_pool_stats()
@@ -0,0 +1,240 @@
+from abc import ABC, abstractmethod
+from bisect import bisect_left
+import math
+from typing import Callable, Dict, Iterable, Sequence, Tuple
+
+import asyncpg
+
+from chatrooms.config import settings
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+LabelValues = Tuple[str, ...]
+Sample = Tuple[str, Dict[str, str], float]
+SamplesCallback = Callable[[], Iterable[Tuple[LabelValues, float]]]
+
+
+def format_value(value: float) -> str:
+    if math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(float(value))
+
+
+def format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ''
+    escaped = (
+        (name, str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"'))
+        for name, value in labels.items()
+    )
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped) + '}'
+
+
+class Metric(ABC):
+    type: str
+
+    name: str
+    documentation: str
+    labelnames: Tuple[str, ...]
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    @abstractmethod
+    def samples(self) -> Iterable[Sample]:
+        pass
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(
+            f'{name}{format_labels(labels)} {format_value(value)}' for name, labels, value in self.samples()
+        )
+        return '\n'.join(lines)
+
+
+class _CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    _values: Dict[LabelValues, _CounterValue]
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def labels(self, *values: str) -> _CounterValue:
+        try:
+            return self._values[values]
+        except KeyError:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"Expected labels {self.labelnames}, got {values}")
+            return self._values.setdefault(values, _CounterValue())
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def samples(self) -> Iterable[Sample]:
+        for values, counter in self._values.items():
+            yield self.name, dict(zip(self.labelnames, values)), counter.value
+
+
+class _HistogramValue:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    buckets: Tuple[float, ...]
+
+    _values: Dict[LabelValues, _HistogramValue]
+
+    def __init__(
+            self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = (*sorted(buckets), math.inf)
+        self._values = {}
+
+    def labels(self, *values: str) -> _HistogramValue:
+        try:
+            return self._values[values]
+        except KeyError:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"Expected labels {self.labelnames}, got {values}")
+            return self._values.setdefault(values, _HistogramValue(self.buckets))
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def samples(self) -> Iterable[Sample]:
+        for values, histogram in self._values.items():
+            labels = dict(zip(self.labelnames, values))
+            count = 0
+            for bound, bucket_count in zip(self.buckets, histogram.counts):
+                count += bucket_count
+                yield f'{self.name}_bucket', {**labels, 'le': format_value(bound)}, count
+            yield f'{self.name}_count', labels, count
+            yield f'{self.name}_sum', labels, histogram.sum
+
+
+class CallbackMetric(Metric):
+    """Metric whose samples are taken from `callback` at collection time, e.g. sizes of in-memory structures."""
+    _callback: SamplesCallback
+
+    def __init__(
+            self, name: str, documentation: str, callback: SamplesCallback, labelnames: Sequence[str] = (),
+            type: str = 'gauge',
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.type = type
+        self._callback = callback
+
+    def samples(self) -> Iterable[Sample]:
+        for values, value in self._callback():
+            yield self.name, dict(zip(self.labelnames, values)), value
+
+
+class _NullMetric:
+    """Stands in for every metric while metrics are disabled."""
+
+    def labels(self, *values: str) -> '_NullMetric':
+        return self
+
+    def inc(self, amount: float = 1) -> None:
+        pass
+
+    def observe(self, value: float) -> None:
+        pass
+
+
+NULL_METRIC = _NullMetric()
+
+
+class MetricsRegistry:
+    """
+    Collects the metrics of the process and renders them in the Prometheus text format.
+    When disabled, it hands out no-op metrics, so instrumented code costs a method call at most.
+    """
+    enabled: bool
+
+    _metrics: Dict[str, Metric]
+
+    def __init__(self, enabled: bool):
+        self.enabled = enabled
+        self._metrics = {}
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(
+            self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_callback(
+            self, name: str, documentation: str, callback: SamplesCallback, labelnames: Sequence[str] = (),
+            type: str = 'gauge',
+    ):
+        return self._register(CallbackMetric(name, documentation, callback, labelnames, type))
+
+    def render(self) -> str:
+        return ''.join(f'{metric.render()}\n' for metric in self._metrics.values())
+
+    def _register(self, metric: Metric):
+        if not self.enabled:
+            return NULL_METRIC
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+        return metric
+
+
+metrics = MetricsRegistry(enabled=settings.METRICS_ENABLED)
+
+
+DB_QUERY_SECONDS = metrics.histogram(
+    'db_query_duration_seconds', "Time spent executing database queries.", ('operation',),
+)
+DB_QUERY_ERRORS = metrics.counter('db_query_errors_total', "Failed database queries.", ('operation',))
+
+
+def get_query_operation(query: str) -> str:
+    operation = query.lstrip().split(None, 1)[0].upper() if query.strip() else ''
+    return operation if operation in ('SELECT', 'INSERT', 'UPDATE', 'DELETE') else 'OTHER'
+
+
+def record_query(record) -> None:
+    operation = get_query_operation(record.query)
+    DB_QUERY_SECONDS.labels(operation).observe(record.elapsed)
+    if record.exception is not None:
+        DB_QUERY_ERRORS.labels(operation).inc()
+
+
+class QueryTimingConnection(asyncpg.connection.Connection):
+    """asyncpg connection reporting the duration of every query it runs."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.add_query_logger(record_query)
@@ -0,0 +1,54 @@
+import time
+from typing import Callable, Dict
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from chatrooms.apps.common.metrics import metrics
+
+
+HTTP_REQUEST_SECONDS = metrics.histogram(
+    'http_request_duration_seconds', "Time spent handling HTTP requests.", ('method', 'path', 'status'),
+)
+
+
+class MetricsMiddleware:
+    """Times HTTP requests, labelled by the path template of the matched route to keep the label set bounded."""
+    UNMATCHED_PATH = '<unmatched>'
+
+    _route_paths: Dict[Callable, str]
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._route_paths = {}
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status_code
+            if message['type'] == 'http.response.start':
+                status_code = message['status']
+            await send(message)
+
+        started_at = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            HTTP_REQUEST_SECONDS.labels(scope['method'], self._get_path(scope), str(status_code)).observe(
+                time.perf_counter() - started_at,
+            )
+
+    def _get_path(self, scope: Scope) -> str:
+        # the router stores the matched endpoint in the (shared) scope
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return self.UNMATCHED_PATH
+        if endpoint not in self._route_paths:
+            self._route_paths.update(
+                (route.endpoint, route.path) for route in scope['app'].routes if hasattr(route, 'endpoint')
+            )
+        return self._route_paths.get(endpoint, self.UNMATCHED_PATH)
@@ -1,12 +1,20 @@
 import asyncio
+import base64
+import binascii
+import json
 import math
-from typing import get_type_hints, Optional, List
+from typing import get_type_hints, Any, Optional, List, Sequence, Tuple
 from urllib.parse import urljoin, urlencode
 
 from fastapi import Request
 from pydantic import BaseModel
+from pydantic.json import pydantic_encoder
+from tortoise.expressions import Q
+from tortoise.models import Model
 from tortoise.queryset import QuerySet
 
+from chatrooms.apps.common.exceptions import BadInputError
+
 
 class PageNumberPagination(BaseModel):
     count: int
@@ -31,25 +39,118 @@ class PageNumberPagination(BaseModel):
         count, items = await asyncio.gather(base_qs.count(), qs)
 
         max_pages = math.ceil(count / page_size)
+        next_page = None if page + 1 > max_pages else cls.get_page_url(request, page + 1)
+        previous_page = None if page <= 1 else cls.get_page_url(request, min(page - 1, max_pages))
+
+        base_schema = get_type_hints(cls)['results'].__args__[0]
+        results = [base_schema.from_orm(item) for item in items]
+
+        return cls(
+            count=count,
+            next=next_page,
+            previous=previous_page,
+            results=results,
+        )
+
+    @staticmethod
+    def get_page_url(request: Request, page: int) -> str:
         url = urljoin(str(request.base_url), request.url.path)
-        if page + 1 > max_pages:
-            next_page = None
-        else:
-            query_params = {**request.query_params, 'page': page + 1}
-            next_page = '?'.join([url, urlencode(query_params)])
+        return '?'.join([url, urlencode({**request.query_params, 'page': page})])
+
+
+class CursorPagination(BaseModel):
+    """
+    Keyset pagination: pages are delimited by the ordering values of the boundary items,
+    so neither OFFSET nor COUNT queries are needed. The last ordering field must be unique.
+    """
+    next: Optional[str]
+    previous: Optional[str]
+    results: List[BaseModel]
 
-        if page <= 1:
-            previous_page = None
+    @classmethod
+    async def paginate_queryset(
+            cls,
+            qs: QuerySet,
+            ordering: Sequence[str],
+            page_size: int,
+            cursor: Optional[str],
+            request: Request,
+    ) -> 'CursorPagination':
+        position, is_reversed = cls.decode_cursor(cursor, qs.model, ordering) if cursor else (None, False)
+        if is_reversed:
+            ordering = [field[1:] if field.startswith('-') else f'-{field}' for field in ordering]
+        if position is not None:
+            qs = qs.filter(cls.get_keyset_filter(ordering, position))
+
+        items = await qs.order_by(*ordering).limit(page_size + 1)
+        has_more = len(items) > page_size
+        items = items[:page_size]
+        if is_reversed:
+            items.reverse()
+            has_next, has_previous = position is not None, has_more
         else:
-            query_params = {**request.query_params, 'page': min(page - 1, max_pages)}
-            previous_page = '?'.join([url, urlencode(query_params)])
+            has_next, has_previous = has_more, position is not None
+
+        next_page = None
+        if has_next and items:
+            next_page = cls.get_cursor_url(request, cls.get_position(items[-1], ordering), False)
+
+        previous_page = None
+        if has_previous and items:
+            previous_page = cls.get_cursor_url(request, cls.get_position(items[0], ordering), True)
 
         base_schema = get_type_hints(cls)['results'].__args__[0]
         results = [base_schema.from_orm(item) for item in items]
 
         return cls(
-            count=count,
             next=next_page,
             previous=previous_page,
             results=results,
         )
+
+    @staticmethod
+    def get_keyset_filter(ordering: Sequence[str], position: Sequence[Any]) -> Q:
+        conditions = []
+        for i, field in enumerate(ordering):
+            equal_values = {name.lstrip('-'): value for name, value in zip(ordering[:i], position)}
+            lookup = f'{field[1:]}__lt' if field.startswith('-') else f'{field}__gt'
+            conditions.append(Q(**equal_values, **{lookup: position[i]}))
+        return Q(*conditions, join_type=Q.OR)
+
+    @classmethod
+    def get_cursor_url(cls, request: Request, position: Sequence[Any], is_reversed: bool) -> str:
+        url = urljoin(str(request.base_url), request.url.path)
+        query_params = {**request.query_params, 'cursor': cls.encode_cursor(position, is_reversed)}
+        return '?'.join([url, urlencode(query_params)])
+
+    @staticmethod
+    def get_position(item: Model, ordering: Sequence[str]) -> List[Any]:
+        return [getattr(item, field.lstrip('-')) for field in ordering]
+
+    @staticmethod
+    def encode_cursor(position: Sequence[Any], is_reversed: bool) -> str:
+        data = json.dumps({'p': position, 'r': is_reversed}, default=pydantic_encoder, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+    @classmethod
+    def decode_cursor(cls, cursor: str, model: Model, ordering: Sequence[str]) -> Tuple[List[Any], bool]:
+        raw_position, is_reversed = cls.decode_raw_cursor(cursor)
+        try:
+            fields = [model._meta.fields_map[field.lstrip('-')] for field in ordering]
+            if len(raw_position) != len(fields):
+                raise ValueError(cursor)
+            position = [field.to_python_value(value) for field, value in zip(fields, raw_position)]
+            return position, is_reversed
+        except (TypeError, ValueError, KeyError):
+            raise BadInputError({'cursor': "Invalid cursor."})
+
+    @staticmethod
+    def decode_raw_cursor(cursor: str) -> Tuple[List[Any], bool]:
+        """Position and direction of the cursor, with the values of the position as they were encoded in JSON."""
+        try:
+            data = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            if not isinstance(data['p'], list):
+                raise ValueError(cursor)
+            return data['p'], bool(data['r'])
+        except (binascii.Error, UnicodeDecodeError, TypeError, ValueError, KeyError):
+            raise BadInputError({'cursor': "Invalid cursor."})
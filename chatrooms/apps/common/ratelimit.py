@@ -0,0 +1,154 @@
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+import math
+import time
+from typing import Awaitable, Callable, Optional
+
+from fastapi import HTTPException, Request, status
+
+from chatrooms.apps.common.metrics import metrics
+from chatrooms.config import settings
+
+
+RATE_LIMIT_DECISIONS = metrics.counter(
+    'rate_limit_decisions_total', "Requests checked against the rate limits.", ('scope', 'result'),
+)
+
+KeyFunc = Callable[[Request], Awaitable[Optional[str]]]
+
+
+class TokenBucket:
+    """Holds up to `burst` tokens, refilled at `rate` tokens per second; each request takes one."""
+    __slots__ = ('rate', 'burst', 'tokens', 'updated_at')
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated_at = time.monotonic()
+
+    def take(self, cost: float = 1) -> float:
+        """Takes the tokens if there are enough of them, otherwise returns the seconds until there will be."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return 0
+        return (cost - self.tokens) / self.rate if self.rate > 0 else math.inf
+
+
+class RateLimitBackend(ABC):
+    """Storage of the token buckets of the rate limits, by key."""
+
+    @abstractmethod
+    async def hit(self, key: str, rate: float, burst: int) -> float:
+        """Takes a token from the bucket of the key; returns 0 if it had one, otherwise the seconds to wait."""
+
+    def clear(self) -> None:
+        pass
+
+
+class MemoryRateLimitBackend(RateLimitBackend):
+    """
+    Keeps the buckets within the current process, so every worker allows the full rate. Only the `max_keys`
+    most recently hit buckets are kept; the ones evicted are full again when hit next.
+    """
+    max_keys: int
+
+    _buckets: 'OrderedDict[str, TokenBucket]'
+
+    def __init__(self, max_keys: int = settings.RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    async def hit(self, key: str, rate: float, burst: int) -> float:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(rate, burst)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket.take()
+
+    def clear(self) -> None:
+        self._buckets.clear()
+
+
+RATE_LIMIT_BACKENDS = {
+    'memory': MemoryRateLimitBackend,
+}
+
+
+def get_rate_limit_backend(name: str) -> RateLimitBackend:
+    return RATE_LIMIT_BACKENDS[name]()
+
+
+rate_limit_backend = get_rate_limit_backend(settings.RATE_LIMIT_BACKEND)
+
+
+async def check_rate_limit(scope: str, key: str, rate: float, burst: int) -> float:
+    """Seconds to wait before the next request of the key is allowed, 0 if this one is; a zero `rate` allows all."""
+    if rate <= 0:
+        return 0
+    retry_after = await rate_limit_backend.hit(f'{scope}:{key}', rate, burst)
+    RATE_LIMIT_DECISIONS.labels(scope, 'limited' if retry_after else 'allowed').inc()
+    return retry_after
+
+
+class LocalRateLimit:
+    """Rate limit of a single object, e.g. a websocket, kept by its owner rather than in the backend."""
+    scope: str
+
+    _bucket: Optional[TokenBucket]
+
+    def __init__(self, scope: str, rate: float, burst: int):
+        self.scope = scope
+        self._bucket = TokenBucket(rate, burst) if rate > 0 else None
+
+    def check(self) -> float:
+        if self._bucket is None:
+            return 0
+        retry_after = self._bucket.take()
+        RATE_LIMIT_DECISIONS.labels(self.scope, 'limited' if retry_after else 'allowed').inc()
+        return retry_after
+
+
+async def get_client_host(request: Request) -> Optional[str]:
+    return request.client.host if request.client else None
+
+
+async def get_body_email(request: Request) -> Optional[str]:
+    try:
+        data = await request.json()
+    except ValueError:
+        return None
+    email = data.get('email') if isinstance(data, dict) else None
+    return email.lower() if isinstance(email, str) else None
+
+
+class RateLimiter:
+    """Dependency rejecting the requests over the rate limit of their key with 429 Too Many Requests."""
+    scope: str
+    rate: float
+    burst: int
+
+    def __init__(self, scope: str, rate: float, burst: int, key: KeyFunc = get_client_host):
+        self.scope = scope
+        self.rate = rate
+        self.burst = burst
+        self.key = key
+
+    async def __call__(self, request: Request) -> None:
+        key = await self.key(request)
+        if key is None:
+            return
+
+        retry_after = await check_rate_limit(self.scope, key, self.rate, self.burst)
+        if retry_after:
+            raise HTTPException(
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                detail="Too many requests.",
+                headers={'Retry-After': str(math.ceil(retry_after))},
+            )
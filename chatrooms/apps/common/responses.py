@@ -0,0 +1,20 @@
+from typing import Any, Sequence
+
+from fastapi.responses import JSONResponse, Response
+
+from chatrooms.apps.common.encoders import json_dumps
+
+
+class FastJSONResponse(JSONResponse):
+
+    def render(self, content: Any) -> bytes:
+        return json_dumps(content)
+
+
+class EncodedPageResponse(Response):
+    """JSON page whose results are encoded already, so they are joined into the body as they are."""
+    media_type = 'application/json'
+
+    def __init__(self, page: dict, results: Sequence[bytes], **kwargs: Any):
+        content = json_dumps({**page, 'results': []})[:-3] + b'[' + b','.join(results) + b']}'
+        super().__init__(content=content, **kwargs)
@@ -7,3 +7,19 @@ class HealthCheck(BaseModel):
 
 class ResponseDetail(BaseModel):
     detail: str
+
+
+class RateLimited(BaseModel):
+    retry_after: float  # seconds
+
+
+class PoolStats(BaseModel):
+    min_size: int
+    max_size: int
+    size: int
+    idle: int
+    in_use: int
+    waiting: int
+    acquired: int
+    acquire_wait_avg_seconds: float
+    acquire_wait_max_seconds: float
@@ -0,0 +1,72 @@
+import asyncio
+
+from tortoise.transactions import get_connection
+
+from chatrooms.apps.common.broadcast import PostgresBroadcast
+
+
+async def test_postgres_broadcast():
+    received = asyncio.Queue()
+    backend1 = PostgresBroadcast(connection_name='models')
+    backend1.subscribe('test_channel', received.put)
+    backend2 = PostgresBroadcast(connection_name='models')
+
+    await backend1.connect()
+    try:
+        await backend2.publish('test_channel', 'chat:message')
+        assert await asyncio.wait_for(received.get(), timeout=5) == 'chat:message'
+    finally:
+        await backend1.disconnect()
+
+
+async def test_postgres_broadcast_dispatches_in_order():
+    received = []
+
+    async def listener(message: str) -> None:
+        # the first message takes the longest, but still comes first
+        await asyncio.sleep(0.05 if message == 'first' else 0)
+        received.append(message)
+
+    backend1 = PostgresBroadcast(connection_name='models')
+    backend1.subscribe('test_channel', listener)
+    backend2 = PostgresBroadcast(connection_name='models')
+
+    await backend1.connect()
+    try:
+        for message in ('first', 'second', 'third'):
+            await backend2.publish('test_channel', message)
+        for __ in range(50):
+            if len(received) == 3:
+                break
+            await asyncio.sleep(0.02)
+        assert received == ['first', 'second', 'third']
+    finally:
+        await backend1.disconnect()
+
+
+async def test_postgres_broadcast_reconnects(mocker):
+    mocker.patch('chatrooms.apps.common.broadcast.RECONNECT_INTERVAL', 0.05)
+    received = asyncio.Queue()
+    backend1 = PostgresBroadcast(connection_name='models')
+    backend1.subscribe('test_channel', received.put)
+    backend2 = PostgresBroadcast(connection_name='models')
+
+    await backend1.connect()
+    try:
+        lost_connection = backend1._connection
+        await backend2.publish('test_channel', 'before')
+        assert await asyncio.wait_for(received.get(), timeout=5) == 'before'
+
+        # the backend of the listening connection is killed, e.g. as the database restarts
+        client = get_connection('models')
+        await client.execute_query('SELECT pg_terminate_backend($1)', [lost_connection.get_server_pid()])
+        for __ in range(100):
+            if backend1._connection not in (None, lost_connection):
+                break
+            await asyncio.sleep(0.05)
+        assert backend1._connection not in (None, lost_connection)
+
+        await backend2.publish('test_channel', 'after')
+        assert await asyncio.wait_for(received.get(), timeout=5) == 'after'
+    finally:
+        await backend1.disconnect()
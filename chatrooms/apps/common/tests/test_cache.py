@@ -0,0 +1,47 @@
+from chatrooms.apps.common.cache import TTLCache
+
+
+def test_get_set():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('b', default=0) == 0
+
+    cache.delete('a')
+    assert cache.get('a') is None
+
+
+def test_expiration(mocker):
+    monotonic_mock = mocker.patch('time.monotonic', return_value=100)
+    cache = TTLCache(max_size=10, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2, ttl=5)
+
+    monotonic_mock.return_value = 104
+    assert cache.get('b') == 2
+    monotonic_mock.return_value = 105
+    assert cache.get('b') is None
+    assert cache.get('a') == 1
+    assert list(cache.items()) == [('a', 1)]
+
+    monotonic_mock.return_value = 160
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_lru_eviction():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+
+def test_disabled():
+    cache = TTLCache(max_size=0, ttl=60)
+    cache.set('a', 1)
+    assert cache.get('a') is None
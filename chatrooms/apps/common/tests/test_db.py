@@ -0,0 +1,120 @@
+import asyncio
+
+from pydantic import ValidationError
+import pytest
+
+from chatrooms.apps.chats.models import Chat
+from chatrooms.apps.common.broadcast import MemoryBroadcast
+from chatrooms.apps.common.db import (
+    InstrumentedAsyncpgDBClient, RecentWriters, get_pool_stats, get_read_connection, recent_writers,
+)
+from chatrooms.config import Settings, settings
+
+
+async def test_instrumented_pool():
+    source = Chat._meta.db
+    client = InstrumentedAsyncpgDBClient(
+        connection_name='stats', user=source.user, password=source.password, database=source.database,
+        host=source.host, port=source.port, minsize=1, maxsize=1, statement_cache_size=0,
+    )
+    await client.create_connection(with_db=True)
+    try:
+        pool = client._pool
+        connection = await pool.acquire()
+        waiter = asyncio.ensure_future(pool.acquire())
+        await asyncio.sleep(0.05)
+        assert pool.waiting == 1
+
+        await pool.release(connection)
+        await pool.release(await waiter)
+        assert pool.waiting == 0
+        assert pool.acquired == 2
+        assert pool.max_acquire_seconds >= 0.05
+    finally:
+        await client.close()
+
+
+async def test_get_read_connection(mocker):
+    assert get_read_connection(Chat) is Chat._meta.db
+
+    read_client = mocker.Mock()
+    mocker.patch.dict('tortoise.Tortoise._connections', {'read': read_client})
+    assert get_read_connection(Chat) is read_client
+    assert get_read_connection(Chat, user_id=1) is read_client
+
+    await recent_writers.add(1)
+    assert get_read_connection(Chat, user_id=1) is Chat._meta.db
+    assert get_read_connection(Chat, user_id=2) is read_client
+    assert get_read_connection(Chat) is read_client
+
+
+async def test_recent_writers(mocker):
+    mocker.patch.dict('tortoise.Tortoise._connections', {'read': mocker.Mock()})
+    broker = MemoryBroadcast()
+    writers1 = RecentWriters(broker, window=0.1)
+    writers2 = RecentWriters(broker, window=0.1)
+    publish = mocker.spy(broker, 'publish')
+
+    await writers1.add(1)
+    await writers1.add(1)  # published already, within the first half of the window
+    assert writers1.is_recent(1) and writers2.is_recent(1)
+    assert not writers2.is_recent(2)
+    assert publish.call_count == 1
+
+    await asyncio.sleep(0.06)
+    await writers2.add(1)
+    assert publish.call_count == 2
+    await writers2.add(2)
+
+    await asyncio.sleep(0.11)
+    assert not writers1.is_recent(1)
+    await writers1.add(3)
+    assert list(writers1._deadlines) == [3]
+
+
+async def test_recent_writers_marks_before_broadcast(mocker):
+    mocker.patch.dict('tortoise.Tortoise._connections', {'read': mocker.Mock()})
+    broker = MemoryBroadcast()
+    writers = RecentWriters(broker, window=5)
+    # the broadcast hasn't come back yet
+    mocker.patch.object(broker, 'publish', mocker.AsyncMock())
+
+    await writers.add(1)
+    assert writers.is_recent(1)
+
+
+async def test_recent_writers_without_read_connection(mocker):
+    broker = MemoryBroadcast()
+    writers = RecentWriters(broker, window=5)
+    publish = mocker.spy(broker, 'publish')
+
+    await writers.add(1)
+    assert not publish.called
+    assert not writers.is_recent(1)
+
+
+async def test_get_pool_stats(mocker):
+    mocker.patch.dict('tortoise.Tortoise._connections', {'default': Chat._meta.db})
+
+    stats = get_pool_stats()['default']
+    assert stats['in_use'] == stats['size'] - stats['idle']
+    assert stats['waiting'] == 0
+
+
+async def test_get_database_pool_stats(async_client, mocker):
+    mocker.patch.dict('tortoise.Tortoise._connections', {'default': Chat._meta.db})
+
+    response = await async_client.get(f'{settings.API_BASE_URL}/health/pool')
+    assert response.status_code == 200
+    assert set(response.json()['default']) >= {'size', 'idle', 'in_use', 'waiting', 'acquired'}
+
+
+@pytest.mark.parametrize('values', [
+    {'DB_POOL_MIN_SIZE': 5, 'DB_POOL_MAX_SIZE': 2},
+    {'DB_POOL_MAX_SIZE': 0},
+    {'DB_STATEMENT_CACHE_SIZE': -1},
+    {'DB_COMMAND_TIMEOUT': 0},
+])
+def test_pool_settings_validation(values):
+    with pytest.raises(ValidationError):
+        Settings(**values)
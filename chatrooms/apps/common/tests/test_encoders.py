@@ -0,0 +1,40 @@
+from datetime import datetime, timezone
+import json
+from uuid import uuid4
+
+from pydantic import BaseModel
+
+from chatrooms.apps.common import encoders
+from chatrooms.apps.common.encoders import json_dumps
+
+
+class Item(BaseModel):
+    id: int
+    uuid: object
+    title: str
+    created_at: datetime
+
+
+def make_item():
+    return Item(
+        id=1,
+        uuid=uuid4(),
+        title="Заголовок",
+        created_at=datetime(2022, 2, 26, 16, 42, 17, 123456, tzinfo=timezone.utc),
+    )
+
+
+def test_json_dumps():
+    item = make_item()
+    result = json_dumps({'item': item, 'items': [item.dict()]})
+    assert isinstance(result, bytes)
+    assert json.loads(result) == {'item': json.loads(item.json()), 'items': [json.loads(item.json())]}
+
+
+def test_json_dumps_without_orjson(mocker):
+    mocker.patch.object(encoders, 'orjson', None)
+
+    item = make_item()
+    result = json_dumps({'item': item})
+    assert isinstance(result, bytes)
+    assert json.loads(result) == {'item': json.loads(item.json())}
@@ -0,0 +1,110 @@
+import asyncpg
+import pytest
+
+from chatrooms.apps.chats.models import Chat
+from chatrooms.apps.common.metrics import (
+    DB_QUERY_SECONDS, MetricsRegistry, NULL_METRIC, QueryTimingConnection, get_query_operation,
+)
+from chatrooms.apps.chats.tests.factories import ChatFactory
+from chatrooms.config import settings
+
+
+def test_counter():
+    registry = MetricsRegistry(enabled=True)
+    counter = registry.counter('requests_total', "Requests.", ('method',))
+    counter.labels('GET').inc()
+    counter.labels('GET').inc(2)
+    counter.labels('POST').inc()
+
+    assert registry.render() == (
+        '# HELP requests_total Requests.\n'
+        '# TYPE requests_total counter\n'
+        'requests_total{method="GET"} 3.0\n'
+        'requests_total{method="POST"} 1.0\n'
+    )
+    with pytest.raises(ValueError):
+        counter.labels('GET', 'extra')
+
+
+def test_histogram():
+    registry = MetricsRegistry(enabled=True)
+    histogram = registry.histogram('duration_seconds', "Duration.", buckets=(0.1, 1))
+    histogram.observe(0.05)
+    histogram.observe(0.1)
+    histogram.observe(5)
+
+    assert registry.render() == (
+        '# HELP duration_seconds Duration.\n'
+        '# TYPE duration_seconds histogram\n'
+        'duration_seconds_bucket{le="0.1"} 2.0\n'
+        'duration_seconds_bucket{le="1.0"} 2.0\n'
+        'duration_seconds_bucket{le="+Inf"} 3.0\n'
+        'duration_seconds_count 3.0\n'
+        'duration_seconds_sum 5.15\n'
+    )
+
+
+def test_callback_metric():
+    registry = MetricsRegistry(enabled=True)
+    registry.register_callback('connections', "Connections.", lambda: [(('a"b',), 2)], ('room',))
+    assert registry.render() == (
+        '# HELP connections Connections.\n'
+        '# TYPE connections gauge\n'
+        'connections{room="a\\"b"} 2.0\n'
+    )
+
+    with pytest.raises(ValueError):
+        registry.register_callback('connections', "Connections.", lambda: [])
+
+
+def test_disabled():
+    registry = MetricsRegistry(enabled=False)
+    counter = registry.counter('requests_total', "Requests.", ('method',))
+    assert counter is NULL_METRIC
+    counter.labels('GET').inc()
+    registry.histogram('duration_seconds', "Duration.").observe(1)
+    assert registry.render() == ''
+
+
+@pytest.mark.parametrize('query, operation', [
+    ('SELECT 1', 'SELECT'),
+    ('\n  insert into "chat" ...', 'INSERT'),
+    ('BEGIN', 'OTHER'),
+    ('', 'OTHER'),
+])
+def test_get_query_operation(query, operation):
+    assert get_query_operation(query) == operation
+
+
+async def test_query_timing_connection():
+    client = Chat._meta.db
+    connection = await asyncpg.connect(
+        host=client.host, port=client.port, user=client.user, password=client.password, database=client.database,
+        connection_class=QueryTimingConnection,
+    )
+    select_count = DB_QUERY_SECONDS.labels('SELECT').counts[:]
+    try:
+        await connection.fetch('SELECT 1')
+    finally:
+        await connection.close()
+    assert sum(DB_QUERY_SECONDS.labels('SELECT').counts) == sum(select_count) + 1
+
+
+async def test_get_metrics(async_client, user):
+    chat = await ChatFactory(creator=user)
+    await async_client.get(f'{settings.API_BASE_URL}/health/status')
+    await async_client.get(f'{settings.API_BASE_URL}/chats/{chat.id}/messages')
+
+    response = await async_client.get(f'{settings.API_BASE_URL}/health/metrics')
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/plain')
+    samples = {line.rsplit(' ', 1)[0] for line in response.text.splitlines()}
+    base_url = settings.API_BASE_URL
+    assert f'http_request_duration_seconds_count{{method="GET",path="{base_url}/health/status",status="200"}}' in samples
+    assert (
+        f'http_request_duration_seconds_count{{method="GET",path="{base_url}/chats/{{chat_id}}/messages",status="403"}}'
+        in samples
+    )
+    assert '# TYPE db_pool_connections' in samples
+    assert 'chat_websocket_connections' in samples
+    assert 'chat_websocket_chats{le="+Inf"}' in samples
@@ -1,9 +1,13 @@
 from typing import List
 
+from urllib.parse import parse_qs, urlparse
+
 from fastapi import Request
 from pydantic import BaseModel
+import pytest
 
-from chatrooms.apps.common.pagination import PageNumberPagination
+from chatrooms.apps.common.exceptions import BadInputError
+from chatrooms.apps.common.pagination import CursorPagination, PageNumberPagination
 from chatrooms.apps.users.models import User
 from chatrooms.apps.users.tests.factories import UserFactory
 
@@ -19,6 +23,25 @@ class UserPageNumberPagination(PageNumberPagination):
     results: List[UserTest]
 
 
+class UserCursorPagination(CursorPagination):
+    results: List[UserTest]
+
+
+def make_request(query_string: bytes) -> Request:
+    return Request(scope={
+        'type': 'http',
+        'scheme': 'http',
+        'server': ('127.0.0.1', 3000),
+        'path': '/api/v1/test',
+        'query_string': query_string,
+        'headers': {},
+    })
+
+
+def get_cursor(url: str) -> str:
+    return parse_qs(urlparse(url).query)['cursor'][0]
+
+
 async def test_paginate_queryset():
     users = await UserFactory.create_batch(size=5)
     request = Request(scope={
@@ -67,3 +90,64 @@ async def test_paginate_queryset():
     assert result.previous == "http://127.0.0.1:3000/api/v1/test?name=John&page=2&age=33"
     assert len(result.results) == 1
     assert result.results[0].id == users[4].id
+
+
+async def test_cursor_paginate_queryset():
+    users = await UserFactory.create_batch(size=5)
+    request = make_request(b'name=John')
+
+    result = await UserCursorPagination.paginate_queryset(
+        qs=User.all(), ordering=('id',), page_size=2, cursor=None, request=request,
+    )
+    assert result.previous is None
+    assert result.next.startswith("http://127.0.0.1:3000/api/v1/test?name=John&cursor=")
+    assert [user.id for user in result.results] == [users[0].id, users[1].id]
+
+    result = await UserCursorPagination.paginate_queryset(
+        qs=User.all(), ordering=('id',), page_size=2, cursor=get_cursor(result.next), request=request,
+    )
+    assert [user.id for user in result.results] == [users[2].id, users[3].id]
+    assert result.previous is not None
+
+    result = await UserCursorPagination.paginate_queryset(
+        qs=User.all(), ordering=('id',), page_size=2, cursor=get_cursor(result.next), request=request,
+    )
+    assert [user.id for user in result.results] == [users[4].id]
+    assert result.next is None
+
+    result = await UserCursorPagination.paginate_queryset(
+        qs=User.all(), ordering=('id',), page_size=2, cursor=get_cursor(result.previous), request=request,
+    )
+    assert [user.id for user in result.results] == [users[2].id, users[3].id]
+
+    result = await UserCursorPagination.paginate_queryset(
+        qs=User.all(), ordering=('id',), page_size=2, cursor=get_cursor(result.previous), request=request,
+    )
+    assert [user.id for user in result.results] == [users[0].id, users[1].id]
+    assert result.previous is None
+    assert result.next is not None
+
+
+async def test_cursor_paginate_queryset_composite_ordering():
+    users = await UserFactory.create_batch(size=4)
+    await User.filter(id__in=[users[1].id, users[2].id]).update(date_join=users[0].date_join)
+    expected_ids = [users[3].id, users[2].id, users[1].id, users[0].id]  # ties on date_join are ordered by id
+    request = make_request(b'')
+
+    cursor, ids = None, []
+    for __ in range(4):
+        result = await UserCursorPagination.paginate_queryset(
+            qs=User.all(), ordering=('-date_join', '-id'), page_size=1, cursor=cursor, request=request,
+        )
+        ids.extend(user.id for user in result.results)
+        if result.next is None:
+            break
+        cursor = get_cursor(result.next)
+    assert ids == expected_ids
+
+
+async def test_cursor_paginate_queryset_invalid_cursor():
+    with pytest.raises(BadInputError):
+        await UserCursorPagination.paginate_queryset(
+            qs=User.all(), ordering=('id',), page_size=2, cursor='not-a-cursor', request=make_request(b''),
+        )
@@ -0,0 +1,75 @@
+import math
+
+from fastapi import HTTPException
+import pytest
+
+from chatrooms.apps.common.ratelimit import (
+    LocalRateLimit, MemoryRateLimitBackend, RateLimiter, TokenBucket, check_rate_limit,
+)
+
+
+def test_token_bucket(mocker):
+    monotonic_mock = mocker.patch('time.monotonic', return_value=100)
+    bucket = TokenBucket(rate=2, burst=3)
+    assert [bucket.take() for __ in range(3)] == [0, 0, 0]
+    assert bucket.take() == 0.5
+
+    monotonic_mock.return_value = 100.5
+    assert bucket.take() == 0
+    assert bucket.take() == 0.5
+
+    monotonic_mock.return_value = 200
+    assert [bucket.take() for __ in range(3)] == [0, 0, 0]
+    assert bucket.take() > 0
+
+
+def test_token_bucket_no_rate():
+    bucket = TokenBucket(rate=0, burst=1)
+    assert bucket.take() == 0
+    assert bucket.take() == math.inf
+
+
+async def test_memory_backend_evicts_least_recently_hit(mocker):
+    mocker.patch('time.monotonic', return_value=100)
+    backend = MemoryRateLimitBackend(max_keys=2)
+    assert await backend.hit('a', rate=1, burst=1) == 0
+    assert await backend.hit('b', rate=1, burst=1) == 0
+    assert await backend.hit('a', rate=1, burst=1) == 1
+    assert await backend.hit('c', rate=1, burst=1) == 0
+
+    # "b" has been evicted, so its bucket is full again
+    assert await backend.hit('b', rate=1, burst=1) == 0
+    assert await backend.hit('c', rate=1, burst=1) == 1
+
+
+async def test_check_rate_limit():
+    assert await check_rate_limit('test', 'key', rate=1, burst=1) == 0
+    assert await check_rate_limit('test', 'key', rate=1, burst=1) > 0
+    assert await check_rate_limit('test', 'other', rate=1, burst=1) == 0
+    assert await check_rate_limit('test_other', 'key', rate=1, burst=1) == 0
+
+    assert all([await check_rate_limit('test_off', 'key', rate=0, burst=0) == 0 for __ in range(10)])
+
+
+def test_local_rate_limit():
+    rate_limit = LocalRateLimit('test', rate=1, burst=2)
+    assert rate_limit.check() == 0
+    assert rate_limit.check() == 0
+    assert rate_limit.check() > 0
+
+    rate_limit = LocalRateLimit('test', rate=0, burst=0)
+    assert rate_limit.check() == 0
+
+
+async def test_rate_limiter(mocker):
+    request = mocker.Mock(client=mocker.Mock(host='127.0.0.1'))
+    rate_limiter = RateLimiter('test', rate=0.5, burst=1)
+    await rate_limiter(request)
+
+    with pytest.raises(HTTPException) as exc_info:
+        await rate_limiter(request)
+    assert exc_info.value.status_code == 429
+    assert exc_info.value.headers == {'Retry-After': '2'}
+
+    await rate_limiter(mocker.Mock(client=mocker.Mock(host='127.0.0.2')))
+    await rate_limiter(mocker.Mock(client=None))
@@ -1,22 +1,91 @@
+from copy import copy
+from typing import Optional
+
 from fastapi import Security, HTTPException
 from fastapi.security import APIKeyHeader
 from starlette.status import HTTP_401_UNAUTHORIZED
 from tortoise.exceptions import DoesNotExist
 
+from chatrooms.apps.common.broadcast import BroadcastBackend, broadcast
+from chatrooms.apps.common.cache import TTLCache
 from chatrooms.apps.users.models import Token, User
+from chatrooms.config import settings
 
 
 authorization_header = APIKeyHeader(name='Authorization')
 
+_MISSING = object()
+
+
+class TokenCache:
+    """
+    Caches users of auth tokens, unknown tokens included, for a short time.
+    Invalidation is published through the broadcast backend, so it reaches every worker.
+    Every request gets its own copy of the cached user.
+    """
+    CHANNEL = 'auth_tokens'
+
+    negative_ttl: float
+
+    _cache: TTLCache
+    _broadcast: BroadcastBackend
+    _generation: int  # of the invalidations, a lookup overlapping one isn't cached
+
+    def __init__(self, broadcast_backend: BroadcastBackend, max_size: int, ttl: float, negative_ttl: float):
+        self.negative_ttl = negative_ttl
+        self._cache = TTLCache(max_size=max_size, ttl=ttl)
+        self._generation = 0
+        self._broadcast = broadcast_backend
+        self._broadcast.subscribe(self.CHANNEL, self._on_broadcast)
+
+    async def get_user(self, token_key: str) -> Optional[User]:
+        user = self._cache.get(token_key, default=_MISSING)
+        if user is not _MISSING:
+            return copy(user)
+
+        generation = self._generation
+        try:
+            token = await Token.all().select_related('user').get(key=token_key)
+        except DoesNotExist:
+            self._cache.set(token_key, None, ttl=self.negative_ttl)
+            return None
+
+        if generation == self._generation:
+            self._cache.set(token_key, copy(token.user))
+        return token.user
+
+    async def invalidate_user(self, user_id: int) -> None:
+        self._invalidate_user(user_id)
+        await self._broadcast.publish(self.CHANNEL, str(user_id))
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def _invalidate_user(self, user_id: int) -> None:
+        self._generation += 1
+        for token_key, user in self._cache.items():
+            if user is not None and user.id == user_id:
+                self._cache.delete(token_key)
+
+    async def _on_broadcast(self, message: str) -> None:
+        self._invalidate_user(int(message))
+
+
+token_cache = TokenCache(
+    broadcast,
+    max_size=settings.AUTH_TOKEN_CACHE_SIZE,
+    ttl=settings.AUTH_TOKEN_CACHE_TTL,
+    negative_ttl=settings.AUTH_TOKEN_CACHE_NEGATIVE_TTL,
+)
+
 
 async def get_current_user(authorization: str = Security(authorization_header)) -> User:
     token_key = extract_token_from_header(authorization)
-    try:
-        token = await Token.all().select_related('user').get(key=token_key)
-    except DoesNotExist:
+    user = await token_cache.get_user(token_key)
+    if user is None:
         raise HTTPException(status_code=HTTP_401_UNAUTHORIZED, detail='Invalid token header.')
 
-    return token.user
+    return user
 
 
 def extract_token_from_header(authorization: str) -> str:
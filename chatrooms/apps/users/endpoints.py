@@ -2,23 +2,34 @@ from fastapi import APIRouter, Depends, status, BackgroundTasks
 from fastapi_mail import MessageSchema
 
 from chatrooms.apps.common.mail import fast_mail
+from chatrooms.apps.common.ratelimit import RateLimiter, get_body_email
 from chatrooms.apps.common.schemas import ResponseDetail
 from chatrooms.apps.users import services as user_services
 from chatrooms.apps.users.authentication import get_current_user
 from chatrooms.apps.users.models import User
 from chatrooms.apps.users.schemas import UserRegister, UserLogin, TokenResult, PasswordReset, PasswordResetConfirm
+from chatrooms.config import settings
 
 
 auth_router = APIRouter()
 
 
+def get_auth_rate_limits(scope: str) -> list:
+    return [
+        Depends(RateLimiter(scope, settings.AUTH_HOST_RATE_LIMIT_RATE, settings.AUTH_HOST_RATE_LIMIT_BURST)),
+        Depends(RateLimiter(
+            f'{scope}_email', settings.AUTH_RATE_LIMIT_RATE, settings.AUTH_RATE_LIMIT_BURST, key=get_body_email,
+        )),
+    ]
+
+
 @auth_router.post('/register', response_model=TokenResult, status_code=status.HTTP_201_CREATED)
 async def register_user(user_data: UserRegister):
     token = await user_services.register_user(user_data)
     return TokenResult.from_orm(token)
 
 
-@auth_router.post('/login', response_model=TokenResult)
+@auth_router.post('/login', response_model=TokenResult, dependencies=get_auth_rate_limits('login'))
 async def login_user(user_data: UserLogin):
     token = await user_services.login_user(user_data)
     return TokenResult.from_orm(token)
@@ -30,7 +41,9 @@ async def logout_user(user: User = Depends(get_current_user)):
     return {'detail': "Logged out"}
 
 
-@auth_router.post('/password/reset', response_model=ResponseDetail)
+@auth_router.post(
+    '/password/reset', response_model=ResponseDetail, dependencies=get_auth_rate_limits('password_reset'),
+)
 async def reset_password(password_reset: PasswordReset, background_tasks: BackgroundTasks):
     reset_creds = await user_services.reset_password(email=password_reset.email)
     if reset_creds:
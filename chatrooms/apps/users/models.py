@@ -1,6 +1,7 @@
 from tortoise import fields, models
 
-from chatrooms.apps.users.security import generate_token, verify_password
+from chatrooms.apps.users.security import generate_token, password_hasher, verify_password
+from chatrooms.config import settings
 
 
 class User(models.Model):
@@ -11,6 +12,16 @@ class User(models.Model):
     def check_password(self, password):
         return verify_password(plain_password=password, hashed_password=self.password)
 
+    async def verify_password(self, password: str) -> bool:
+        if not settings.PASSWORD_REHASH_ON_LOGIN:
+            return await password_hasher.verify(password, self.password)
+
+        is_valid, new_password_hash = await password_hasher.verify_and_update(password, self.password)
+        if is_valid and new_password_hash:
+            self.password = new_password_hash
+            await self.save(update_fields=['password'])
+        return is_valid
+
 
 class Token(models.Model):
     key = fields.CharField(max_length=40, pk=True)
@@ -1,10 +1,23 @@
+import asyncio
 import binascii
+from concurrent.futures import ThreadPoolExecutor
 import os
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
 
 from passlib.context import CryptContext
 
+from chatrooms.config import settings
 
-password_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+
+password_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    bcrypt__default_rounds=settings.PASSWORD_HASH_ROUNDS,
+    # hashes made with other rounds are reported as needing an update
+    bcrypt__min_rounds=settings.PASSWORD_HASH_ROUNDS,
+    bcrypt__max_rounds=settings.PASSWORD_HASH_ROUNDS,
+)
 
 
 def verify_password(plain_password: str, hashed_password: str) -> bool:
@@ -15,5 +28,68 @@ def get_password_hash(password: str) -> str:
     return password_context.hash(password)
 
 
+class PasswordHasher:
+    """
+    Runs password hashing in a thread pool, so bcrypt doesn't block the event loop.
+    At most `max_workers` hashes are computed at once, the rest wait in a queue.
+    """
+    context: CryptContext
+    max_workers: int
+
+    running: int
+    waiting: int
+    completed: int
+    total_wait_time: float
+
+    def __init__(self, context: CryptContext, max_workers: int):
+        self.context = context
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='password-hasher')
+        self._semaphore = asyncio.Semaphore(max_workers)
+
+        self.running = 0
+        self.waiting = 0
+        self.completed = 0
+        self.total_wait_time = 0.0
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._run(self.context.verify, password, hashed_password)
+
+    async def verify_and_update(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        return await self._run(self.context.verify_and_update, password, hashed_password)
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            'max_workers': self.max_workers,
+            'running': self.running,
+            'waiting': self.waiting,
+            'completed': self.completed,
+            'total_wait_time': self.total_wait_time,
+        }
+
+    async def _run(self, func: Callable, *args: Any) -> Any:
+        self.waiting += 1
+        queued_at = time.monotonic()
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        self.total_wait_time += time.monotonic() - queued_at
+        self.running += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.running -= 1
+            self.completed += 1
+            self._semaphore.release()
+
+
+password_hasher = PasswordHasher(password_context, max_workers=settings.PASSWORD_HASHER_WORKERS)
+
+
 def generate_token() -> str:
     return binascii.hexlify(os.urandom(20)).decode()
@@ -7,9 +7,10 @@ from tortoise.exceptions import DoesNotExist
 
 from chatrooms.apps.common.exceptions import BadInputError
 from chatrooms.apps.common.utils import base36_to_int, int_to_base36
+from chatrooms.apps.users.authentication import token_cache
 from chatrooms.apps.users.models import User, Token
 from chatrooms.apps.users.schemas import UserRegister, UserLogin, PasswordResetCredentials, PasswordResetConfirm
-from chatrooms.apps.users.security import get_password_hash
+from chatrooms.apps.users.security import password_hasher
 from chatrooms.config import settings
 
 
@@ -18,7 +19,7 @@ async def register_user(user_data: UserRegister) -> Token:
     if is_user_exists:
         raise BadInputError({'email': "User with the email already exists."})
 
-    password_hash = get_password_hash(user_data.password)
+    password_hash = await password_hasher.hash(user_data.password)
     user = await User.create(**user_data.dict(exclude={'password'}), password=password_hash)
     token = await Token.generate(user)
     return token
@@ -32,7 +33,7 @@ async def login_user(user_data: UserLogin) -> Token:
     except DoesNotExist:
         raise BadInputError(error_message)
 
-    if not user.check_password(password=user_data.password):
+    if not await user.verify_password(password=user_data.password):
         raise BadInputError(error_message)
 
     try:
@@ -45,6 +46,7 @@ async def login_user(user_data: UserLogin) -> Token:
 
 async def logout_user(user: User) -> None:
     await Token.filter(user=user).delete()
+    await token_cache.invalidate_user(user.id)
 
 
 class PasswordResetTokenGenerator:
@@ -120,6 +122,7 @@ async def confirm_password_reset(confirm: PasswordResetConfirm) -> None:
     if not PasswordResetTokenGenerator().check_token(user, token=confirm.token):
         raise BadInputError({'token': 'Invalid or expired token'})
 
-    password_hash = get_password_hash(confirm.new_password)
+    password_hash = await password_hasher.hash(confirm.new_password)
     user.password = password_hash
     await user.save(update_fields=['password'])
+    await token_cache.invalidate_user(user.id)
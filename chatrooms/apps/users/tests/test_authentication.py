@@ -0,0 +1,74 @@
+from fastapi import status
+
+from chatrooms.apps.common.broadcast import MemoryBroadcast
+from chatrooms.apps.users.authentication import TokenCache
+from chatrooms.apps.users.models import Token
+from chatrooms.apps.users.tests.factories import UserFactory
+from chatrooms.apps.users.tests.utils import authenticate
+
+
+class TestTokenCache:
+
+    async def test_get_user(self, user):
+        token = await Token.generate(user)
+        cache = TokenCache(MemoryBroadcast(), max_size=10, ttl=60, negative_ttl=60)
+
+        cached_user = await cache.get_user(token.key)
+        assert cached_user.id == user.id
+
+        await token.delete()
+        cached_user.email = 'changed@example.com'
+        cached_user = await cache.get_user(token.key)
+        assert cached_user.id == user.id
+        assert cached_user.email == user.email
+
+    async def test_get_user_unknown_token(self, user):
+        cache = TokenCache(MemoryBroadcast(), max_size=10, ttl=60, negative_ttl=60)
+
+        assert await cache.get_user('unknown') is None
+        await Token.create(key='unknown', user=user)
+        assert await cache.get_user('unknown') is None
+
+    async def test_invalidate_user(self, user):
+        other_user = await UserFactory()
+        token = await Token.generate(user)
+        other_token = await Token.generate(other_user)
+        broker = MemoryBroadcast()
+        cache = TokenCache(broker, max_size=10, ttl=60, negative_ttl=60)
+        other_worker_cache = TokenCache(broker, max_size=10, ttl=60, negative_ttl=60)
+
+        for token_cache in [cache, other_worker_cache]:
+            await token_cache.get_user(token.key)
+            await token_cache.get_user(other_token.key)
+
+        await token.delete()
+        await cache.invalidate_user(user.id)
+        for token_cache in [cache, other_worker_cache]:
+            assert await token_cache.get_user(token.key) is None
+            assert (await token_cache.get_user(other_token.key)).id == other_user.id
+
+    async def test_invalidate_user_during_lookup(self, user, mocker):
+        token = await Token.generate(user)
+        cache = TokenCache(MemoryBroadcast(), max_size=10, ttl=60, negative_ttl=60)
+
+        found_token = await Token.all().select_related('user').get(key=token.key)
+
+        # the token is deleted and invalidated while it's being looked up
+        async def get(*args, **kwargs):
+            await token.delete()
+            await cache.invalidate_user(user.id)
+            return found_token
+
+        mocker.patch('tortoise.queryset.QuerySet.get', side_effect=get)
+        assert (await cache.get_user(token.key)).id == user.id
+        mocker.stopall()
+        assert await cache.get_user(token.key) is None
+
+
+async def test_logout_invalidates_token(async_client, user):
+    await authenticate(async_client, user)
+    response = await async_client.post('/api/v1/auth/logout')
+    assert response.status_code == status.HTTP_200_OK
+
+    response = await async_client.post('/api/v1/auth/logout')
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
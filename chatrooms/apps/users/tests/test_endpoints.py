@@ -5,6 +5,7 @@ from chatrooms.apps.common.utils import int_to_base36
 from chatrooms.apps.users.models import User, Token
 from chatrooms.apps.users.tests.factories import USER_PASSWORD
 from chatrooms.apps.users.tests.utils import authenticate
+from chatrooms.config import settings
 
 
 async def test_register_user(async_client):
@@ -109,6 +110,31 @@ async def test_login_user_invalid_password(async_client, user):
     assert data['non_field_errors'] == "Invalid email or password."
 
 
+async def test_login_user_rate_limited(async_client, user):
+    payload = {
+        "email": user.email,
+        "password": "wrongpassword",
+    }
+
+    for __ in range(settings.AUTH_RATE_LIMIT_BURST):
+        response = await async_client.post('/api/v1/auth/login', json=payload)
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+    response = await async_client.post('/api/v1/auth/login', json={**payload, "password": USER_PASSWORD})
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert int(response.headers['Retry-After']) > 0
+    assert not await Token.filter(user=user).exists()
+
+
+async def test_login_rate_limited_per_email(async_client, user):
+    # the requests of a host for many emails, e.g. the users behind a proxy, are limited by the host's limit only
+    for i in range(settings.AUTH_RATE_LIMIT_BURST + 1):
+        response = await async_client.post(
+            '/api/v1/auth/login', json={"email": f"user{i}@example.com", "password": "wrongpassword"},
+        )
+        assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+
 async def test_logout_user(async_client, user):
     await authenticate(async_client, user)
     assert await Token.filter(user=user).exists()
@@ -0,0 +1,62 @@
+import asyncio
+
+from passlib.context import CryptContext
+
+from chatrooms.apps.users.models import User
+from chatrooms.apps.users.security import PasswordHasher
+from chatrooms.apps.users.tests.factories import UserFactory, USER_PASSWORD
+
+
+def make_context(rounds: int) -> CryptContext:
+    return CryptContext(
+        schemes=["bcrypt"],
+        bcrypt__default_rounds=rounds,
+        bcrypt__min_rounds=rounds,
+        bcrypt__max_rounds=rounds,
+    )
+
+
+class TestPasswordHasher:
+
+    async def test_hash_verify(self):
+        hasher = PasswordHasher(make_context(rounds=4), max_workers=1)
+
+        password_hash = await hasher.hash('password')
+        assert await hasher.verify('password', password_hash)
+        assert not await hasher.verify('not_a_password', password_hash)
+        assert await hasher.verify_and_update('password', password_hash) == (True, None)
+
+    async def test_verify_and_update_changed_rounds(self):
+        old_password_hash = make_context(rounds=4).hash('password')
+        hasher = PasswordHasher(make_context(rounds=5), max_workers=1)
+
+        is_valid, new_password_hash = await hasher.verify_and_update('password', old_password_hash)
+        assert is_valid
+        assert new_password_hash.startswith('$2b$05$')
+        assert await hasher.verify('password', new_password_hash)
+
+    async def test_concurrency_limit(self):
+        hasher = PasswordHasher(make_context(rounds=4), max_workers=2)
+
+        tasks = [asyncio.create_task(hasher.hash(f'password{i}')) for i in range(5)]
+        await asyncio.sleep(0)
+        stats = hasher.get_stats()
+        assert stats['running'] == 2
+        assert stats['waiting'] == 3
+
+        await asyncio.gather(*tasks)
+        stats = hasher.get_stats()
+        assert stats['running'] == 0
+        assert stats['waiting'] == 0
+        assert stats['completed'] == 5
+
+
+async def test_user_verify_password_rehash(mocker):
+    user = await UserFactory(password=make_context(rounds=4).hash(USER_PASSWORD))
+    mocker.patch('chatrooms.apps.users.models.password_hasher', PasswordHasher(make_context(rounds=5), max_workers=1))
+
+    assert not await user.verify_password('not_a_password')
+    assert await user.verify_password(USER_PASSWORD)
+    await user.refresh_from_db()
+    assert user.password.startswith('$2b$05$')
+    assert (await User.get(id=user.id)).check_password(USER_PASSWORD)
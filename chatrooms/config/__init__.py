@@ -34,6 +34,40 @@ class Settings(BaseSettings):
             password=values.get("POSTGRES_PASSWORD"),
         )
 
+    DATABASE_REPLICA_URI: Optional[PostgresDsn] = None  # for the listing endpoints, the primary is used if not set
+    DB_READ_YOUR_WRITES_WINDOW: float = 5  # seconds a user's reads stay on the primary after their writes
+
+    DB_POOL_MIN_SIZE: int = 1
+    DB_POOL_MAX_SIZE: int = 5
+    # of a separate pool for the listing endpoints, 0 shares the default one or, with a replica, is DB_POOL_MAX_SIZE
+    DB_READ_POOL_MAX_SIZE: int = 0
+    DB_POOL_MAX_INACTIVE_LIFETIME: float = 300  # seconds, 0 keeps idle connections open
+    DB_STATEMENT_CACHE_SIZE: int = 100  # prepared statements per connection, 0 disables it (e.g. for pgbouncer)
+    DB_COMMAND_TIMEOUT: Optional[float] = None  # seconds
+
+    @validator(
+        "DB_READ_YOUR_WRITES_WINDOW", "DB_POOL_MIN_SIZE", "DB_READ_POOL_MAX_SIZE", "DB_POOL_MAX_INACTIVE_LIFETIME",
+        "DB_STATEMENT_CACHE_SIZE",
+    )
+    def check_not_negative(cls, v: Union[int, float]) -> Union[int, float]:
+        if v < 0:
+            raise ValueError("Must not be negative")
+        return v
+
+    @validator("DB_POOL_MAX_SIZE")
+    def check_pool_max_size(cls, v: int, values: Dict[str, Any]) -> int:
+        if v < 1:
+            raise ValueError("Must be at least 1")
+        if values.get("DB_POOL_MIN_SIZE", 0) > v:
+            raise ValueError("Must not be less than DB_POOL_MIN_SIZE")
+        return v
+
+    @validator("DB_COMMAND_TIMEOUT")
+    def check_command_timeout(cls, v: Optional[float]) -> Optional[float]:
+        if v is not None and v <= 0:
+            raise ValueError("Must be positive")
+        return v
+
     CORS_ORIGINS: List[AnyHttpUrl] = []
 
     @validator("CORS_ORIGINS", pre=True)
@@ -44,6 +78,119 @@ class Settings(BaseSettings):
             return v
         raise ValueError(v)
 
+    BROADCAST_BACKEND: str = "memory"
+
+    @validator("BROADCAST_BACKEND")
+    def check_broadcast_backend(cls, v: str) -> str:
+        if v not in ("memory", "postgres"):
+            raise ValueError(f"Unknown broadcast backend: {v}")
+        return v
+
+    PASSWORD_HASH_ROUNDS: int = 12
+    PASSWORD_HASHER_WORKERS: int = 2
+    PASSWORD_REHASH_ON_LOGIN: bool = True
+
+    AUTH_TOKEN_CACHE_SIZE: int = 10000
+    AUTH_TOKEN_CACHE_TTL: float = 60  # seconds
+    AUTH_TOKEN_CACHE_NEGATIVE_TTL: float = 5  # seconds
+
+    WS_SEND_QUEUE_SIZE: int = 256
+    WS_SEND_QUEUE_OVERFLOW: str = "drop_oldest"
+    WS_SEND_QUEUE_CLOSE_CODE: int = 1013  # try again later
+
+    @validator("WS_SEND_QUEUE_OVERFLOW")
+    def check_send_queue_overflow(cls, v: str) -> str:
+        if v not in ("drop_oldest", "disconnect"):
+            raise ValueError(f"Unknown send queue overflow policy: {v}")
+        return v
+
+    WS_REPLAY_BATCH_SIZE: int = 100
+
+    # permessage-deflate of the websockets, when the client offers it; compression is done per connection,
+    # so it trades the CPU time of fan-outs for bandwidth
+    WS_PER_MESSAGE_DEFLATE: bool = True
+    WS_DEFLATE_COMPRESS_LEVEL: int = 6  # 1 (fastest) - 9 (smallest)
+    WS_DEFLATE_MEMORY_LEVEL: int = 5  # 1 - 9, of the compression state kept per connection
+    WS_DEFLATE_MAX_WINDOW_BITS: int = 12  # 9 - 15, of the server's compression window
+    WS_DEFLATE_NO_CONTEXT_TAKEOVER: bool = False  # compress every frame on its own, saving memory but not bytes
+
+    @validator("WS_DEFLATE_COMPRESS_LEVEL", "WS_DEFLATE_MEMORY_LEVEL")
+    def check_deflate_level(cls, v: int) -> int:
+        if not 1 <= v <= 9:
+            raise ValueError("Must be between 1 and 9")
+        return v
+
+    @validator("WS_DEFLATE_MAX_WINDOW_BITS")
+    def check_deflate_window_bits(cls, v: int) -> int:
+        if not 9 <= v <= 15:
+            raise ValueError("Must be between 9 and 15")
+        return v
+
+    # while a chat gets WS_BATCH_HOT_CHAT_RATE messages per second or more, the websockets opting in with `batch=1`
+    # get its messages every WS_BATCH_DELAY seconds, in a single frame; a zero rate disables batching
+    WS_BATCH_HOT_CHAT_RATE: float = 50
+    WS_BATCH_DELAY: float = 0.005  # seconds
+    WS_BATCH_MAX_SIZE: int = 100  # messages per frame
+
+    CHAT_PRESENCE_INTERVAL: float = 0.25  # seconds between the presence diffs of a chat
+    CHAT_TYPING_DEBOUNCE: float = 3  # seconds, a user's typing is published at most once per this period
+
+    # on shutdown the websockets are closed a batch at a time, each told to reconnect after a random delay
+    WS_DRAIN_BATCH_SIZE: int = 100
+    WS_DRAIN_BATCH_INTERVAL: float = 0.1  # seconds
+    WS_DRAIN_FLUSH_TIMEOUT: float = 2  # seconds to wait for the queued messages of a websocket to be sent
+    WS_DRAIN_RECONNECT_JITTER: float = 10  # seconds, the upper bound of the reconnect delay
+
+    @validator("WS_DRAIN_BATCH_SIZE", "WS_BATCH_MAX_SIZE")
+    def check_batch_size(cls, v: int) -> int:
+        if v < 1:
+            raise ValueError("Must be at least 1")
+        return v
+
+    RATE_LIMIT_BACKEND: str = "memory"
+    RATE_LIMIT_MAX_KEYS: int = 100000
+
+    @validator("RATE_LIMIT_BACKEND")
+    def check_rate_limit_backend(cls, v: str) -> str:
+        if v not in ("memory",):
+            raise ValueError(f"Unknown rate limit backend: {v}")
+        return v
+
+    # requests per second and the burst allowed above it; a zero rate disables the limit
+    AUTH_RATE_LIMIT_RATE: float = 0.1  # of login and password reset requests, per email
+    AUTH_RATE_LIMIT_BURST: int = 10
+    AUTH_HOST_RATE_LIMIT_RATE: float = 2  # of the same, per client host, which may be shared e.g. behind a NAT
+    AUTH_HOST_RATE_LIMIT_BURST: int = 100
+    WS_MESSAGES_RATE_LIMIT_RATE: float = 5  # per websocket
+    WS_MESSAGES_RATE_LIMIT_BURST: int = 20
+    USER_MESSAGES_RATE_LIMIT_RATE: float = 10  # per user, across their websockets
+    USER_MESSAGES_RATE_LIMIT_BURST: int = 40
+    WS_ACTIONS_RATE_LIMIT_RATE: float = 10  # of the typing, presence and read actions, per websocket
+    WS_ACTIONS_RATE_LIMIT_BURST: int = 40
+
+    CHAT_MESSAGES_BATCH_SIZE: int = 100
+    # seconds a write of the messages waits for its batch to fill, zero writes as soon as the previous write is done
+    CHAT_MESSAGES_FLUSH_INTERVAL: float = 0
+    CHAT_MESSAGES_MAX_PENDING: int = 10000
+
+    # the messages are partitioned by month, see chatrooms.apps.chats.partitions
+    CHAT_MESSAGE_PARTITIONS_AHEAD: int = 3  # months after the current one
+    CHAT_MESSAGE_RETENTION_MONTHS: int = 0  # the partitions older than this are dropped, zero keeps all of them
+
+    CHAT_READ_MARKERS_BATCH_SIZE: int = 1000
+    CHAT_READ_MARKERS_FLUSH_INTERVAL: float = 1  # seconds
+    CHAT_UNREAD_COUNT_LIMIT: int = 1000  # unread messages of a chat are counted up to this
+
+    CHAT_ACCESS_CACHE_SIZE: int = 10000
+    CHAT_ACCESS_CACHE_TTL: float = 30  # seconds
+
+    CHAT_RECENT_MESSAGES_SIZE: int = 50  # per chat, 0 disables the cache
+    CHAT_RECENT_MESSAGES_MAX_BYTES: int = 32 * 1024 * 1024
+
+    CHAT_EXPORT_BATCH_SIZE: int = 1000
+
+    METRICS_ENABLED: bool = True
+
     APPS_MODELS: List[str] = [
         "chatrooms.apps.users.models",
         "chatrooms.apps.chats.models",
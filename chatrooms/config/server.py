@@ -0,0 +1,75 @@
+"""
+Runs the app with uvicorn, draining the chat websockets on shutdown before uvicorn drops them,
+and with the permessage-deflate parameters of the settings:
+
+    $ python -m chatrooms.config.server --host 0.0.0.0 --port 3000
+"""
+import argparse
+import socket
+from typing import Any, List, Optional, Union
+
+from starlette.types import ASGIApp
+import uvicorn
+from uvicorn.protocols.websockets.websockets_impl import WebSocketProtocol
+from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+
+from chatrooms.apps.chats.websockets import chats_connections
+from chatrooms.config import settings
+
+
+class ChatWebSocketProtocol(WebSocketProtocol):
+    """uvicorn's websockets protocol, which only allows turning permessage-deflate on with its defaults."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.config.ws_per_message_deflate:
+            self.available_extensions = [
+                ServerPerMessageDeflateFactory(
+                    server_no_context_takeover=settings.WS_DEFLATE_NO_CONTEXT_TAKEOVER,
+                    server_max_window_bits=settings.WS_DEFLATE_MAX_WINDOW_BITS,
+                    compress_settings={
+                        'level': settings.WS_DEFLATE_COMPRESS_LEVEL,
+                        'memLevel': settings.WS_DEFLATE_MEMORY_LEVEL,
+                    },
+                ),
+            ]
+
+
+class DrainingServer(uvicorn.Server):
+    """
+    uvicorn closes the open connections before the app's shutdown handlers run,
+    so the websockets are drained before that, while new ones are refused.
+    """
+
+    async def shutdown(self, sockets: Optional[List[socket.socket]] = None) -> None:
+        if not self.force_exit:
+            await chats_connections.drain()
+        await super().shutdown(sockets=sockets)
+
+
+def get_config(app: Union[ASGIApp, str], **kwargs: Any) -> uvicorn.Config:
+    return uvicorn.Config(
+        app, ws=ChatWebSocketProtocol, ws_per_message_deflate=settings.WS_PER_MESSAGE_DEFLATE, **kwargs,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--log-level', default='info')
+    parser.add_argument(
+        '--forwarded-allow-ips',
+        help="comma separated addresses of the proxies whose X-Forwarded-For headers give the client addresses, "
+             "$FORWARDED_ALLOW_IPS or 127.0.0.1 by default",
+    )
+    args = parser.parse_args()
+    config = get_config(
+        'main:app', host=args.host, port=args.port, log_level=args.log_level,
+        proxy_headers=True, forwarded_allow_ips=args.forwarded_allow_ips,
+    )
+    DrainingServer(config).run()
+
+
+if __name__ == '__main__':
+    main()
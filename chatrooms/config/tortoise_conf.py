@@ -1,7 +1,42 @@
+from tortoise.backends.base.config_generator import expand_db_url
+
+from chatrooms.apps.common.metrics import QueryTimingConnection
 from chatrooms.config import settings
 
+
+def get_db_connection_config(db_url: str, min_size: int, max_size: int) -> dict:
+    config = expand_db_url(db_url)
+    config['engine'] = 'chatrooms.apps.common.db'
+    config['credentials'].update(
+        minsize=min_size,
+        maxsize=max_size,
+        max_inactive_connection_lifetime=settings.DB_POOL_MAX_INACTIVE_LIFETIME,
+        statement_cache_size=settings.DB_STATEMENT_CACHE_SIZE,
+        command_timeout=settings.DB_COMMAND_TIMEOUT,
+    )
+    if settings.METRICS_ENABLED:
+        config['credentials']['connection_class'] = QueryTimingConnection
+    return config
+
+
+def get_connections_config() -> dict:
+    connections = {
+        "default": get_db_connection_config(
+            settings.DATABASE_URI, settings.DB_POOL_MIN_SIZE, settings.DB_POOL_MAX_SIZE,
+        ),
+    }
+    if settings.DATABASE_REPLICA_URI or settings.DB_READ_POOL_MAX_SIZE:
+        read_pool_max_size = settings.DB_READ_POOL_MAX_SIZE or settings.DB_POOL_MAX_SIZE
+        connections["read"] = get_db_connection_config(
+            settings.DATABASE_REPLICA_URI or settings.DATABASE_URI,
+            min(settings.DB_POOL_MIN_SIZE, read_pool_max_size),
+            read_pool_max_size,
+        )
+    return connections
+
+
 TORTOISE_ORM = {
-    "connections": {"default": settings.DATABASE_URI},
+    "connections": get_connections_config(),
     "apps": {
         "models": {
             "models": settings.APPS_MODELS,
@@ -4,7 +4,15 @@ from tortoise.contrib.test import finalizer, initializer
 from httpx import AsyncClient
 from pydantic import PostgresDsn, parse_obj_as
 
+from chatrooms.apps.chats.access import chat_access_cache
+from chatrooms.apps.chats.read_markers import chat_read_markers
+from chatrooms.apps.chats.recent_messages import recent_messages
+from chatrooms.apps.chats.sink import chat_messages_sink
+from chatrooms.apps.chats.websockets import chats_connections
+from chatrooms.apps.common.db import recent_writers
 from chatrooms.apps.common.mail import fast_mail
+from chatrooms.apps.common.ratelimit import rate_limit_backend
+from chatrooms.apps.users.authentication import token_cache
 from chatrooms.apps.users.tests.factories import UserFactory
 from chatrooms.config import settings
 from main import app
@@ -32,6 +40,14 @@ def fake_db(event_loop):
     )
     initializer(db_url=fake_url, modules=settings.APPS_MODELS, loop=event_loop)
     yield
+    token_cache.clear()
+    chat_access_cache.clear()
+    recent_messages.clear()
+    chat_messages_sink.clear()
+    chat_read_markers.clear()
+    recent_writers.clear()
+    rate_limit_backend.clear()
+    chats_connections.presence.clear()
     finalizer()
 
 
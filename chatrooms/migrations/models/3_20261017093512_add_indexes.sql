@@ -0,0 +1,14 @@
+-- upgrade --
+UPDATE "chat" SET "title" = LEFT("title", 149) || ' (' || LEFT("id"::TEXT, 8) || ')' WHERE "id" IN (SELECT "id" FROM (SELECT "id", ROW_NUMBER() OVER (PARTITION BY "creator_id", "title" ORDER BY "created_at", "id") AS "position" FROM "chat") AS "numbered" WHERE "position" > 1);
+CREATE UNIQUE INDEX IF NOT EXISTS "uid_chat_creator_8784b5" ON "chat" ("creator_id", "title");
+CREATE INDEX IF NOT EXISTS "idx_chat_creator_29baa5" ON "chat" ("creator_id", "created_at");
+CREATE INDEX IF NOT EXISTS "idx_chatmessage_chat_id_e8bf98" ON "chatmessage" ("chat_id", "id");
+DELETE FROM "chat_user" AS "a" USING "chat_user" AS "b" WHERE "a"."ctid" < "b"."ctid" AND "a"."chat_id" = "b"."chat_id" AND "a"."user_id" = "b"."user_id";
+CREATE UNIQUE INDEX IF NOT EXISTS "uid_chat_user_chat_id_user_id" ON "chat_user" ("chat_id", "user_id");
+CREATE INDEX IF NOT EXISTS "idx_chat_user_user_id_chat_id" ON "chat_user" ("user_id", "chat_id");
+-- downgrade --
+DROP INDEX IF EXISTS "idx_chat_user_user_id_chat_id";
+DROP INDEX IF EXISTS "uid_chat_user_chat_id_user_id";
+DROP INDEX IF EXISTS "idx_chatmessage_chat_id_e8bf98";
+DROP INDEX IF EXISTS "idx_chat_creator_29baa5";
+DROP INDEX IF EXISTS "uid_chat_creator_8784b5";
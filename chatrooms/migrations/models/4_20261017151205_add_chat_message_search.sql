@@ -0,0 +1,4 @@
+-- upgrade --
+CREATE INDEX IF NOT EXISTS "idx_chatmessage_text_search" ON "chatmessage" USING GIN (to_tsvector('simple', "text"));
+-- downgrade --
+DROP INDEX IF EXISTS "idx_chatmessage_text_search";
@@ -0,0 +1,12 @@
+-- upgrade --
+CREATE TABLE IF NOT EXISTS "chatreadmarker" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "last_read_id" INT NOT NULL  DEFAULT 0,
+    "updated_at" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP,
+    "chat_id" UUID NOT NULL REFERENCES "chat" ("id") ON DELETE CASCADE,
+    "user_id" INT NOT NULL REFERENCES "user" ("id") ON DELETE CASCADE,
+    CONSTRAINT "uid_chatreadmar_user_id_29589c" UNIQUE ("user_id", "chat_id")
+);
+COMMENT ON TABLE "chatreadmarker" IS 'The last message of the chat read by the user.';
+-- downgrade --
+DROP TABLE IF EXISTS "chatreadmarker";
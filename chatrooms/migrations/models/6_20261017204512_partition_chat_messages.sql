@@ -0,0 +1,30 @@
+-- upgrade --
+ALTER TABLE "chatmessage" RENAME TO "chatmessage_legacy";
+ALTER INDEX "idx_chatmessage_text_search" RENAME TO "chatmessage_legacy_text_search_idx";
+ALTER TABLE "chatmessage_legacy" DROP CONSTRAINT "chatmessage_pkey";
+ALTER TABLE "chatmessage_legacy" ADD CONSTRAINT "chatmessage_legacy_pkey" PRIMARY KEY ("id", "created_at");
+DROP INDEX "idx_chatmessage_chat_id_e8bf98";
+CREATE TABLE "chatmessage" (
+    "id" INT NOT NULL DEFAULT nextval('chatmessage_id_seq'),
+    "text" TEXT NOT NULL,
+    "created_at" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP,
+    "is_deleted" BOOL NOT NULL  DEFAULT False,
+    "author_id" INT NOT NULL REFERENCES "user" ("id") ON DELETE CASCADE,
+    "chat_id" UUID NOT NULL REFERENCES "chat" ("id") ON DELETE CASCADE,
+    PRIMARY KEY ("id", "created_at")
+) PARTITION BY RANGE ("created_at");
+ALTER SEQUENCE "chatmessage_id_seq" OWNED BY "chatmessage"."id";
+CREATE INDEX "idx_chatmessage_chat_id_e8bf98" ON "chatmessage" ("chat_id", "id") INCLUDE ("created_at");
+CREATE INDEX "idx_chatmessage_text_search" ON "chatmessage" USING GIN (to_tsvector('simple', "text"));
+ALTER TABLE "chatmessage" ATTACH PARTITION "chatmessage_legacy" DEFAULT;
+-- downgrade --
+ALTER TABLE "chatmessage" DETACH PARTITION "chatmessage_legacy";
+ALTER TABLE "chatmessage_legacy" DROP CONSTRAINT IF EXISTS "chatmessage_legacy_created_at_check";
+INSERT INTO "chatmessage_legacy" ("id", "text", "created_at", "is_deleted", "author_id", "chat_id") SELECT "id", "text", "created_at", "is_deleted", "author_id", "chat_id" FROM "chatmessage";
+ALTER SEQUENCE "chatmessage_id_seq" OWNED BY "chatmessage_legacy"."id";
+DROP TABLE "chatmessage";
+ALTER TABLE "chatmessage_legacy" RENAME TO "chatmessage";
+ALTER TABLE "chatmessage" DROP CONSTRAINT "chatmessage_legacy_pkey";
+ALTER TABLE "chatmessage" ADD CONSTRAINT "chatmessage_pkey" PRIMARY KEY ("id");
+ALTER INDEX "chatmessage_legacy_chat_id_id_created_at_idx" RENAME TO "idx_chatmessage_chat_id_e8bf98";
+ALTER INDEX "chatmessage_legacy_text_search_idx" RENAME TO "idx_chatmessage_text_search";
@@ -3,14 +3,22 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from tortoise.contrib.fastapi import register_tortoise
 
+from chatrooms.apps.chats.read_markers import chat_read_markers
+from chatrooms.apps.chats.sink import chat_messages_sink
+from chatrooms.apps.chats.websockets import chats_connections
+from chatrooms.apps.common.broadcast import broadcast
 from chatrooms.apps.common.exceptions import BadInputError, PermissionDeniedError
+from chatrooms.apps.common.middleware import MetricsMiddleware
+from chatrooms.apps.common.responses import FastJSONResponse
 from chatrooms.config import settings
 from chatrooms.config.endpoints import router
+from chatrooms.config.tortoise_conf import TORTOISE_ORM
 
 
 app = FastAPI(
     title="Chatrooms",
-    openapi_url=f"{settings.API_BASE_URL}/openapi.json"
+    openapi_url=f"{settings.API_BASE_URL}/openapi.json",
+    default_response_class=FastJSONResponse,
 )
 
 
@@ -22,19 +30,48 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+if settings.METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+
 
 app.include_router(router, prefix=settings.API_BASE_URL)
 
 
+# registered before tortoise's own shutdown handler, so these run while the db connections are still open
+@app.on_event("shutdown")
+async def drain_chat_connections():
+    await chats_connections.drain()
+    await chats_connections.presence.close()
+
+
+@app.on_event("shutdown")
+async def flush_chat_messages():
+    await chat_messages_sink.close()
+
+
+@app.on_event("shutdown")
+async def flush_chat_read_markers():
+    await chat_read_markers.close()
+
+
+@app.on_event("shutdown")
+async def disconnect_broadcast():
+    await broadcast.disconnect()
+
+
 register_tortoise(
     app,
-    db_url=settings.DATABASE_URI,
-    modules={"models": settings.APPS_MODELS},
+    config=TORTOISE_ORM,
     generate_schemas=False,
     add_exception_handlers=True,
 )
 
 
+@app.on_event("startup")
+async def connect_broadcast():
+    await broadcast.connect()
+
+
 @app.exception_handler(BadInputError)
 async def bad_input_error_handler(__: Request, exc: BadInputError):
     return JSONResponse(status_code=status.HTTP_400_BAD_REQUEST, content=exc.message)